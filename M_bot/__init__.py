@@ -0,0 +1 @@
+from M_bot import startup
@@ -0,0 +1,237 @@
+"""
+This module moves the expenses of the closed years out of the hot database, one archive database per year.
+
+An archived year keeps its expenses and rollups in ARCHIVE_DIR/expenses-<year>.db and is listed in the
+archived_years table. The queries over a date range run on every database holding a part of it: the archives
+of the years in the range are attached to the connection on demand and combined with the hot database with
+UNION ALL. Expenses added to an archived year later stay in the hot database until the next archiving.
+A year is moved ARCHIVE_CHUNK_SIZE expenses at a time, each chunk in a transaction of its own, so the bot's
+writes never wait long for the write lock.
+"""
+import os
+import sqlite3
+import time
+from datetime import date, datetime
+
+from M_bot import db
+
+# Directory of the archives, next to the database by default
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR')
+# Closed years kept in the hot database, the older ones are archived
+ARCHIVE_KEEP_YEARS = int(os.getenv('ARCHIVE_KEEP_YEARS', '1'))
+# SQLite attaches at most 10 databases to a connection
+ARCHIVE_MAX_ATTACHED = int(os.getenv('ARCHIVE_MAX_ATTACHED', '10'))
+# Expenses moved per transaction, and the pause letting the bot's writes run between two of them
+ARCHIVE_CHUNK_SIZE = int(os.getenv('ARCHIVE_CHUNK_SIZE', '5000'))
+ARCHIVE_CHUNK_PAUSE = float(os.getenv('ARCHIVE_CHUNK_PAUSE_MS', '50')) / 1000
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS {schema}.expenses (
+       id integer PRIMARY KEY,
+       chat_id integer NOT NULL DEFAULT 0,
+       name text,
+       category text,
+       shared integer NOT NULL DEFAULT 0,
+       amount integer,
+       date text)""",
+    "CREATE INDEX IF NOT EXISTS {schema}.idx_expenses_chat_date ON expenses (chat_id, date)",
+    """CREATE TABLE IF NOT EXISTS {schema}.daily_totals (
+       chat_id integer,
+       day text,
+       category text,
+       shared integer,
+       total real,
+       count integer,
+       PRIMARY KEY (chat_id, day, category, shared))""",
+    """CREATE TABLE IF NOT EXISTS {schema}.monthly_totals (
+       chat_id integer,
+       month text,
+       category text,
+       shared integer,
+       total real,
+       count integer,
+       PRIMARY KEY (chat_id, month, category, shared))""",
+    f"""CREATE VIEW IF NOT EXISTS {{schema}}.expenses_search AS
+        SELECT id, {db.CHAT_TOKEN_SQL.format('chat_id')} AS chat, name, category FROM expenses""",
+    """CREATE VIRTUAL TABLE IF NOT EXISTS {schema}.expenses_fts USING fts5(
+       chat, name, category, content='expenses_search', content_rowid='id', prefix='2 3 4')""",
+]
+
+
+def archive_dir() -> str:
+    """
+    Returns the directory of the archives.
+    """
+    return ARCHIVE_DIR or os.path.join(os.path.dirname(db.DB_PATH) or '.', 'archive')
+
+
+def archive_path(year: int) -> str:
+    """
+    Returns the path of a year's archive.
+    """
+    return os.path.join(archive_dir(), f"expenses-{year}.db")
+
+
+def archived_years(conn: sqlite3.Connection) -> list:
+    """
+    Returns the archived years.
+    """
+    return [row[0] for row in conn.execute("SELECT year FROM archived_years ORDER BY year")]
+
+
+def attach(conn: sqlite3.Connection, year: int, keep: tuple = ()) -> str:
+    """
+    Attaches a year's archive to the connection unless it already is and returns its schema name.
+    When too many archives are attached, one that is not in keep is detached first.
+    """
+    schema = f"archive_{year}"
+    attached = [row[1] for row in conn.execute("PRAGMA database_list") if row[1].startswith('archive_')]
+    if schema in attached:
+        return schema
+    unused = [name for name in attached if name not in keep]
+    if len(attached) >= ARCHIVE_MAX_ATTACHED:
+        if not unused:
+            raise ValueError(f"More than {ARCHIVE_MAX_ATTACHED} archived years in one query")
+        conn.execute(f"DETACH DATABASE {unused[0]}")
+    os.makedirs(archive_dir(), exist_ok=True)
+    conn.execute(f"ATTACH DATABASE ? AS {schema}", (archive_path(year),))
+    _upgrade_search(conn, schema)
+    return schema
+
+
+def _upgrade_search(conn: sqlite3.Connection, schema: str):
+    # The archives made before the full-text index had the chat column get the new index on their first attach
+    def outdated():
+        columns = [row[1] for row in conn.execute(f"PRAGMA {schema}.table_info(expenses_fts)")]
+        return bool(columns) and 'chat' not in columns
+
+    if not outdated():
+        return
+    with db.transaction(conn):
+        # Another connection may have upgraded it while this one waited for the lock
+        if not outdated():
+            return
+        conn.execute(f"DROP TABLE {schema}.expenses_fts")
+        for statement in SCHEMA:
+            conn.execute(statement.format(schema=schema))
+        conn.execute(f"INSERT INTO {schema}.expenses_fts (expenses_fts) VALUES ('rebuild')")
+
+
+def _years(start: str, end: str) -> range:
+    # Years of a [start, end) range of dates or months
+    last = int(end[:4]) - (end[5:] in ('01', '01-01'))
+    return range(int(start[:4]), last + 1)
+
+
+def sources(conn: sqlite3.Connection, start: str, end: str) -> list:
+    """
+    Returns the schemas holding the expenses of the [start, end) range of dates or months,
+    attaching the archives it needs.
+    """
+    years = [year for year in archived_years(conn) if year in _years(start, end)]
+    keep = tuple(f"archive_{year}" for year in years)
+    return [attach(conn, year, keep) for year in years] + ['main']
+
+
+def union(conn: sqlite3.Connection, sql: str, params: tuple, start: str, end: str) -> tuple[str, tuple]:
+    """
+    Returns the query running sql, whose tables are prefixed with {schema}, on every database holding
+    the [start, end) range, combined with UNION ALL, and its parameters.
+    """
+    schemas = sources(conn, start, end)
+    return " UNION ALL ".join(sql.format(schema=schema) for schema in schemas), tuple(params) * len(schemas)
+
+
+def union_batches(conn: sqlite3.Connection, sql: str, params: tuple, start: str, end: str):
+    """
+    Like union, yields the queries covering the [start, end) range, each on at most ARCHIVE_MAX_ATTACHED archives,
+    for the ranges having more archived years than can be attached at once. Every query must run before the next one
+    is taken, which may detach its archives.
+    """
+    years = [year for year in archived_years(conn) if year in _years(start, end)]
+    batches = [years[index:index + ARCHIVE_MAX_ATTACHED] for index in range(0, len(years), ARCHIVE_MAX_ATTACHED)]
+    for number, batch in enumerate(batches or [[]]):
+        keep = tuple(f"archive_{year}" for year in batch)
+        schemas = [attach(conn, year, keep) for year in batch] + (['main'] if number == 0 else [])
+        yield " UNION ALL ".join(sql.format(schema=schema) for schema in schemas), tuple(params) * len(schemas)
+
+
+def years_to_archive(conn: sqlite3.Connection, day: date = None) -> list:
+    """
+    Returns the closed years older than the ARCHIVE_KEEP_YEARS last ones having expenses in the hot database.
+    """
+    last = (day or date.today()).year - 1 - ARCHIVE_KEEP_YEARS
+    return [int(row[0]) for row in conn.execute(
+        "SELECT DISTINCT substr(month, 1, 4) FROM monthly_totals WHERE month < ? ORDER BY 1",
+        (f"{last + 1:04d}-01",))]
+
+
+def _move_chunk(conn: sqlite3.Connection, schema: str, year: int, start: str, end: str, size: int) -> int:
+    # Moves the oldest size expenses of the [start, end) range and their totals into the archive
+    # in one transaction, returns the number of moved expenses
+    with db.transaction(conn):
+        for statement in SCHEMA:
+            conn.execute(statement.format(schema=schema))
+        last = conn.execute("SELECT date, id FROM main.expenses WHERE date >= ? AND date < ? "
+                            "ORDER BY date, id LIMIT 1 OFFSET ?", (start, end, size - 1)).fetchone()
+        chunk = "FROM main.expenses WHERE date >= ? AND date < ?"
+        params = (start, end)
+        if last is not None:
+            chunk += " AND (date, id) <= (?, ?)"
+            params += tuple(last)
+        first_id = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {schema}.expenses").fetchone()[0]
+        moved = conn.execute(f"INSERT INTO {schema}.expenses (chat_id, name, category, shared, amount, date) "
+                             f"SELECT chat_id, name, category, shared, amount, date {chunk} ORDER BY date, id",
+                             params).rowcount
+        if not moved:
+            return 0
+        # The archives have no triggers, the new expenses are added to their full-text index
+        conn.execute(f"INSERT INTO {schema}.expenses_fts (rowid, chat, name, category) "
+                     f"SELECT id, chat, name, category FROM {schema}.expenses_search WHERE id > ?", (first_id,))
+        conn.execute(f"""
+            INSERT INTO {schema}.daily_totals (chat_id, day, category, shared, total, count)
+            SELECT chat_id, date, category, shared, SUM(amount), COUNT(*) {chunk}
+            GROUP BY chat_id, date, category, shared
+            ON CONFLICT (chat_id, day, category, shared)
+            DO UPDATE SET total = total + excluded.total, count = count + excluded.count
+        """, params)
+        conn.execute(f"""
+            INSERT INTO {schema}.monthly_totals (chat_id, month, category, shared, total, count)
+            SELECT chat_id, substr(date, 1, 7), category, shared, SUM(amount), COUNT(*) {chunk}
+            GROUP BY chat_id, substr(date, 1, 7), category, shared
+            ON CONFLICT (chat_id, month, category, shared)
+            DO UPDATE SET total = total + excluded.total, count = count + excluded.count
+        """, params)
+        # The delete triggers take the moved expenses out of the hot rollups and index
+        conn.execute(f"DELETE {chunk}", params)
+        # Listed from the first chunk on, so the reads combine the moved and the remaining expenses
+        conn.execute(f"""
+            INSERT INTO archived_years (year, rows, archived_at)
+            VALUES (?, (SELECT COUNT(*) FROM {schema}.expenses), ?)
+            ON CONFLICT (year) DO UPDATE SET rows = excluded.rows, archived_at = excluded.archived_at
+        """, (year, datetime.now().isoformat(timespec='seconds')))
+    return moved
+
+
+def archive_year(conn: sqlite3.Connection, year: int, chunk_size: int = None) -> int:
+    """
+    Moves a year's expenses and rollups from the hot database into its archive, chunk_size (ARCHIVE_CHUNK_SIZE)
+    expenses per transaction, and returns the number of moved expenses. The connection must not be in a transaction.
+    With the hot database in WAL mode the commit of a chunk is atomic for each database but not across both.
+    """
+    start, end = db.year_range(year)
+    schema = attach(conn, year)
+    moved = 0
+    while True:
+        chunk = _move_chunk(conn, schema, year, start, end, chunk_size or ARCHIVE_CHUNK_SIZE)
+        if not chunk:
+            return moved
+        moved += chunk
+        time.sleep(ARCHIVE_CHUNK_PAUSE)
+
+
+def archive(conn: sqlite3.Connection, day: date = None) -> dict:
+    """
+    Archives every year returned by years_to_archive and returns the number of moved expenses per year.
+    """
+    return {year: archive_year(conn, year) for year in years_to_archive(conn, day)}
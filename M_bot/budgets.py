@@ -0,0 +1,166 @@
+"""
+This module contains the monthly budgets of the chats and their alerts.
+
+The budgets are stored in the budgets table and kept in memory with what was spent on them this month
+(shared expenses count as half, as in the reports). Every write registers record() to run once it is committed,
+so the spending is updated by the amount of the change and the alerts are found without a query.
+load() rebuilds the memory from the monthly rollup on startup; a budget's spending missing from memory is
+read from the rollup when it is needed, by the first expense of a commit since the rollup already counts all of them.
+"""
+import os
+import sqlite3
+import threading
+from datetime import date
+
+from M_bot import db
+
+# Percentages of a budget whose crossing is reported
+BUDGET_ALERTS = tuple(int(percent) / 100 for percent in os.getenv('BUDGET_ALERTS', '80,100').split(','))
+
+_lock = threading.Lock()
+# chat_id -> {category: monthly limit}
+_limits = {}
+# (chat_id, category) -> (month, spent), only for the categories with a budget
+_spent = {}
+# (chat_id, category) -> number of the commit whose expenses were all counted when the spending was read from the rollup
+_caught_up = {}
+
+
+def current_month() -> str:
+    """
+    Returns this month as 'yyyy-mm'.
+    """
+    return date.today().strftime('%Y-%m')
+
+
+def _select_spent(conn: sqlite3.Connection, chat_id: int, month: str, category: str) -> float:
+    return conn.execute("SELECT COALESCE(SUM(CASE WHEN shared THEN total / 2 ELSE total END), 0) FROM monthly_totals "
+                        "WHERE chat_id = ? AND month = ? AND category = ?", (chat_id, month, category)).fetchone()[0]
+
+
+def load(conn: sqlite3.Connection = None):
+    """
+    Loads the budgets and this month's spending on them.
+    """
+    conn = conn or db.get_connection()
+    month = current_month()
+    rows = conn.execute("""
+        SELECT b.chat_id, b.category, b.amount,
+               COALESCE(SUM(CASE WHEN m.shared THEN m.total / 2 ELSE m.total END), 0)
+        FROM budgets b
+        LEFT JOIN monthly_totals m ON m.chat_id = b.chat_id AND m.category = b.category AND m.month = ?
+        GROUP BY b.chat_id, b.category
+    """, (month,)).fetchall()
+    with _lock:
+        _limits.clear()
+        _spent.clear()
+        _caught_up.clear()
+        for chat_id, category, amount, spent in rows:
+            _limits.setdefault(chat_id, {})[category] = amount
+            _spent[chat_id, category] = (month, spent)
+
+
+def reset():
+    """
+    Forgets every budget, until the next load().
+    """
+    with _lock:
+        _limits.clear()
+        _spent.clear()
+        _caught_up.clear()
+
+
+def _alerts(category: str, limit: float, before: float, after: float) -> list:
+    # The highest threshold crossed by the change
+    crossed = [threshold for threshold in BUDGET_ALERTS if before < threshold * limit <= after]
+    if not crossed:
+        return []
+    return [f"Budget alert: {category} reached {max(crossed):.0%} of its monthly budget ({after:.2f} of {limit:.2f})"]
+
+
+def record(chat_id: int, expense_date: str, category: str, amount: float, shared: bool, alerts: list = None):
+    """
+    Adds a committed expense, or removes it when the amount is negative, from this month's spending on the budget
+    of its category, and appends to alerts the thresholds the expense crossed.
+    Registered with db.after_commit(), so the expenses of a batch are added in order.
+    """
+    month = current_month()
+    if expense_date[:7] != month:
+        return
+    with _lock:
+        limit = _limits.get(chat_id, {}).get(category)
+        if limit is None:
+            return
+        change = amount / 2 if shared else amount
+        spent_month, spent = _spent.get((chat_id, category), (None, 0))
+        commit = db.commit_number()
+        if spent_month == month and commit is not None and _caught_up.get((chat_id, category)) == commit:
+            # Read from the rollup by an earlier expense of the same commit, which counted this one too
+            before = after = spent
+        elif spent_month == month:
+            before, after = spent, spent + change
+        else:
+            # The rollup already counts every expense of the commit
+            after = _select_spent(db.get_connection(), chat_id, month, category)
+            before = after - change
+            _caught_up[chat_id, category] = commit
+        _spent[chat_id, category] = (month, after)
+    if alerts is not None and change > 0:
+        alerts.extend(_alerts(category, limit, before, after))
+
+
+def forget_spent(chat_id: int):
+    """
+    Drops the chat's spending from memory, after writes that do not record() their expenses.
+    """
+    with _lock:
+        for key in [key for key in _spent if key[0] == chat_id]:
+            del _spent[key]
+
+
+def _set_limit(chat_id: int, category: str, amount: float):
+    with _lock:
+        if amount:
+            _limits.setdefault(chat_id, {})[category] = amount
+        else:
+            _limits.get(chat_id, {}).pop(category, None)
+        _spent.pop((chat_id, category), None)
+
+
+def set_budget(chat_id: int, category: str, amount: float):
+    """
+    Sets the monthly budget of a category of the chat, an amount of 0 removes it.
+    """
+    with db.transaction() as conn:
+        if amount:
+            conn.execute("INSERT INTO budgets (chat_id, category, amount) VALUES (?, ?, ?) "
+                         "ON CONFLICT (chat_id, category) DO UPDATE SET amount = excluded.amount",
+                         (chat_id, category, amount))
+        else:
+            conn.execute("DELETE FROM budgets WHERE chat_id = ? AND category = ?", (chat_id, category))
+        db.after_commit(_set_limit, chat_id, category, amount)
+
+
+def get_budgets(chat_id: int) -> list:
+    """
+    Returns the chat's budgets as (category, limit, spent this month), sorted by category.
+    """
+    month = current_month()
+    with _lock:
+        limits = dict(_limits.get(chat_id, {}))
+        spent = {category: _spent.get((chat_id, category)) for category in limits}
+    conn = db.get_connection()
+    return [(category, limits[category],
+             spent[category][1] if spent[category] and spent[category][0] == month
+             else _select_spent(conn, chat_id, month, category))
+            for category in sorted(limits)]
+
+
+def format_budgets(budgets: list) -> str:
+    """
+    Formats the budgets for /budget.
+    """
+    if not budgets:
+        return "No budgets yet, set one with /budget category amount"
+    return '\n'.join(["Budgets this month:"] + [f"{category}: {spent:.2f} of {limit:.2f} ({spent / limit:.0%})"
+                                                for category, limit, spent in budgets])
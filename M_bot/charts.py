@@ -0,0 +1,104 @@
+"""
+This module renders the report charts as PNG images.
+
+Every chart is drawn on its own Figure with the Agg canvas instead of the global pyplot figure,
+so charts never leak into each other, nothing is shown on screen, the figures are freed as soon as
+the image is saved and charts can be rendered from several threads at once.
+"""
+import os
+from collections import namedtuple
+from io import BytesIO
+
+import matplotlib.style
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.patches import Circle
+
+# Draw the four charts of a report on a single image
+REPORT_COMBINED = os.getenv('REPORT_COMBINED', '0') == '1'
+
+CHART_SIZE = (8, 6)
+CHART_DPI = 100
+
+# The style is applied once when the module is loaded, rendering only reads it
+matplotlib.style.use('fivethirtyeight')
+
+Panel = namedtuple('Panel', ['kind', 'data', 'title'])
+
+
+def _draw_bar(ax, data: dict):
+    ax.bar(list(data.keys()), list(data.values()))
+
+
+def _draw_donut(ax, data: dict):
+    values = [value for value in data.values() if value > 0]
+    if not values:
+        ax.text(0.5, 0.5, "No expenses", ha='center', va='center', transform=ax.transAxes)
+        ax.set_axis_off()
+        return
+    labels = [label for label, value in data.items() if value > 0]
+    ax.pie(values, labels=labels, autopct='%1.1f%%', startangle=90, pctdistance=0.85)
+    ax.add_artist(Circle((0, 0), 0.70, fc='white'))
+    ax.axis('equal')
+
+
+DRAW = {
+    'bar': _draw_bar,
+    'donut': _draw_donut,
+}
+
+
+def _save(fig: Figure) -> BytesIO:
+    # Render the figure as PNG into memory and free it
+    buffer = BytesIO()
+    try:
+        FigureCanvasAgg(fig).print_png(buffer)
+    finally:
+        fig.clear()
+    buffer.seek(0)
+    return buffer
+
+
+def render(kind: str, data: dict, title: str) -> BytesIO:
+    """
+    Renders a 'bar' or 'donut' chart of the data and returns the PNG in a buffer.
+    """
+    return render_panels([Panel(kind, data, title)], columns=1)
+
+
+def render_panels(panels: list, columns: int = 2) -> BytesIO:
+    """
+    Renders the panels as the subplots of one figure, in rows of the given number of columns,
+    and returns the PNG in a buffer.
+    """
+    rows = -(-len(panels) // columns)
+    fig = Figure(figsize=(CHART_SIZE[0] * columns, CHART_SIZE[1] * rows), dpi=CHART_DPI)
+    for index, panel in enumerate(panels, 1):
+        ax = fig.add_subplot(rows, columns, index)
+        DRAW[panel.kind](ax, panel.data)
+        ax.set_title(panel.title)
+    fig.tight_layout()
+    return _save(fig)
+
+
+def report_panels(totals: dict, bucket: str, period: str) -> list:
+    """
+    Returns the four panels of a report: the expenses per bucket ('day' or 'month') and per category,
+    then the same for the shared expenses.
+    """
+    return [
+        Panel('bar', totals['per_bucket'], f"Expenses per {bucket} for {period}"),
+        Panel('donut', totals['per_category'], f"Expenses per category for {period}"),
+        Panel('bar', totals['shared_per_bucket'], f"Shared expenses per {bucket} for {period}"),
+        Panel('donut', totals['shared_per_category'], f"Shared expenses per category for {period}"),
+    ]
+
+
+def render_report(totals: dict, bucket: str, period: str, combined: bool = None) -> list:
+    """
+    Renders the charts of a report, as one image when combined and as one image per panel otherwise.
+    """
+    panels = report_panels(totals, bucket, period)
+    if REPORT_COMBINED if combined is None else combined:
+        return [render_panels(panels)]
+    return [render(*panel) for panel in panels]
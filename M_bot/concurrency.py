@@ -0,0 +1,74 @@
+"""
+This module limits the work of the expensive commands.
+
+Identical requests running at the same time are coalesced: the first one computes the result and the others
+wait for it. The computations hold a slot of their chat (CHAT_HEAVY_LIMIT per chat) and a global slot
+(HEAVY_LIMIT), so the requests of a busy chat queue behind each other instead of taking every worker.
+"""
+import asyncio
+import os
+from contextlib import asynccontextmanager
+
+from M_bot import metrics
+
+# Expensive computations running at once for a chat and for all the chats
+CHAT_HEAVY_LIMIT = int(os.getenv('CHAT_HEAVY_LIMIT', '1'))
+HEAVY_LIMIT = int(os.getenv('HEAVY_LIMIT', '4'))
+
+_loop = None
+_inflight = {}
+_chat_slots = {}
+_global_slots = None
+
+
+def _state():
+    # The asyncio primitives belong to the running loop, start over when it changed
+    global _loop, _global_slots
+    loop = asyncio.get_running_loop()
+    if loop is not _loop:
+        _loop = loop
+        _inflight.clear()
+        _chat_slots.clear()
+        _global_slots = asyncio.Semaphore(HEAVY_LIMIT)
+
+
+@asynccontextmanager
+async def heavy(chat_id: int):
+    """
+    Holds a slot of the chat and a global slot while the block runs, waiting for them in order.
+    """
+    _state()
+    slots = _chat_slots.get(chat_id)
+    if slots is None:
+        # [semaphore, number of users]
+        slots = _chat_slots[chat_id] = [asyncio.Semaphore(CHAT_HEAVY_LIMIT), 0]
+    slots[1] += 1
+    try:
+        async with slots[0], _global_slots:
+            yield
+    finally:
+        slots[1] -= 1
+        if not slots[1]:
+            del _chat_slots[chat_id]
+
+
+async def coalesce(key: tuple, fn, *args):
+    """
+    Returns await fn(*args), or the result of the identical call already running for the same key.
+    The computation keeps running when one of the callers is cancelled.
+    """
+    _state()
+    task = _inflight.get(key)
+    if task is None:
+        task = _inflight[key] = asyncio.ensure_future(fn(*args))
+        task.add_done_callback(lambda _: _inflight.pop(key, None) if _inflight.get(key) is task else None)
+    else:
+        metrics.inc('bot_coalesced_total', kind=key[0])
+    return await asyncio.shield(task)
+
+
+def inflight() -> int:
+    """
+    Returns the number of computations running.
+    """
+    return len(_inflight)
@@ -0,0 +1,777 @@
+"""
+This module contains the database schema, the data access layer and helpers shared by the bot and the stats.
+
+Every thread uses its own connection. The handlers await read() for queries, which run on a thread pool,
+and write() for changes, which a single writer task commits in batches on the writer thread.
+"""
+import asyncio
+import itertools
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+
+from M_bot import metrics
+
+DB_PATH = os.getenv('DB_PATH', 'data/expenses.db')
+DB_READ_THREADS = int(os.getenv('DB_READ_THREADS', '4'))
+# Chat the expenses recorded before the ledgers were split per chat are assigned to
+LEGACY_CHAT_ID = int(os.getenv('LEGACY_CHAT_ID', '0'))
+# Writes queued within this window are committed together, up to DB_WRITE_BATCH_SIZE of them
+DB_WRITE_WINDOW = float(os.getenv('DB_WRITE_WINDOW_MS', '5')) / 1000
+DB_WRITE_BATCH_SIZE = int(os.getenv('DB_WRITE_BATCH_SIZE', '64'))
+
+# Dates are stored as ISO 'YYYY-MM-DD' text so they sort and compare correctly
+DATE_FORMAT = '%Y-%m-%d'
+USER_DATE_FORMAT = '%d.%m.%Y'
+
+# The shared flag is stored as 0 or 1 and shown to the users as yes or no
+SHARED_AS_TEXT = "CASE WHEN shared THEN 'yes' ELSE 'no' END"
+
+
+def connect(path: str = None, **kwargs) -> sqlite3.Connection:
+    """
+    Opens a connection to the expenses database.
+    """
+    path = path or DB_PATH
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    return sqlite3.connect(path, **kwargs)
+
+
+def _iso_date(value) -> str:
+    # The dates typed by the users, with or without the leading zeros, None when it cannot be read
+    try:
+        return datetime.strptime(value.strip(), USER_DATE_FORMAT).strftime(DATE_FORMAT)
+    except (AttributeError, ValueError):
+        return None
+
+
+def _convert_dates(conn: sqlite3.Connection, table: str, quarantine: bool = True) -> int:
+    # Rewrites the dates of the table that are not ISO yet as 'yyyy-mm-dd'. The rows whose date cannot be read are
+    # moved to quarantined_expenses, so they can be fixed by hand. Returns the number of quarantined rows.
+    rows = conn.execute(f"SELECT rowid, date FROM {table} "
+                        "WHERE date IS NULL OR date NOT GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]'").fetchall()
+    dates = [(rowid, _iso_date(value)) for rowid, value in rows]
+    conn.executemany(f"UPDATE {table} SET date = ? WHERE rowid = ?",
+                     [(value, rowid) for rowid, value in dates if value])
+    invalid = [(rowid,) for rowid, value in dates if value is None]
+    if not invalid or not quarantine:
+        return 0
+    columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    chat_id = 'chat_id' if 'chat_id' in columns else '0'
+    conn.execute("""CREATE TABLE IF NOT EXISTS quarantined_expenses (
+                    source text,
+                    chat_id integer,
+                    name text,
+                    category text,
+                    shared text,
+                    amount integer,
+                    date text)""")
+    conn.executemany(f"INSERT INTO quarantined_expenses (source, chat_id, name, category, shared, amount, date) "
+                     f"SELECT '{table}', {chat_id}, name, category, shared, amount, date FROM {table} "
+                     f"WHERE rowid = ?", invalid)
+    conn.executemany(f"DELETE FROM {table} WHERE rowid = ?", invalid)
+    print(f"Moved {len(invalid)} expenses with unreadable dates from {table} to quarantined_expenses")
+    return len(invalid)
+
+
+def _migrate_iso_dates(conn: sqlite3.Connection):
+    # Rewrite 'dd.mm.yyyy' dates as 'yyyy-mm-dd' and index them.
+    # The rows of shared_expenses are copies of expenses, only the originals are quarantined.
+    _convert_dates(conn, 'expenses')
+    _convert_dates(conn, 'shared_expenses', quarantine=False)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_expenses_date ON expenses (date)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_shared_expenses_date ON shared_expenses (date)")
+
+
+def rebuild_rollups(conn: sqlite3.Connection):
+    """
+    Recomputes the daily and monthly totals from the expenses table.
+    """
+    conn.execute("DELETE FROM daily_totals")
+    conn.execute("DELETE FROM monthly_totals")
+    conn.execute("""
+        INSERT INTO daily_totals (chat_id, day, category, shared, total, count)
+        SELECT chat_id, date, category, shared, SUM(amount), COUNT(*) FROM expenses
+        GROUP BY chat_id, date, category, shared
+    """)
+    conn.execute("""
+        INSERT INTO monthly_totals (chat_id, month, category, shared, total, count)
+        SELECT chat_id, substr(day, 1, 7), category, shared, SUM(total), SUM(count) FROM daily_totals
+        GROUP BY chat_id, substr(day, 1, 7), category, shared
+    """)
+
+
+def _migrate_rollups(conn: sqlite3.Connection):
+    # Totals per (day, category, shared) and (month, category, shared), kept up to date by triggers
+    # so they change in the same transaction as the expenses
+    conn.execute("""CREATE TABLE IF NOT EXISTS daily_totals (
+                    day text,
+                    category text,
+                    shared text,
+                    total real,
+                    count integer,
+                    PRIMARY KEY (day, category, shared))""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS monthly_totals (
+                    month text,
+                    category text,
+                    shared text,
+                    total real,
+                    count integer,
+                    PRIMARY KEY (month, category, shared))""")
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS expenses_rollup_insert AFTER INSERT ON expenses
+        BEGIN
+            INSERT INTO daily_totals (day, category, shared, total, count)
+            VALUES (NEW.date, NEW.category, NEW.shared, NEW.amount, 1)
+            ON CONFLICT (day, category, shared) DO UPDATE SET total = total + excluded.total, count = count + 1;
+            INSERT INTO monthly_totals (month, category, shared, total, count)
+            VALUES (substr(NEW.date, 1, 7), NEW.category, NEW.shared, NEW.amount, 1)
+            ON CONFLICT (month, category, shared) DO UPDATE SET total = total + excluded.total, count = count + 1;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS expenses_rollup_delete AFTER DELETE ON expenses
+        BEGIN
+            UPDATE daily_totals SET total = total - OLD.amount, count = count - 1
+            WHERE day = OLD.date AND category = OLD.category AND shared = OLD.shared;
+            DELETE FROM daily_totals
+            WHERE day = OLD.date AND category = OLD.category AND shared = OLD.shared AND count <= 0;
+            UPDATE monthly_totals SET total = total - OLD.amount, count = count - 1
+            WHERE month = substr(OLD.date, 1, 7) AND category = OLD.category AND shared = OLD.shared;
+            DELETE FROM monthly_totals
+            WHERE month = substr(OLD.date, 1, 7) AND category = OLD.category AND shared = OLD.shared AND count <= 0;
+        END
+    """)
+
+
+def _migrate_chat_ledgers(conn: sqlite3.Connection):
+    # Every chat gets its own ledger, the existing expenses go to LEGACY_CHAT_ID
+    for table in ('expenses', 'shared_expenses'):
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN chat_id integer NOT NULL DEFAULT 0")
+        if LEGACY_CHAT_ID:
+            conn.execute(f"UPDATE {table} SET chat_id = ?", (LEGACY_CHAT_ID,))
+    conn.execute("DROP INDEX IF EXISTS idx_expenses_date")
+    conn.execute("DROP INDEX IF EXISTS idx_shared_expenses_date")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_expenses_chat_date ON expenses (chat_id, date)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_shared_expenses_chat_date ON shared_expenses (chat_id, date)")
+
+    # The rollups are keyed by chat too, they are rebuilt after the migrations
+    conn.execute("DROP TRIGGER IF EXISTS expenses_rollup_insert")
+    conn.execute("DROP TRIGGER IF EXISTS expenses_rollup_delete")
+    conn.execute("DROP TABLE IF EXISTS daily_totals")
+    conn.execute("DROP TABLE IF EXISTS monthly_totals")
+    conn.execute("""CREATE TABLE daily_totals (
+                    chat_id integer,
+                    day text,
+                    category text,
+                    shared text,
+                    total real,
+                    count integer,
+                    PRIMARY KEY (chat_id, day, category, shared))""")
+    conn.execute("""CREATE TABLE monthly_totals (
+                    chat_id integer,
+                    month text,
+                    category text,
+                    shared text,
+                    total real,
+                    count integer,
+                    PRIMARY KEY (chat_id, month, category, shared))""")
+    conn.execute("""
+        CREATE TRIGGER expenses_rollup_insert AFTER INSERT ON expenses
+        BEGIN
+            INSERT INTO daily_totals (chat_id, day, category, shared, total, count)
+            VALUES (NEW.chat_id, NEW.date, NEW.category, NEW.shared, NEW.amount, 1)
+            ON CONFLICT (chat_id, day, category, shared)
+            DO UPDATE SET total = total + excluded.total, count = count + 1;
+            INSERT INTO monthly_totals (chat_id, month, category, shared, total, count)
+            VALUES (NEW.chat_id, substr(NEW.date, 1, 7), NEW.category, NEW.shared, NEW.amount, 1)
+            ON CONFLICT (chat_id, month, category, shared)
+            DO UPDATE SET total = total + excluded.total, count = count + 1;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER expenses_rollup_delete AFTER DELETE ON expenses
+        BEGIN
+            UPDATE daily_totals SET total = total - OLD.amount, count = count - 1
+            WHERE chat_id = OLD.chat_id AND day = OLD.date AND category = OLD.category AND shared = OLD.shared;
+            DELETE FROM daily_totals
+            WHERE chat_id = OLD.chat_id AND day = OLD.date AND category = OLD.category AND shared = OLD.shared
+            AND count <= 0;
+            UPDATE monthly_totals SET total = total - OLD.amount, count = count - 1
+            WHERE chat_id = OLD.chat_id AND month = substr(OLD.date, 1, 7) AND category = OLD.category
+            AND shared = OLD.shared;
+            DELETE FROM monthly_totals
+            WHERE chat_id = OLD.chat_id AND month = substr(OLD.date, 1, 7) AND category = OLD.category
+            AND shared = OLD.shared AND count <= 0;
+        END
+    """)
+
+
+def _migrate_single_table(conn: sqlite3.Connection):
+    # The shared expenses were also copied to shared_expenses, keep only expenses with a shared flag.
+    # Copies left in shared_expenses after their expense was deleted are dropped with the table.
+    conn.execute("""CREATE TABLE expenses_new (
+                    id integer PRIMARY KEY,
+                    chat_id integer NOT NULL DEFAULT 0,
+                    name text,
+                    category text,
+                    shared integer NOT NULL DEFAULT 0 CHECK (shared IN (0, 1)),
+                    amount integer,
+                    date text)""")
+    conn.execute("""
+        INSERT INTO expenses_new (id, chat_id, name, category, shared, amount, date)
+        SELECT rowid, chat_id, name, category, lower(trim(shared)) = 'yes', amount, date FROM expenses
+    """)
+    conn.execute("DROP TABLE expenses")
+    conn.execute("DROP TABLE shared_expenses")
+    conn.execute("ALTER TABLE expenses_new RENAME TO expenses")
+    conn.execute("CREATE INDEX idx_expenses_chat_date ON expenses (chat_id, date)")
+    # Covers the shared-only queries without reading the table
+    conn.execute("CREATE INDEX idx_expenses_shared ON expenses (chat_id, date, category, amount, shared)"
+                 " WHERE shared = 1")
+    # For the code still reading shared_expenses
+    conn.execute("""
+        CREATE VIEW shared_expenses AS
+        SELECT id, chat_id, name, category, 'yes' AS shared, amount, date FROM expenses WHERE shared = 1
+    """)
+
+    # The rollups are keyed by the flag now, they are rebuilt after the migrations
+    conn.execute("DROP TABLE daily_totals")
+    conn.execute("DROP TABLE monthly_totals")
+    conn.execute("""CREATE TABLE daily_totals (
+                    chat_id integer,
+                    day text,
+                    category text,
+                    shared integer,
+                    total real,
+                    count integer,
+                    PRIMARY KEY (chat_id, day, category, shared))""")
+    conn.execute("""CREATE TABLE monthly_totals (
+                    chat_id integer,
+                    month text,
+                    category text,
+                    shared integer,
+                    total real,
+                    count integer,
+                    PRIMARY KEY (chat_id, month, category, shared))""")
+    conn.execute("""
+        CREATE TRIGGER expenses_rollup_insert AFTER INSERT ON expenses
+        BEGIN
+            INSERT INTO daily_totals (chat_id, day, category, shared, total, count)
+            VALUES (NEW.chat_id, NEW.date, NEW.category, NEW.shared, NEW.amount, 1)
+            ON CONFLICT (chat_id, day, category, shared)
+            DO UPDATE SET total = total + excluded.total, count = count + 1;
+            INSERT INTO monthly_totals (chat_id, month, category, shared, total, count)
+            VALUES (NEW.chat_id, substr(NEW.date, 1, 7), NEW.category, NEW.shared, NEW.amount, 1)
+            ON CONFLICT (chat_id, month, category, shared)
+            DO UPDATE SET total = total + excluded.total, count = count + 1;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER expenses_rollup_delete AFTER DELETE ON expenses
+        BEGIN
+            UPDATE daily_totals SET total = total - OLD.amount, count = count - 1
+            WHERE chat_id = OLD.chat_id AND day = OLD.date AND category = OLD.category AND shared = OLD.shared;
+            DELETE FROM daily_totals
+            WHERE chat_id = OLD.chat_id AND day = OLD.date AND category = OLD.category AND shared = OLD.shared
+            AND count <= 0;
+            UPDATE monthly_totals SET total = total - OLD.amount, count = count - 1
+            WHERE chat_id = OLD.chat_id AND month = substr(OLD.date, 1, 7) AND category = OLD.category
+            AND shared = OLD.shared;
+            DELETE FROM monthly_totals
+            WHERE chat_id = OLD.chat_id AND month = substr(OLD.date, 1, 7) AND category = OLD.category
+            AND shared = OLD.shared AND count <= 0;
+        END
+    """)
+
+
+def _migrate_archived_years(conn: sqlite3.Connection):
+    # The closed years moved to their own archive database, see archive.py
+    conn.execute("""CREATE TABLE archived_years (
+                    year integer PRIMARY KEY,
+                    rows integer,
+                    archived_at text)""")
+
+
+def _migrate_budgets(conn: sqlite3.Connection):
+    # Monthly budgets per category, see budgets.py
+    conn.execute("""CREATE TABLE budgets (
+                    chat_id integer,
+                    category text,
+                    amount real,
+                    PRIMARY KEY (chat_id, category))""")
+
+
+def _migrate_search(conn: sqlite3.Connection):
+    # Full-text index of the names and categories, see search.py. It reads the rows from the expenses table
+    # and the triggers keep it in sync.
+    conn.execute("""CREATE VIRTUAL TABLE expenses_fts USING fts5(
+                    name, category, content='expenses', content_rowid='id', prefix='2 3')""")
+    conn.execute("""
+        CREATE TRIGGER expenses_fts_insert AFTER INSERT ON expenses
+        BEGIN
+            INSERT INTO expenses_fts (rowid, name, category) VALUES (NEW.id, NEW.name, NEW.category);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER expenses_fts_delete AFTER DELETE ON expenses
+        BEGIN
+            INSERT INTO expenses_fts (expenses_fts, rowid, name, category)
+            VALUES ('delete', OLD.id, OLD.name, OLD.category);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER expenses_fts_update AFTER UPDATE OF name, category ON expenses
+        BEGIN
+            INSERT INTO expenses_fts (expenses_fts, rowid, name, category)
+            VALUES ('delete', OLD.id, OLD.name, OLD.category);
+            INSERT INTO expenses_fts (rowid, name, category) VALUES (NEW.id, NEW.name, NEW.category);
+        END
+    """)
+    conn.execute("INSERT INTO expenses_fts (expenses_fts) VALUES ('rebuild')")
+
+
+def _migrate_loose_dates(conn: sqlite3.Connection):
+    # The first date migration only rewrote the zero-padded dates, convert the 'd.m.yyyy' ones it left behind
+    _convert_dates(conn, 'expenses')
+
+
+# The chat_id column as the token standing for the chat in the full-text index, see chat_token()
+CHAT_TOKEN_SQL = "'c' || replace({}, '-', 'n')"
+
+
+def chat_token(chat_id: int) -> str:
+    """
+    Returns the word standing for the chat in the full-text index, 'c42' or 'cn42' for the negative group ids.
+    """
+    return f"c{chat_id}".replace('-', 'n')
+
+
+def _migrate_search_chats(conn: sqlite3.Connection):
+    # The full-text index gets the chat as a word of its own, so a search only reads the chat's matches.
+    # The index reads its rows from the expenses_search view, which adds that word to the expenses.
+    for trigger in ('insert', 'delete', 'update'):
+        conn.execute(f"DROP TRIGGER expenses_fts_{trigger}")
+    conn.execute("DROP TABLE expenses_fts")
+    conn.execute(f"""CREATE VIEW expenses_search AS
+                    SELECT id, {CHAT_TOKEN_SQL.format('chat_id')} AS chat, name, category FROM expenses""")
+    conn.execute("""CREATE VIRTUAL TABLE expenses_fts USING fts5(
+                    chat, name, category, content='expenses_search', content_rowid='id', prefix='2 3 4')""")
+    new_chat, old_chat = CHAT_TOKEN_SQL.format('NEW.chat_id'), CHAT_TOKEN_SQL.format('OLD.chat_id')
+    conn.execute(f"""
+        CREATE TRIGGER expenses_fts_insert AFTER INSERT ON expenses
+        BEGIN
+            INSERT INTO expenses_fts (rowid, chat, name, category) VALUES (NEW.id, {new_chat}, NEW.name, NEW.category);
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER expenses_fts_delete AFTER DELETE ON expenses
+        BEGIN
+            INSERT INTO expenses_fts (expenses_fts, rowid, chat, name, category)
+            VALUES ('delete', OLD.id, {old_chat}, OLD.name, OLD.category);
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER expenses_fts_update AFTER UPDATE OF chat_id, name, category ON expenses
+        BEGIN
+            INSERT INTO expenses_fts (expenses_fts, rowid, chat, name, category)
+            VALUES ('delete', OLD.id, {old_chat}, OLD.name, OLD.category);
+            INSERT INTO expenses_fts (rowid, chat, name, category) VALUES (NEW.id, {new_chat}, NEW.name, NEW.category);
+        END
+    """)
+    conn.execute("INSERT INTO expenses_fts (expenses_fts) VALUES ('rebuild')")
+
+
+def claim_legacy_expenses(conn: sqlite3.Connection, chat_id: int) -> int:
+    """
+    Moves the expenses of the legacy ledger (chat 0) to the chat and returns how many were moved.
+    """
+    moved = conn.execute("UPDATE expenses SET chat_id = ? WHERE chat_id = 0", (chat_id,)).rowcount
+    rebuild_rollups(conn)
+    return moved
+
+
+# Each migration moves the schema one version up, PRAGMA user_version tracks the current one
+MIGRATIONS = [
+    _migrate_iso_dates,
+    _migrate_rollups,
+    _migrate_chat_ledgers,
+    _migrate_single_table,
+    _migrate_archived_years,
+    _migrate_budgets,
+    _migrate_search,
+    _migrate_loose_dates,
+    _migrate_search_chats,
+]
+
+
+def init_db(conn: sqlite3.Connection):
+    """
+    Creates the tables and applies pending migrations.
+    """
+    conn.execute("""CREATE TABLE IF NOT EXISTS expenses (
+               name text,
+               category text,
+               shared text,
+               amount integer,
+               date text)""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS shared_expenses (
+                    name text,
+                    category text,
+                    shared text,
+                    amount integer,
+                    date text)""")
+    conn.commit()
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        with transaction(conn):
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {number}")
+    # The rollups are derived from the expenses, rebuild them for the new schema
+    if version < len(MIGRATIONS):
+        with transaction(conn):
+            rebuild_rollups(conn)
+
+
+@contextmanager
+def transaction(conn: sqlite3.Connection = None):
+    """
+    Runs the block in a transaction on the connection (the thread's connection by default).
+    Inside another transaction a savepoint is used, so only the block is rolled back on error.
+    """
+    conn = conn or get_connection()
+    if conn.in_transaction:
+        callbacks = _after_commit.setdefault(conn, [])
+        mark = len(callbacks)
+        conn.execute("SAVEPOINT block")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK TO block")
+            conn.execute("RELEASE block")
+            del callbacks[mark:]
+            raise
+        conn.execute("RELEASE block")
+    else:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            _after_commit.pop(conn, None)
+            raise
+        try:
+            conn.commit()
+        except BaseException:
+            # Nothing was committed, the callbacks must not run with the next transaction
+            _after_commit.pop(conn, None)
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        previous = getattr(_local, 'commit', None)
+        _local.commit = next(_commit_numbers)
+        try:
+            for fn, args in _after_commit.pop(conn, []):
+                # The transaction is committed, a failing callback must not make its writes look failed
+                try:
+                    fn(*args)
+                except Exception as e:
+                    print(f"After commit callback {getattr(fn, '__qualname__', fn)} failed: {e}")
+        finally:
+            _local.commit = previous
+
+
+def commit_number():
+    """
+    Returns the number of the commit whose after_commit callbacks are running on this thread, None outside of them.
+    """
+    return getattr(_local, 'commit', None)
+
+
+def after_commit(fn, *args, conn: sqlite3.Connection = None):
+    """
+    Runs fn(*args) once the current transaction is committed, or right away outside of a transaction.
+    Nothing runs if the transaction or the savepoint it was registered in is rolled back.
+    The errors of the callbacks run after a commit are printed and do not reach the writer.
+    """
+    conn = conn or get_connection()
+    if conn.in_transaction:
+        _after_commit.setdefault(conn, []).append((fn, args))
+    else:
+        fn(*args)
+
+
+_local = threading.local()
+_after_commit = {}
+_commit_numbers = itertools.count(1)
+_connections = []
+_connections_lock = threading.Lock()
+_initialized = set()
+_generation = 0
+
+_read_executor = None
+_write_executor = None
+_write_queue = None
+_writer_task = None
+
+
+def get_connection() -> sqlite3.Connection:
+    """
+    Returns the connection of the current thread, opening it on first use.
+    The connections run in WAL mode so reads never wait for the writer.
+    """
+    connections = getattr(_local, 'connections', None)
+    if connections is None or _local.generation != _generation:
+        connections = _local.connections = {}
+        _local.generation = _generation
+    conn = connections.get(DB_PATH)
+    if conn is None:
+        # Opened by this thread only, but close() may run on another one
+        conn = connect(DB_PATH, isolation_level=None, check_same_thread=False,
+                       factory=metrics.connection_factory())
+        # Only applies to a new database, maintenance.py converts the existing ones
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("PRAGMA busy_timeout = 5000")
+        with _connections_lock:
+            if DB_PATH not in _initialized:
+                init_db(conn)
+                _initialized.add(DB_PATH)
+            _connections.append(conn)
+        connections[DB_PATH] = conn
+    return conn
+
+
+_write_stats = {'batches': 0, 'writes': 0, 'max_batch_size': 0, 'commit_seconds': 0.0, 'max_commit_seconds': 0.0}
+
+
+def _run_batch(batch: list) -> list:
+    # Runs on the writer thread: every write gets its own savepoint, the batch is committed once
+    results = []
+    started = time.perf_counter()
+    with transaction() as conn:
+        for fn, args in batch:
+            try:
+                with transaction(conn):
+                    results.append((True, fn(*args)))
+            except Exception as e:
+                results.append((False, e))
+    elapsed = time.perf_counter() - started
+
+    _write_stats['batches'] += 1
+    _write_stats['writes'] += len(batch)
+    _write_stats['max_batch_size'] = max(_write_stats['max_batch_size'], len(batch))
+    _write_stats['commit_seconds'] += elapsed
+    _write_stats['max_commit_seconds'] = max(_write_stats['max_commit_seconds'], elapsed)
+    metrics.inc('bot_db_write_batches_total')
+    metrics.inc('bot_db_writes_total', len(batch))
+    metrics.observe('bot_db_write_batch_seconds', elapsed)
+    return results
+
+
+async def _writer():
+    # Collects the writes queued within DB_WRITE_WINDOW and commits them in one transaction
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _write_queue.get()]
+        deadline = loop.time() + DB_WRITE_WINDOW
+        while len(batch) < DB_WRITE_BATCH_SIZE:
+            if not _write_queue.empty():
+                batch.append(_write_queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_write_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        try:
+            results = await loop.run_in_executor(_write_executor, _run_batch,
+                                                 [(fn, args) for fn, args, _ in batch])
+        except Exception as e:
+            # The commit failed, none of the writes happened
+            results = [(False, e)] * len(batch)
+
+        for (_, _, future), (ok, result) in zip(batch, results):
+            if future.cancelled():
+                continue
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(result)
+
+
+def write_stats() -> dict:
+    """
+    Returns the number of batches and writes, the batch sizes and the commit latencies of the writer.
+    """
+    stats = dict(_write_stats)
+    batches = stats['batches'] or 1
+    stats['avg_batch_size'] = stats['writes'] / batches
+    stats['avg_commit_seconds'] = stats['commit_seconds'] / batches
+    return stats
+
+
+def start():
+    """
+    Starts the read thread pool and the writer task, must be called from the event loop.
+    """
+    global _read_executor, _write_executor, _write_queue, _writer_task
+    if _read_executor is None:
+        _read_executor = ThreadPoolExecutor(DB_READ_THREADS, thread_name_prefix='db-read')
+    if _write_executor is None:
+        _write_executor = ThreadPoolExecutor(1, thread_name_prefix='db-write')
+    loop = asyncio.get_running_loop()
+    if _writer_task is None or _writer_task.done() or _writer_task.get_loop() is not loop:
+        _write_queue = asyncio.Queue()
+        _writer_task = loop.create_task(_writer())
+
+
+async def read(fn, *args):
+    """
+    Runs fn(*args) on the read thread pool and returns its result.
+    """
+    start()
+    return await asyncio.get_running_loop().run_in_executor(_read_executor, fn, *args)
+
+
+async def write(fn, *args):
+    """
+    Queues fn(*args) for the writer and returns its result once it ran.
+    """
+    start()
+    future = asyncio.get_running_loop().create_future()
+    await _write_queue.put((fn, args, future))
+    return await future
+
+
+async def stop():
+    """
+    Stops the writer task and the thread pools and closes the connections.
+    """
+    global _read_executor, _write_executor, _writer_task
+    if _writer_task is not None:
+        _writer_task.cancel()
+        _writer_task = None
+    for executor in (_read_executor, _write_executor):
+        if executor is not None:
+            executor.shutdown()
+    _read_executor = _write_executor = None
+    close()
+
+
+def close():
+    """
+    Closes every connection opened by get_connection().
+    """
+    global _generation
+    with _connections_lock:
+        for conn in _connections:
+            conn.close()
+        _connections.clear()
+        _initialized.clear()
+        _generation += 1
+
+
+CATEGORY_MAPPING = {
+    "food": "food",
+    "cosmetics": "cosmetics",
+    "hc": "house cleaning",
+    "eo": "eating out",
+    "cravings": "cravings",
+    "alcohol": "alcohol"
+}
+
+
+def normalize_category(category: str) -> str:
+    """
+    Expands the category shortcuts, other categories are kept as they are.
+    """
+    return CATEGORY_MAPPING.get(category, category)
+
+
+def parse_user_date(value: str) -> str:
+    """
+    Converts a 'dd.mm.yyyy' date typed by the user into the stored format.
+    Raises ValueError for invalid dates.
+    """
+    return datetime.strptime(value, USER_DATE_FORMAT).strftime(DATE_FORMAT)
+
+
+def today() -> str:
+    """
+    Returns today's date in the stored format.
+    """
+    return date.today().strftime(DATE_FORMAT)
+
+
+def next_day(value: str) -> str:
+    """
+    Returns the day after a stored date, to turn an inclusive end date into an exclusive one.
+    """
+    return (datetime.strptime(value, DATE_FORMAT) + timedelta(days=1)).strftime(DATE_FORMAT)
+
+
+def month_range(month: int, year: int) -> tuple[str, str]:
+    """
+    Returns the [start, end) date range of a month.
+    """
+    start = date(year, month, 1)
+    end = date(year + 1, 1, 1) if month == 12 else date(year, month + 1, 1)
+    return start.strftime(DATE_FORMAT), end.strftime(DATE_FORMAT)
+
+
+def year_range(year: int) -> tuple[str, str]:
+    """
+    Returns the [start, end) date range of a year.
+    """
+    return date(year, 1, 1).strftime(DATE_FORMAT), date(year + 1, 1, 1).strftime(DATE_FORMAT)
+
+
+def week_range(day: date = None) -> tuple[str, str]:
+    """
+    Returns the [start, end) date range from last Sunday up to and including the given day.
+    """
+    day = day or date.today()
+    start = day + timedelta(days=(6 - day.weekday()) % 7 - 7)
+    return start.strftime(DATE_FORMAT), (day + timedelta(days=1)).strftime(DATE_FORMAT)
+
+
+def month_to_date_range(day: date = None) -> tuple[str, str]:
+    """
+    Returns the [start, end) date range from the first of the month up to and including the given day.
+    """
+    day = day or date.today()
+    return day.replace(day=1).strftime(DATE_FORMAT), (day + timedelta(days=1)).strftime(DATE_FORMAT)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="M bot database maintenance")
+    parser.add_argument('command', choices=['migrate', 'rebuild-rollups', 'claim-legacy'])
+    parser.add_argument('chat_id', nargs='?', type=int, help="chat receiving the legacy expenses (claim-legacy)")
+    args = parser.parse_args()
+
+    conn = connect()
+    init_db(conn)
+    if args.command == 'rebuild-rollups':
+        rebuild_rollups(conn)
+        conn.commit()
+        print("Rollup tables rebuilt")
+    elif args.command == 'claim-legacy':
+        if args.chat_id is None:
+            parser.error("claim-legacy needs the chat id")
+        moved = claim_legacy_expenses(conn, args.chat_id)
+        conn.commit()
+        print(f"Moved {moved} expenses to chat {args.chat_id}")
+    conn.close()
@@ -0,0 +1,89 @@
+"""
+This module exports expenses as CSV or JSONL.
+
+The rows are streamed from the cursor in chunks into a spooled temporary file, which stays in memory
+while it is small and moves to a private temporary file when it grows. Big exports are gzip compressed.
+"""
+import csv
+import gzip
+import io
+import json
+import os
+import tempfile
+
+from M_bot import archive, db
+
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', '1000'))
+# Exports bigger than this are kept in a temporary file instead of memory
+EXPORT_SPOOL_SIZE = int(os.getenv('EXPORT_SPOOL_SIZE', str(1024 * 1024)))
+# Exports with more rows than this are compressed
+EXPORT_COMPRESS_ROWS = int(os.getenv('EXPORT_COMPRESS_ROWS', '10000'))
+# Telegram does not accept bigger documents from bots, the exports above it are not sent
+EXPORT_MAX_SIZE = int(os.getenv('EXPORT_MAX_SIZE', str(50 * 1024 * 1024)))
+
+EXPORT_FORMATS = ('csv', 'jsonl')
+COLUMNS = ('name', 'category', 'shared', 'amount', 'date')
+
+
+def count_expenses(chat_id: int, start: str, end: str) -> int:
+    """
+    Returns the number of the chat's expenses in the [start, end) date range.
+    """
+    conn = db.get_connection()
+    sql, params = archive.union(conn, "SELECT COUNT(*) FROM {schema}.expenses "
+                                "WHERE chat_id = ? AND date >= ? AND date < ?", (chat_id, start, end), start, end)
+    return sum(row[0] for row in conn.execute(sql, params))
+
+
+def _write_rows(cursor, text, export_format: str):
+    if export_format == 'csv':
+        writer = csv.writer(text)
+        writer.writerow(COLUMNS)
+        while rows := cursor.fetchmany(EXPORT_CHUNK_SIZE):
+            writer.writerows(rows)
+    else:
+        while rows := cursor.fetchmany(EXPORT_CHUNK_SIZE):
+            text.write(''.join(json.dumps(dict(zip(COLUMNS, row))) + '\n' for row in rows))
+
+
+def export_expenses(chat_id: int, start: str, end: str, export_format: str = 'csv', name: str = 'expenses'):
+    """
+    Exports the chat's expenses of the [start, end) date range.
+    Returns the file positioned at its start, its file name and the number of exported rows.
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format {export_format}")
+    count = count_expenses(chat_id, start, end)
+    compress = count > EXPORT_COMPRESS_ROWS
+    filename = f"{name}.{export_format}" + ('.gz' if compress else '')
+
+    output = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
+    stream = gzip.GzipFile(filename=filename[:-3], mode='wb', fileobj=output) if compress else output
+    text = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+
+    columns = ', '.join(db.SHARED_AS_TEXT if column == 'shared' else column for column in COLUMNS)
+    conn = db.get_connection()
+    sql, params = archive.union(conn, f"SELECT {columns} FROM {{schema}}.expenses "
+                                "WHERE chat_id = ? AND date >= ? AND date < ?", (chat_id, start, end), start, end)
+    cursor = conn.execute(f"SELECT * FROM ({sql}) ORDER BY date", params)
+    try:
+        _write_rows(cursor, text, export_format)
+    finally:
+        cursor.close()
+
+    text.flush()
+    # Detach so closing the wrappers does not close the output
+    text.detach()
+    if compress:
+        stream.close()
+    output.seek(0)
+    return output, filename, count
+
+
+def file_size(file) -> int:
+    """
+    Returns the size of the exported file and rewinds it.
+    """
+    size = file.seek(0, io.SEEK_END)
+    file.seek(0)
+    return size
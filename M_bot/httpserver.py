@@ -0,0 +1,88 @@
+"""
+This module contains a minimal HTTP/1.1 server on top of asyncio streams, used for the local endpoints of the bot.
+
+Every connection serves a single request and is closed after the response.
+"""
+import asyncio
+from http import HTTPStatus
+
+MAX_BODY_SIZE = 1024 * 1024
+
+
+class HTTPError(Exception):
+    """
+    Raised for requests that cannot be parsed.
+    """
+
+    def __init__(self, status: int):
+        super().__init__(HTTPStatus(status).phrase)
+        self.status = status
+
+
+async def read_request(reader: asyncio.StreamReader) -> tuple[str, str, dict, bytes]:
+    """
+    Reads a request and returns its method, path, lower-cased headers and body.
+    """
+    request_line = await reader.readline()
+    try:
+        method, path, _ = request_line.decode('latin-1').split()
+    except ValueError:
+        raise HTTPError(400) from None
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    try:
+        length = int(headers.get('content-length', '0'))
+    except ValueError:
+        raise HTTPError(400) from None
+    if length > MAX_BODY_SIZE:
+        raise HTTPError(413)
+    body = await reader.readexactly(length) if length else b''
+    return method, path, headers, body
+
+
+def format_response(status: int, body: bytes = b'', content_type: str = 'text/plain; charset=utf-8') -> bytes:
+    """
+    Formats a complete response.
+    """
+    head = (f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n")
+    return head.encode('latin-1') + body
+
+
+async def serve(host: str, port: int, handler) -> asyncio.Server:
+    """
+    Starts a server calling handler(method, path, headers, body) for every request.
+    The handler returns (status, body) or (status, body, content type).
+    """
+
+    async def handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            try:
+                request = await read_request(reader)
+            except HTTPError as e:
+                response = (e.status, str(e).encode())
+            except (asyncio.IncompleteReadError, ConnectionError):
+                return
+            else:
+                try:
+                    response = await handler(*request)
+                except Exception as e:
+                    print(f"HTTP handler error occurred: {e}")
+                    response = (500, b'Internal Server Error')
+            writer.write(format_response(*response))
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle_connection, host, port)
@@ -0,0 +1,172 @@
+"""
+This module imports expenses in bulk from a CSV file with name, category, shared, amount and date columns.
+
+The file is parsed in chunks on the read thread pool and every chunk is inserted with executemany
+in one write, so the file is never fully loaded into memory and other writes can run between the chunks.
+Files that are not UTF-8 are read as IMPORT_FALLBACK_ENCODING, a file that still cannot be read stops the import
+and the chunks inserted before are kept.
+"""
+import codecs
+import csv
+import io
+import os
+import sqlite3
+import time
+from datetime import datetime
+
+from M_bot import budgets, db, report_cache
+
+IMPORT_CHUNK_SIZE = int(os.getenv('IMPORT_CHUNK_SIZE', '5000'))
+# Encoding of the files that are not UTF-8, the bank statements are often exported in a Windows code page
+IMPORT_FALLBACK_ENCODING = os.getenv('IMPORT_FALLBACK_ENCODING', 'cp1250')
+
+# Only the first rejected rows are reported back to the user
+MAX_REPORTED_ERRORS = 5
+
+SHARED_VALUES = {
+    "yes": True, "y": True, "true": True, "1": True,
+    "no": False, "n": False, "false": False, "0": False,
+}
+
+
+def parse_date(value: str) -> str:
+    """
+    Converts a 'dd.mm.yyyy' or 'yyyy-mm-dd' date into the stored format.
+    Raises ValueError for invalid dates.
+    """
+    if '.' in value:
+        return db.parse_user_date(value)
+    return datetime.strptime(value, db.DATE_FORMAT).strftime(db.DATE_FORMAT)
+
+
+def parse_row(row: list) -> tuple:
+    """
+    Validates a CSV row and returns it as (name, category, shared, amount, date).
+    Raises ValueError with the reason when the row is invalid.
+    """
+    if len(row) != 5:
+        raise ValueError(f"expected 5 columns, got {len(row)}")
+    name, category, shared, amount, expense_date = (value.strip() for value in row)
+    if not name:
+        raise ValueError("missing name")
+    shared = SHARED_VALUES.get(shared.lower())
+    if shared is None:
+        raise ValueError("shared should be yes or no")
+    try:
+        amount = float(amount.replace(',', '.'))
+    except ValueError:
+        raise ValueError(f"invalid amount {amount!r}") from None
+    if amount <= 0:
+        raise ValueError("amount must be greater than 0")
+    if amount.is_integer():
+        amount = int(amount)
+    try:
+        expense_date = parse_date(expense_date)
+    except ValueError:
+        raise ValueError(f"invalid date {expense_date!r}") from None
+    return name.lower(), db.normalize_category(category.lower()), shared, amount, expense_date
+
+
+def parse_chunk(reader, size: int) -> tuple[list, list]:
+    """
+    Parses up to size rows from the CSV reader.
+    Returns the valid rows and the (line number, reason) of the rejected ones.
+    """
+    rows = []
+    rejected = []
+    for row in reader:
+        if not row:
+            continue
+        # Skip the header
+        if reader.line_num == 1 and row[0].strip().lower() == 'name':
+            continue
+        try:
+            rows.append(parse_row(row))
+        except ValueError as e:
+            rejected.append((reader.line_num, str(e)))
+        if len(rows) + len(rejected) >= size:
+            break
+    return rows, rejected
+
+
+def insert_expenses(chat_id: int, rows: list) -> int:
+    """
+    Inserts the parsed rows into the chat's ledger in one transaction and returns how many were inserted.
+    """
+    rows = [row + (chat_id,) for row in rows]
+    with db.transaction() as conn:
+        conn.executemany("INSERT INTO expenses (name, category, shared, amount, date, chat_id) "
+                         "VALUES (?, ?, ?, ?, ?, ?)", rows)
+        for month in {row[4][:7] for row in rows}:
+            db.after_commit(report_cache.bump_version, chat_id, f"{month}-01")
+        db.after_commit(budgets.forget_spent, chat_id)
+    return len(rows)
+
+
+def detect_encoding(file, block_size: int = 1024 * 1024) -> str:
+    """
+    Returns 'utf-8-sig' when the whole binary file object is UTF-8, IMPORT_FALLBACK_ENCODING otherwise,
+    and rewinds the file.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        while block := file.read(block_size):
+            decoder.decode(block)
+        decoder.decode(b'', final=True)
+        return 'utf-8-sig'
+    except UnicodeDecodeError:
+        return IMPORT_FALLBACK_ENCODING
+    finally:
+        file.seek(0)
+
+
+async def import_csv(file, chat_id: int) -> dict:
+    """
+    Imports the expenses from a seekable binary CSV file object into the chat's ledger.
+    Returns the number of inserted rows, the number and the first reasons of the rejected rows,
+    the error that stopped the import, if any, and the elapsed time.
+    """
+    started = time.perf_counter()
+    encoding = await db.read(detect_encoding, file)
+    reader = csv.reader(io.TextIOWrapper(file, encoding=encoding, newline=''))
+    inserted = 0
+    rejected = 0
+    errors = []
+    error = None
+    # Last line of the chunks already imported
+    line = 0
+    try:
+        while True:
+            rows, chunk_rejected = await db.read(parse_chunk, reader, IMPORT_CHUNK_SIZE)
+            if not rows and not chunk_rejected:
+                break
+            if rows:
+                inserted += await db.write(insert_expenses, chat_id, rows)
+            rejected += len(chunk_rejected)
+            errors.extend(chunk_rejected[:MAX_REPORTED_ERRORS - len(errors)])
+            line = reader.line_num
+    except (UnicodeDecodeError, csv.Error) as e:
+        error = f"the file could not be read after line {line} ({e})"
+    except sqlite3.Error as e:
+        print(f"Database error occurred: {e}")
+        error = f"the expenses after line {line} could not be saved"
+    return {
+        'inserted': inserted,
+        'rejected': rejected,
+        'errors': errors,
+        'error': error,
+        'seconds': time.perf_counter() - started,
+    }
+
+
+def format_summary(result: dict) -> str:
+    """
+    Formats the result of an import for the reply.
+    """
+    lines = [f"Imported {result['inserted']} expenses, rejected {result['rejected']} rows "
+             f"in {result['seconds']:.2f} s"]
+    for line_num, reason in result['errors']:
+        lines.append(f"  line {line_num}: {reason}")
+    if result.get('error'):
+        lines.append(f"Import stopped, {result['error']}")
+    return '\n'.join(lines)
@@ -0,0 +1,126 @@
+"""
+This module lists the expenses of a period one page at a time.
+
+The pages are read with keyset queries: the newest expenses come first, ordered by (date, id), and a page
+starts right after the (date, id) of the last expense shown, so every page is one lookup in the
+(chat_id, date) index however far the listing goes. The period total and the running total of the
+expenses listed so far come from the daily rollup. The page buttons carry the period and the cursor
+in their callback data.
+"""
+import os
+import re
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from M_bot import db
+
+LISTING_PAGE_SIZE = int(os.getenv('LISTING_PAGE_SIZE', '20'))
+
+# Directions of a page from its cursor: older expenses or newer ones
+OLDER = 'o'
+NEWER = 'n'
+
+CALLBACK_PREFIX = 'list'
+CALLBACK_PATTERN = re.compile(rf'^{CALLBACK_PREFIX}:(\d{{4}}-\d\d-\d\d):(\d{{4}}-\d\d-\d\d):([{OLDER}{NEWER}]):'
+                              r'(\d{4}-\d\d-\d\d):(\d+)$')
+
+# rows are (id, date, name, category, shared, amount), newest first
+Page = namedtuple('Page', ['rows', 'newer', 'older', 'running', 'total', 'count'])
+
+
+def _select_rows(conn, chat_id: int, start: str, end: str, direction: str, cursor: tuple, limit: int) -> list:
+    sql = "SELECT id, date, name, category, shared, amount FROM expenses WHERE chat_id = ? AND date >= ? AND date < ?"
+    params = [chat_id, start, end]
+    if cursor:
+        sql += " AND (date, id) < (?, ?)" if direction == OLDER else " AND (date, id) > (?, ?)"
+        params += cursor
+    sql += " ORDER BY date DESC, id DESC LIMIT ?" if direction == OLDER else " ORDER BY date, id LIMIT ?"
+    rows = conn.execute(sql, (*params, limit)).fetchall()
+    return rows if direction == OLDER else rows[::-1]
+
+
+def fetch_page(chat_id: int, start: str, end: str, direction: str = OLDER, cursor: tuple = None,
+               size: int = None) -> Page:
+    """
+    Returns the page of the chat's expenses of the [start, end) date range following the (date, id) cursor
+    in the direction, the first page when there is no cursor.
+    """
+    size = size or LISTING_PAGE_SIZE
+    conn = db.get_connection()
+    # One more row tells whether there is another page in that direction
+    rows = _select_rows(conn, chat_id, start, end, direction, cursor, size + 1)
+    if direction == OLDER:
+        newer, older, rows = cursor is not None, len(rows) > size, rows[:size]
+    elif len(rows) > size:
+        newer, older, rows = True, True, rows[-size:]
+    else:
+        # Back at the newest expenses, show a full first page
+        rows = _select_rows(conn, chat_id, start, end, OLDER, None, size + 1)
+        newer, older, rows = False, len(rows) > size, rows[:size]
+
+    total, count = conn.execute("SELECT COALESCE(SUM(total), 0), COALESCE(SUM(count), 0) FROM daily_totals "
+                                "WHERE chat_id = ? AND day >= ? AND day < ?", (chat_id, start, end)).fetchone()
+    running = 0
+    if rows:
+        # The days after the last listed one from the rollup, plus that day's expenses listed so far
+        last_id, last_date = rows[-1][:2]
+        running = conn.execute(
+            "SELECT (SELECT COALESCE(SUM(total), 0) FROM daily_totals WHERE chat_id = ? AND day > ? AND day < ?)"
+            " + (SELECT COALESCE(SUM(amount), 0) FROM expenses WHERE chat_id = ? AND date = ? AND id >= ?)",
+            (chat_id, last_date, end, chat_id, last_date, last_id)).fetchone()[0]
+    return Page(rows, newer, older, running, total, count)
+
+
+def _user_date(value: str) -> str:
+    return datetime.strptime(value, db.DATE_FORMAT).strftime(db.USER_DATE_FORMAT)
+
+
+def _amount(value: float) -> str:
+    return f"{value:.2f}"
+
+
+def format_page(page: Page, start: str, end: str) -> str:
+    """
+    Formats a page of expenses with the running and the period totals.
+    """
+    last_day = (datetime.strptime(end, db.DATE_FORMAT) - timedelta(days=1)).strftime(db.DATE_FORMAT)
+    period = _user_date(start) if start == last_day else f"{_user_date(start)} - {_user_date(last_day)}"
+    lines = [f"Expenses {period}"]
+    for _, expense_date, name, category, shared, amount in page.rows:
+        shared = ", shared" if shared else ""
+        lines.append(f"{_user_date(expense_date)} {name} ({category}{shared}): {_amount(amount)}")
+    lines.append(f"Running total {_amount(page.running)} of {_amount(page.total)} ({page.count} expenses)")
+    return '\n'.join(lines)
+
+
+def callback_data(start: str, end: str, direction: str, row: tuple) -> str:
+    """
+    Returns the callback data of the button opening the page after the row in the direction.
+    """
+    return f"{CALLBACK_PREFIX}:{start}:{end}:{direction}:{row[1]}:{row[0]}"
+
+
+def parse_callback(data: str) -> tuple[str, str, str, tuple]:
+    """
+    Returns the start, end, direction and cursor of a page button.
+    Raises ValueError for data not made by callback_data.
+    """
+    match = CALLBACK_PATTERN.match(data or '')
+    if match is None:
+        raise ValueError(f"Invalid listing callback {data}")
+    start, end, direction, cursor_date, cursor_id = match.groups()
+    return start, end, direction, (cursor_date, int(cursor_id))
+
+
+def keyboard(page: Page, start: str, end: str):
+    """
+    Returns the buttons to the newer and older pages, None when everything fits in the page.
+    """
+    buttons = []
+    if page.newer:
+        buttons.append(InlineKeyboardButton("« Newer", callback_data=callback_data(start, end, NEWER, page.rows[0])))
+    if page.older:
+        buttons.append(InlineKeyboardButton("Older »", callback_data=callback_data(start, end, OLDER, page.rows[-1])))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
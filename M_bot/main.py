@@ -1,19 +1,25 @@
 """
 This module contains the main functionality of the application.
 """
+import asyncio
+import math
 import os
 import sqlite3
-from datetime import date
+import tempfile
+from datetime import MAXYEAR, MINYEAR
 from typing import Final
 
 from dotenv import load_dotenv
 from telegram import Update, InputFile
-from telegram.ext import Application, CommandHandler, MessageHandler, filters
+from telegram.ext import Application, CallbackQueryHandler, CommandHandler, MessageHandler, TypeHandler, filters
 
-from M_bot.stats import generate_monthly_reports, generate_yearly_reports
+from M_bot import (budgets, concurrency, db, exporter, importer, listing, maintenance, metrics, parser, prerender,
+                   report_cache, report_pool, search, startup, webhook)
 
 load_dotenv()
 TOKEN = os.getenv('TOKEN')
+# Telegram user ids allowed to use the admin commands, separated by commas
+ADMIN_IDS = {int(user_id) for user_id in os.getenv('ADMIN_IDS', '').split(',') if user_id.strip()}
 
 BOT_USERNAME: Final = '@multi_milosz_bot'
 
@@ -42,6 +48,14 @@ async def help_command(update: Update, _):
     - /monthly_expenses [month] [year]: Shows this month's expenses
     - /old_expense (patter like expense with date at the end): Adds an old expense
     - /expense_help: Shows help for the expense command
+    - /export [from] [to] [csv|jsonl]: Exports the expenses between two dates
+    - /import: Imports expenses from a CSV file (name, category, shared, amount, date)
+    - /budget [category amount]: Sets the monthly budget of a category or shows the budgets
+    - /search terms [from] [to]: Finds the expenses by name or category, words can be cut short
+    - /cache_stats: Shows the report cache statistics
+    - /bot_stats: Shows the command latencies and the slowest queries (admins only)
+    - /db_health: Shows the database size, free pages and row counts (admins only)
+    - /maintenance: Archives the closed years and vacuums the database (admins only)
     """
     await update.message.reply_text(help_text)
 
@@ -49,7 +63,8 @@ async def expense_help(update: Update, _):
     """
     Handles the expense command.
     """
-    await update.message.reply_text("Pattern for expenses - [command category name shared amount]\n"
+    await update.message.reply_text("Pattern for expenses - [command category name shared amount [dd.mm.yyyy]]\n"
+                                    "-Several expenses can be sent at once, one per line\n"
                                     "-Available categories:\n"
                                     "   food, cosmetics, hc-housecleaning, eo-eating out, cravings, alcohol\n"
                                     "-Shared:\n"
@@ -58,189 +73,368 @@ async def expense_help(update: Update, _):
                                     "monthly_report, yearly_report\n")
 
 
-def add_expense(name: str, category: str, shared: str, amount: float):
+def get_today_expenses(chat_id: int) -> list:
     """
-    Adds a new expense.
+    Returns today's expenses of the chat.
     """
-    if amount <= 0:
-        return "Amount must be greater than 0"
-    category_mapping = {
-        "food": "food",
-        "cosmetics": "cosmetics",
-        "hc": "house cleaning",
-        "eo": "eating out",
-        "cravings": "cravings",
-        "alcohol": "alcohol"
-    }
-    category = category_mapping.get(category, category)
-    try:
-        c.execute("INSERT INTO expenses (name, category, shared, amount, date) VALUES (?, ?, ?, ?, ?)",
-                  (name, category, shared, amount, date.today().strftime('%d.%m.%Y')))
-        if shared.lower() == "yes":
-            c.execute("INSERT INTO shared_expenses (name, category, shared, amount, date) VALUES (?, ?, ?, ?, ?)",
-                      (name, category, shared, amount, date.today().strftime('%d.%m.%Y')))
-        conn.commit()
-    except sqlite3.Error as e:
-        print(f"Database error occurred: {e}")
-        return "Something went wrong with adding new expense"
+    return db.get_connection().execute(f"SELECT name, category, {db.SHARED_AS_TEXT}, amount, date FROM expenses "
+                                       "WHERE chat_id = ? AND date = ?", (chat_id, db.today())).fetchall()
 
 
-def add_old_expense(name: str, category: str, shared: str, amount: float, expense_date: str):
+def remove_last_expense(chat_id: int):
     """
-    Adds an old expense.
+    Removes the last added expense of the chat.
     """
-    category_mapping = {
-        "food": "food",
-        "cosmetics": "cosmetics",
-        "hc": "house cleaning",
-        "eo": "eating out",
-        "cravings": "cravings",
-        "alcohol": "alcohol"
-    }
-    category = category_mapping.get(category, category)
     try:
-        c.execute("INSERT INTO expenses (name, category, shared, amount, date) VALUES (?, ?, ?, ?, ?)",
-                  (name, category, shared, amount, expense_date))
-        if shared.lower() == "yes":
-            c.execute("INSERT INTO shared_expenses (name, category, shared, amount, date) VALUES (?, ?, ?, ?, ?)",
-                      (name, category, shared, amount, expense_date))
-        conn.commit()
+        with db.transaction() as conn:
+            deleted = conn.execute("DELETE FROM expenses WHERE id = "
+                                   "(SELECT MAX(id) FROM expenses WHERE chat_id = ?) "
+                                   "RETURNING date, category, amount, shared", (chat_id,)).fetchone()
+            if deleted:
+                expense_date, category, amount, shared = deleted
+                db.after_commit(report_cache.bump_version, chat_id, expense_date)
+                db.after_commit(budgets.record, chat_id, expense_date, category, -amount, shared)
     except sqlite3.Error as e:
         print(f"Database error occurred: {e}")
-        return "Something went wrong with adding new expense"
+        return "Something went wrong with deleting the last expense"
+    return "The last expense has been deleted"
 
 
-def generate_weekly_expenses() -> str:
+async def delete_last_expense(update: Update, _):
     """
-    Generates weekly expenses.
+    Deletes the last expense.
     """
-    with conn:
-        c.execute("""
-            SELECT * FROM expenses
-            WHERE date BETWEEN strftime('%d.%m.%Y', date('now', 'weekday 0', '-7 days')) AND strftime('%d.%m.%Y', date('now'))
-        """)
-        rows = c.fetchall()
-        if not rows:
-            return "No expenses this week"
-        else:
-            with open('weekly_expenses.txt', 'w', encoding='utf-8') as f:
-                for row in rows:
-                    f.write(str(row) + '\n')
-            return 'weekly_expenses.txt'
+    return await update.message.reply_text(await db.write(remove_last_expense, update.effective_chat.id))
 
 
-def generate_monthly_expenses() -> str:
+async def send_file(update: Update, _, document, filename: str):
     """
-    Generates monthly expenses.
+    Sends bytes or a file object as a document to the Telegram chat.
     """
-    with conn:
-        c.execute("""
-                    SELECT * FROM expenses
-                    WHERE date BETWEEN strftime('%d.%m.%Y', date('now', 'start of month')) AND strftime('%d.%m.%Y', date('now'))
-                """)
-        rows = c.fetchall()
-        if not rows:
-            return "No expenses this month"
-        else:
-            with open('monthly_expenses.txt', 'w', encoding='utf-8') as f:
-                for row in rows:
-                    f.write(str(row) + '\n')
-            return 'monthly_expenses.txt'
+    # InputFile reads file objects whole anyway and fails on the spooled ones, which have no name.
+    # A file shared by coalesced requests is read from its start by each of them
+    if hasattr(document, 'read'):
+        document.seek(0)
+        document = document.read()
+    await _.bot.send_document(chat_id=update.message.chat_id, document=InputFile(document, filename=filename))
 
 
-async def delete_last_expense(update: Update, _):
+async def render_report(chat_id: int, period: str, report_type: str, version: int, *args) -> bytes:
     """
-    Deletes the last expense.
+    Renders a report in the worker pool holding a heavy slot of the chat and caches it.
+    The waits for the slot count against the report queue, so a busy pool rejects the request.
     """
-    try:
-        c.execute("DELETE FROM expenses WHERE rowid = (SELECT MAX(rowid) FROM expenses)")
-        conn.commit()
-    except sqlite3.Error as e:
-        print(f"Database error occurred: {e}")
-        return await update.message.reply_text("Something went wrong with deleting the last expense")
-    return await update.message.reply_text("The last expense has been deleted")
+    report = await report_pool.render(report_type, chat_id, *args, limit=concurrency.heavy(chat_id))
+    report_cache.put(chat_id, period, report_type, version, report)
+    return report
+
+
+async def get_report(update: Update, period: str, report_type: str, *args):
+    """
+    Returns the report of the chat from the cache or renders it in the worker pool,
+    identical requests rendering at the same time share one rendering.
+    Returns None and tells the user to retry when the pool is busy.
+    """
+    chat_id = update.effective_chat.id
+    version, report = report_cache.get(chat_id, period, report_type)
+    if report is None:
+        try:
+            report = await concurrency.coalesce(('report', chat_id, period, report_type, version), render_report,
+                                                chat_id, period, report_type, version, *args)
+        except report_pool.QueueFull:
+            await update.message.reply_text("Too many reports are being generated right now, please try again later")
+            return None
+    return report
+
+
+async def cache_stats_command(update: Update, _):
+    """
+    Shows the report cache statistics.
+    """
+    info = report_cache.cache_info()
+    await update.message.reply_text(f"Report cache: {info.hits} hits, {info.misses} misses, "
+                                    f"{info.currsize}/{info.maxsize} reports")
+
+
+def is_admin(update: Update) -> bool:
+    """
+    Returns whether the update comes from one of the bot admins.
+    """
+    return update.effective_user is not None and update.effective_user.id in ADMIN_IDS
+
+
+async def bot_stats_command(update: Update, _):
+    """
+    Shows the handler latencies, the report phases and the slowest SQL statements to the admins.
+    """
+    if not is_admin(update):
+        return await update.message.reply_text("This command is only available to the bot admins")
+    await update.message.reply_text(metrics.summary())
+
+
+async def db_health_command(update: Update, _):
+    """
+    Shows the database size, free pages, row counts and archives to the admins.
+    """
+    if not is_admin(update):
+        return await update.message.reply_text("This command is only available to the bot admins")
+    await update.message.reply_text(maintenance.format_health(await db.read(maintenance.health)))
 
 
-async def send_file(update: Update, _, filename: str):
+async def maintenance_command(update: Update, _):
     """
-    Sends a file to the Telegram chat.
+    Runs the database maintenance for the admins.
     """
-    # Send the file to the Telegram chat
-    with open(filename, 'rb') as f:
-        await _.bot.send_document(chat_id=update.message.chat_id, document=InputFile(f))
+    if not is_admin(update):
+        return await update.message.reply_text("This command is only available to the bot admins")
+    try:
+        result = await maintenance.run_maintenance()
+    except sqlite3.Error as e:
+        print(f"Database maintenance failed: {e}")
+        return await update.message.reply_text("Something went wrong with the database maintenance")
+    await update.message.reply_text(maintenance.format_result(result))
+
 
-    os.remove(filename)
+def valid_year(year: int) -> bool:
+    # The reports cover the [year, year + 1) range, so the next year must be a valid date too
+    return MINYEAR <= year < MAXYEAR
 
 
 async def monthly_report_command(update: Update, _):
+    usage = "Please provide a month and a year in the format 'monthly_report month year'"
     processed: str = update.message.text.lower()
     parts = processed.split()
     if len(parts) != 3:
-        return await update.message.reply_text(
-            "Please provide a month and a year in the format 'monthly_report month year'")
+        return await update.message.reply_text(usage)
     try:
         month = int(parts[1])
         year = int(parts[2])
     except ValueError:
         return await update.message.reply_text("Month and year should be numbers")
-    generate_monthly_reports(month, year)
-    return await send_file(update, _, 'monthly_reports.docx') or "File sent successfully"
+    if not 1 <= month <= 12 or not valid_year(year):
+        return await update.message.reply_text(usage)
+    report = await get_report(update, f"{year:04d}-{month:02d}", 'monthly', month, year)
+    if report is None:
+        return
+    return await send_file(update, _, report, 'monthly_reports.docx') or "File sent successfully"
 
 
 async def yearly_report_command(update: Update, _):
+    usage = "Please provide a year in the format 'yearly_report year'"
     processed: str = update.message.text.lower()
-    year = processed.split()[1]
-    generate_yearly_reports(year)
-    return await send_file(update, _, '../yearly_reports.docx') or "File sent successfully"
+    parts = processed.split()
+    if len(parts) != 2:
+        return await update.message.reply_text(usage)
+    try:
+        year = int(parts[1])
+    except ValueError:
+        return await update.message.reply_text("The year should be a number")
+    if not valid_year(year):
+        return await update.message.reply_text(usage)
+    report = await get_report(update, f"{year:04d}", 'yearly', year)
+    if report is None:
+        return
+    return await send_file(update, _, report, 'yearly_reports.docx') or "File sent successfully"
+
+
+async def send_listing(update: Update, start: str, end: str, empty_text: str):
+    """
+    Replies with the first page of the chat's expenses of the [start, end) date range.
+    """
+    page = await db.read(listing.fetch_page, update.effective_chat.id, start, end)
+    if not page.rows:
+        return await update.message.reply_text(empty_text)
+    return await update.message.reply_text(listing.format_page(page, start, end),
+                                            reply_markup=listing.keyboard(page, start, end))
+
+
+async def listing_page_callback(update: Update, _):
+    """
+    Shows the page of a listing chosen with its buttons in place of the current one.
+    """
+    query = update.callback_query
+    try:
+        start, end, direction, cursor = listing.parse_callback(query.data)
+    except ValueError:
+        return await query.answer("This listing is no longer available")
+    page = await db.read(listing.fetch_page, update.effective_chat.id, start, end, direction, cursor)
+    await query.answer()
+    if not page.rows:
+        return await query.edit_message_text("No expenses in this period")
+    return await query.edit_message_text(listing.format_page(page, start, end),
+                                         reply_markup=listing.keyboard(page, start, end))
 
 
 async def today_expenses_command(update: Update, _):
-    with conn:
-        c.execute("SELECT * FROM expenses WHERE date = ?", (date.today().strftime('%d.%m.%Y'),))
-        rows = c.fetchall()
-        if not rows:
-            return await update.message.reply_text("No expenses today")
-        else:
-            return await update.message.reply_text('\n'.join(map(str, rows)))
+    return await send_listing(update, db.today(), db.next_day(db.today()), "No expenses today")
+
+
+async def run_export(chat_id: int, start: str, end: str, export_format: str, name: str):
+    """
+    Exports the chat's expenses holding a heavy slot of the chat.
+    """
+    async with concurrency.heavy(chat_id):
+        return await db.read(exporter.export_expenses, chat_id, start, end, export_format, name)
+
+
+async def send_export(update: Update, _, start: str, end: str, export_format: str, name: str, empty_text: str):
+    """
+    Exports the chat's expenses of the [start, end) date range and sends them as a document,
+    identical exports running at the same time share one export.
+    The export stays in its spooled file until it is sent, the ones too big for Telegram are never read.
+    """
+    chat_id = update.effective_chat.id
+    file, filename, count = await concurrency.coalesce(('export', chat_id, start, end, export_format, name),
+                                                       run_export, chat_id, start, end, export_format, name)
+    if not count:
+        return await update.message.reply_text(empty_text)
+    if exporter.file_size(file) > exporter.EXPORT_MAX_SIZE:
+        max_size = exporter.EXPORT_MAX_SIZE / 1024 / 1024
+        return await update.message.reply_text(f"The export is bigger than {max_size:.0f} MB, "
+                                               "please export a shorter period")
+    return await send_file(update, _, file, filename) or "File sent successfully"
 
 
 async def weekly_expenses_command(update: Update, _):
-    filename = generate_weekly_expenses()
-    if filename == "No expenses this week":
-        return await update.message.reply_text(filename)
-    else:
-        return await send_file(update, _, filename) or "File sent successfully"
+    return await send_listing(update, *db.week_range(), "No expenses this week")
 
 
 async def monthly_expenses_command(update: Update, _):
-    filename = generate_monthly_expenses()
-    if filename == "No expenses this month":
-        return await update.message.reply_text(filename)
-    else:
-        return await send_file(update, _, filename) or "File sent successfully"
+    return await send_listing(update, *db.month_to_date_range(), "No expenses this month")
 
 
-async def old_expense_command(update: Update, _):
-    processed: str = update.message.text.lower()
+async def export_command(update: Update, _):
+    """
+    Exports the expenses between two dd.mm.yyyy dates (this month by default) as csv or jsonl.
+    """
+    parts = update.message.text.lower().split()[1:]
+    export_format = 'csv'
+    if parts and parts[-1] in exporter.EXPORT_FORMATS:
+        export_format = parts.pop()
+    if len(parts) > 2:
+        return await update.message.reply_text("Please use the format 'export [from] [to] [csv|jsonl]'")
+    start, end = db.month_to_date_range()
+    try:
+        if len(parts) >= 1:
+            start = db.parse_user_date(parts[0])
+        if len(parts) == 2:
+            end = db.next_day(db.parse_user_date(parts[1]))
+    except ValueError:
+        return await update.message.reply_text("Invalid date. Please enter a valid date in the format dd.mm.yyyy.")
+    return await send_export(update, _, start, end, export_format, 'expenses', "No expenses in this period")
+
+
+def add_expenses(expenses: list, chat_id: int, alerts: list = None):
+    """
+    Adds parsed expenses to the ledger of the chat in one transaction, the budget alerts they raise are appended
+    to alerts.
+    """
     try:
-        name = processed.split()[2:-3]
-        name = ' '.join([str(elem) for elem in name])
-        expense_date = processed.split()[-1]
-        add_old_expense(name, processed.split()[1], processed.split()[-3], int(processed.split()[-2]), expense_date)
-    except Exception as e:
-        return await update.message.reply_text("Something went wrong with adding your old expense")
-    return await update.message.reply_text("Your old expense has been added")
+        with db.transaction() as conn:
+            conn.executemany("INSERT INTO expenses (name, category, shared, amount, date, chat_id) "
+                             "VALUES (?, ?, ?, ?, ?, ?)", [expense + (chat_id,) for expense in expenses])
+            for month in {expense.date[:7] for expense in expenses}:
+                db.after_commit(report_cache.bump_version, chat_id, f"{month}-01")
+            for expense in expenses:
+                db.after_commit(budgets.record, chat_id, expense.date, expense.category, expense.amount,
+                                expense.shared, alerts)
+    except sqlite3.Error as e:
+        print(f"Database error occurred: {e}")
+        return False
+    return True
+
+
+async def add_expenses_command(update: Update, default_date: str, added_text: str):
+    """
+    Adds the expenses of a message, one per line, and replies with the result of every line.
+    """
+    results = parser.parse_message(update.message.text, default_date)
+    if not results:
+        return await update.message.reply_text(f"Please send the expenses as '{parser.USAGE}', one per line")
+    expenses = [result.expense for result in results if result.expense]
+    # Filled once the expenses are committed, before the write returns
+    alerts = []
+    if expenses and not await db.write(add_expenses, expenses, update.effective_chat.id, alerts):
+        return await update.message.reply_text("Something went wrong with adding your expenses")
+    text = added_text if len(results) == 1 and expenses else parser.format_results(results)
+    return await update.message.reply_text('\n'.join([text] + alerts))
+
+
+async def old_expense_command(update: Update, _):
+    # Every line needs its date
+    return await add_expenses_command(update, None, "Your old expense has been added")
 
 
 async def expense_command(update: Update, _):
-    processed: str = update.message.text.lower()
+    # Lines without a date are today's expenses
+    return await add_expenses_command(update, db.today(), "Your expense has been added")
+
+
+async def budget_command(update: Update, _):
+    """
+    Sets the monthly budget of a category ('budget category amount', 0 removes it) or shows the budgets.
+    """
+    chat_id = update.effective_chat.id
+    parts = update.message.text.lower().split()[1:]
+    if not parts:
+        return await update.message.reply_text(budgets.format_budgets(await db.read(budgets.get_budgets, chat_id)))
+    try:
+        if len(parts) != 2:
+            raise ValueError
+        category, amount = db.normalize_category(parts[0]), float(parts[1].replace(',', '.'))
+        if amount < 0 or not math.isfinite(amount):
+            raise ValueError
+    except ValueError:
+        return await update.message.reply_text("Please use the format 'budget category amount', 0 removes the budget")
+    try:
+        await db.write(budgets.set_budget, chat_id, category, amount)
+    except sqlite3.Error as e:
+        print(f"Database error occurred: {e}")
+        return await update.message.reply_text("Something went wrong with setting the budget")
+    if not amount:
+        return await update.message.reply_text(f"The {category} budget has been removed")
+    return await update.message.reply_text(budgets.format_budgets(await db.read(budgets.get_budgets, chat_id)))
+
+
+async def search_command(update: Update, _):
+    """
+    Searches the expenses by name and category, between two optional dd.mm.yyyy dates.
+    """
+    parts = update.message.text.split()[1:]
+    dates = []
+    while parts and len(dates) < 2 and parser.DATE_PATTERN.fullmatch(parts[-1]):
+        dates.insert(0, parts.pop())
+    if not parts:
+        return await update.message.reply_text("Please use the format 'search terms [from] [to]'")
+    try:
+        start = db.parse_user_date(dates[0]) if dates else None
+        end = db.next_day(db.parse_user_date(dates[1])) if len(dates) == 2 else None
+    except ValueError:
+        return await update.message.reply_text("Invalid date. Please enter a valid date in the format dd.mm.yyyy.")
+    terms = ' '.join(parts)
     try:
-        name = processed.split()[2:-2]
-        name = ' '.join([str(elem) for elem in name])
-        add_expense(name, processed.split()[1], processed.split()[-2], int(processed.split()[-1]))
-    except:
-        return await update.message.reply_text("Something went wrong with adding your expense")
-    return await update.message.reply_text("Your expense has been added")
+        result = await db.read(search.search, update.effective_chat.id, terms, start, end)
+    except ValueError:
+        return await update.message.reply_text("Please search for words or their beginnings")
+    return await update.message.reply_text(search.format_result(result, terms))
+
+
+async def import_command(update: Update, _):
+    """
+    Imports expenses from a CSV document sent with the /import caption or replied to with /import.
+    """
+    message = update.message
+    document = message.document or (message.reply_to_message and message.reply_to_message.document)
+    if document is None:
+        return await message.reply_text("Send a CSV file with the caption /import or reply to one with /import.\n"
+                                        "Columns: name, category, shared, amount, date (dd.mm.yyyy)")
+    file = await document.get_file()
+    # Small files stay in memory, big ones are spooled to a private temporary file
+    with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as buffer:
+        await file.download_to_memory(buffer)
+        buffer.seek(0)
+        result = await importer.import_csv(buffer, update.effective_chat.id)
+    return await message.reply_text(importer.format_summary(result))
 
 
 async def error(update: Update, _):
@@ -262,46 +456,87 @@ async def handle_message(update: Update, _):
         await update.message.reply_text("I don't understand your command.")
 
 
+async def track_first_update(update: Update, _):
+    """
+    Records when the first update is handled.
+    """
+    if 'first_update' not in startup.timings():
+        startup.mark('first_update')
+        print(startup.summary())
+
+
+async def on_startup(_):
+    """
+    Starts the database access layer, loads the budgets, starts the metrics endpoint and pre-warms the report
+    workers in the background.
+    """
+    db.start()
+    await db.read(budgets.load)
+    report_pool.prewarm()
+    await metrics.start_server()
+    startup.mark('ready')
+    print(startup.summary())
+
+
+async def on_shutdown(_):
+    """
+    Stops the database access layer, the report workers and the metrics endpoint.
+    """
+    await metrics.stop_server()
+    await db.stop()
+    report_pool.shutdown()
+
+
 if __name__ == "__main__":
-    if not os.path.exists('data'):
-        os.makedirs('data')
-    conn = sqlite3.connect('data/expenses.db')
-    c = conn.cursor()
-    c.execute("""CREATE TABLE IF NOT EXISTS expenses (
-               name text,
-               category text,
-               shared text,
-               amount integer,
-               date text)""")
-    c.execute("""CREATE TABLE IF NOT EXISTS shared_expenses (
-                    name text,
-                    category text,
-                    shared text,
-                    amount integer,
-                    date text)""")
-    conn.commit()
+    startup.mark('imported')
+    # Apply the migrations before any update is handled
+    db.get_connection()
     print("Starting bot...")
-    app = Application.builder().token(TOKEN).build()
+    app = (Application.builder().token(TOKEN).concurrent_updates(True)
+           .update_queue(asyncio.Queue(maxsize=webhook.UPDATE_QUEUE_SIZE))
+           .post_init(on_startup).post_shutdown(on_shutdown).build())
+
+    app.add_handler(TypeHandler(Update, metrics.instrument(track_first_update)), group=-1)
 
     # Commands
-    app.add_handler(CommandHandler('start', start_command))
-    app.add_handler(CommandHandler('help', help_command))
-    app.add_handler(CommandHandler('expense', expense_command))
-    app.add_handler(CommandHandler('delete_last_expense', delete_last_expense))
-    app.add_handler(CommandHandler('monthly_report', monthly_report_command))
-    app.add_handler(CommandHandler('yearly_report', yearly_report_command))
-    app.add_handler(CommandHandler('today_expenses', today_expenses_command))
-    app.add_handler(CommandHandler('weekly_expenses', weekly_expenses_command))
-    app.add_handler(CommandHandler('monthly_expenses', monthly_expenses_command))
-    app.add_handler(CommandHandler('old_expense', old_expense_command))
-    app.add_handler(CommandHandler('expense_help', expense_help))
-
-    app.add_handler(MessageHandler(filters.TEXT, handle_message))
+    app.add_handler(CommandHandler('start', metrics.instrument(start_command)))
+    app.add_handler(CommandHandler('help', metrics.instrument(help_command)))
+    app.add_handler(CommandHandler('expense', metrics.instrument(expense_command)))
+    app.add_handler(CommandHandler('delete_last_expense', metrics.instrument(delete_last_expense)))
+    app.add_handler(CommandHandler('monthly_report', metrics.instrument(monthly_report_command)))
+    app.add_handler(CommandHandler('yearly_report', metrics.instrument(yearly_report_command)))
+    app.add_handler(CommandHandler('today_expenses', metrics.instrument(today_expenses_command)))
+    app.add_handler(CommandHandler('weekly_expenses', metrics.instrument(weekly_expenses_command)))
+    app.add_handler(CommandHandler('monthly_expenses', metrics.instrument(monthly_expenses_command)))
+    app.add_handler(CommandHandler('old_expense', metrics.instrument(old_expense_command)))
+    app.add_handler(CommandHandler('expense_help', metrics.instrument(expense_help)))
+    app.add_handler(CommandHandler('cache_stats', metrics.instrument(cache_stats_command)))
+    app.add_handler(CommandHandler('bot_stats', metrics.instrument(bot_stats_command)))
+    app.add_handler(CommandHandler('db_health', metrics.instrument(db_health_command)))
+    app.add_handler(CommandHandler('maintenance', metrics.instrument(maintenance_command)))
+    app.add_handler(CommandHandler('import', metrics.instrument(import_command)))
+    app.add_handler(CommandHandler('export', metrics.instrument(export_command)))
+    app.add_handler(CommandHandler('budget', metrics.instrument(budget_command)))
+    app.add_handler(CommandHandler('search', metrics.instrument(search_command)))
+    app.add_handler(MessageHandler(filters.Document.ALL & filters.CaptionRegex(r'^/import'),
+                                   metrics.instrument(import_command)))
+
+    app.add_handler(MessageHandler(filters.TEXT, metrics.instrument(handle_message)))
+
+    # Buttons
+    app.add_handler(CallbackQueryHandler(metrics.instrument(listing_page_callback),
+                                         pattern=f'^{listing.CALLBACK_PREFIX}:'))
 
     # Errors
-    print("Polling...")
     app.add_error_handler(error)
 
-    app.run_polling(poll_interval=3)
+    # Jobs
+    prerender.schedule(app.job_queue)
+    maintenance.schedule(app.job_queue)
 
-    conn.close()
+    if webhook.WEBHOOK_URL:
+        print("Starting webhook...")
+        asyncio.run(webhook.run(app))
+    else:
+        print("Polling...")
+        app.run_polling(poll_interval=3)
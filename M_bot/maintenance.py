@@ -0,0 +1,209 @@
+"""
+This module keeps the hot database small and its statistics fresh.
+
+The maintenance job runs from the application's job queue every day at MAINTENANCE_HOUR (UTC), and on demand
+with the /maintenance admin command. It moves the closed years into their archives, refreshes the query
+planner statistics and gives up to MAINTENANCE_VACUUM_PAGES free pages back to the file system.
+Switching an existing database to incremental vacuum rewrites the whole file while holding the write lock,
+so only the job and the command line do it, never /maintenance.
+/db_health reports the file sizes, the free pages and the row counts.
+
+    python -m M_bot.maintenance [health|run]
+"""
+import asyncio
+import os
+import sqlite3
+import time
+from datetime import date, time as day_time
+
+from telegram.ext import ContextTypes
+
+from M_bot import archive, concurrency, db, metrics
+
+MAINTENANCE_ENABLED = os.getenv('MAINTENANCE_ENABLED', '1') == '1'
+# Hour of the day the job runs at, pick one with little traffic
+MAINTENANCE_HOUR = int(os.getenv('MAINTENANCE_HOUR', '4'))
+# Free pages given back per run, the vacuum holds the write lock while it runs
+MAINTENANCE_VACUUM_PAGES = int(os.getenv('MAINTENANCE_VACUUM_PAGES', '10000'))
+# Rows sampled per index by ANALYZE
+MAINTENANCE_ANALYSIS_LIMIT = int(os.getenv('MAINTENANCE_ANALYSIS_LIMIT', '1000'))
+
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+def connect() -> sqlite3.Connection:
+    """
+    Opens a connection of its own for the maintenance, waiting longer than the bot for the write lock.
+    """
+    conn = db.connect(isolation_level=None, check_same_thread=False, factory=metrics.connection_factory())
+    conn.execute("PRAGMA busy_timeout = 30000")
+    # Applies the pending migrations
+    db.init_db(conn)
+    return conn
+
+
+def _pragma(conn: sqlite3.Connection, name: str):
+    return conn.execute(f"PRAGMA {name}").fetchone()[0]
+
+
+def enable_incremental_vacuum(conn: sqlite3.Connection) -> bool:
+    """
+    Switches a database created without incremental vacuum to it, which rewrites the whole file once.
+    Returns whether it was switched.
+    """
+    if _pragma(conn, 'auto_vacuum') == AUTO_VACUUM_INCREMENTAL:
+        return False
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+    return True
+
+
+def optimize(conn: sqlite3.Connection):
+    """
+    Refreshes the query planner statistics, sampling MAINTENANCE_ANALYSIS_LIMIT rows per index.
+    """
+    conn.execute(f"PRAGMA analysis_limit = {MAINTENANCE_ANALYSIS_LIMIT}")
+    conn.execute("ANALYZE")
+    conn.execute("PRAGMA optimize")
+
+
+def vacuum(conn: sqlite3.Connection, pages: int = None) -> int:
+    """
+    Gives up to pages free pages back to the file system and truncates the write-ahead log.
+    Returns the number of freed pages.
+    """
+    free = _pragma(conn, 'freelist_count')
+    # The pragma frees one page per returned row
+    conn.execute(f"PRAGMA incremental_vacuum({pages or MAINTENANCE_VACUUM_PAGES})").fetchall()
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+    return free - _pragma(conn, 'freelist_count')
+
+
+def _file_size(path: str) -> int:
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def health(conn: sqlite3.Connection = None) -> dict:
+    """
+    Returns the size of the database files, the page usage, the row counts and the archives.
+    """
+    conn = conn or db.get_connection()
+    page_size, page_count, free_pages = (_pragma(conn, name) for name in ('page_size', 'page_count',
+                                                                          'freelist_count'))
+    try:
+        # Unused bytes inside the pages in use, when SQLite is built with the dbstat table
+        unused = conn.execute("SELECT SUM(unused) FROM dbstat").fetchone()[0] or 0
+    except sqlite3.OperationalError:
+        unused = None
+    used_bytes = (page_count - free_pages) * page_size
+    return {
+        'file_bytes': _file_size(db.DB_PATH),
+        'wal_bytes': _file_size(db.DB_PATH + '-wal'),
+        'page_size': page_size,
+        'page_count': page_count,
+        'free_pages': free_pages,
+        'free_ratio': free_pages / page_count if page_count else 0.0,
+        'unused_ratio': unused / used_bytes if unused is not None and used_bytes else None,
+        'incremental_vacuum': _pragma(conn, 'auto_vacuum') == AUTO_VACUUM_INCREMENTAL,
+        'rows': {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                 for table in ('expenses', 'daily_totals', 'monthly_totals')},
+        'archives': [(year, rows, _file_size(archive.archive_path(year)))
+                     for year, rows in conn.execute("SELECT year, rows FROM archived_years ORDER BY year")],
+    }
+
+
+def _megabytes(size: int) -> str:
+    return f"{size / 1024 / 1024:.1f} MB"
+
+
+def format_health(info: dict) -> str:
+    """
+    Formats the database health for /db_health.
+    """
+    lines = [
+        f"Database: {_megabytes(info['file_bytes'])}, WAL {_megabytes(info['wal_bytes'])}",
+        f"Pages: {info['page_count']} of {info['page_size']} bytes, {info['free_pages']} free "
+        f"({info['free_ratio']:.1%})" + ("" if info['incremental_vacuum'] else ", incremental vacuum not enabled"),
+    ]
+    if info['unused_ratio'] is not None:
+        lines.append(f"Unused space in the pages: {info['unused_ratio']:.1%}")
+    lines.append("Rows: " + ", ".join(f"{table} {count}" for table, count in info['rows'].items()))
+    if info['archives']:
+        lines.append("Archives: " + ", ".join(f"{year} ({rows} expenses, {_megabytes(size)})"
+                                              for year, rows, size in info['archives']))
+    return '\n'.join(lines)
+
+
+def run(day: date = None, switch_vacuum: bool = False) -> dict:
+    """
+    Archives the closed years, refreshes the statistics and vacuums the hot database,
+    switching it to incremental vacuum first when switch_vacuum is set.
+    Returns what was done and how long it took.
+    """
+    started = time.perf_counter()
+    conn = connect()
+    try:
+        result = {'archived': archive.archive(conn, day)}
+        result['vacuum_enabled'] = switch_vacuum and enable_incremental_vacuum(conn)
+        result['incremental_vacuum'] = _pragma(conn, 'auto_vacuum') == AUTO_VACUUM_INCREMENTAL
+        optimize(conn)
+        result['freed_pages'] = vacuum(conn)
+    finally:
+        conn.close()
+    result['seconds'] = time.perf_counter() - started
+    return result
+
+
+def format_result(result: dict) -> str:
+    """
+    Formats the result of a maintenance run.
+    """
+    archived = ", ".join(f"{year} ({moved} expenses)" for year, moved in result['archived'].items()) or "nothing"
+    enabled = " after enabling incremental vacuum" if result['vacuum_enabled'] else ""
+    if not result['incremental_vacuum']:
+        enabled = (", incremental vacuum not enabled yet (the daily job or "
+                   "'python -m M_bot.maintenance run' enables it)")
+    return (f"Maintenance done in {result['seconds']:.1f} s: archived {archived}, "
+            f"freed {result['freed_pages']} pages{enabled}")
+
+
+async def run_maintenance(switch_vacuum: bool = False) -> dict:
+    """
+    Runs the maintenance on a thread of its own, a run requested while another one is running waits for it.
+    """
+    return await concurrency.coalesce(('maintenance',), asyncio.to_thread, run, None, switch_vacuum)
+
+
+async def maintenance_job(_: ContextTypes.DEFAULT_TYPE):
+    """
+    Job running the maintenance.
+    """
+    try:
+        print(format_result(await run_maintenance(switch_vacuum=True)))
+    except sqlite3.Error as e:
+        print(f"Database maintenance failed: {e}")
+
+
+def schedule(job_queue):
+    """
+    Schedules the maintenance every day.
+    """
+    if not MAINTENANCE_ENABLED or job_queue is None:
+        return
+    job_queue.run_daily(maintenance_job, day_time(hour=MAINTENANCE_HOUR), name='maintenance')
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="M bot database maintenance")
+    parser.add_argument('command', nargs='?', choices=['health', 'run'], default='health')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        print(format_result(run(switch_vacuum=True)))
+    connection = connect()
+    try:
+        print(format_health(health(connection)))
+    finally:
+        connection.close()
@@ -0,0 +1,350 @@
+"""
+This module collects the metrics of the bot: handler calls, errors and latencies, SQL statement times and rows,
+and the phases of the report rendering.
+
+The metrics are kept in memory and exposed in the Prometheus text format on an optional local HTTP endpoint
+(METRICS_PORT) and summarized by the /bot_stats command. Worker processes send theirs back with drain() and merge().
+"""
+import functools
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from M_bot import httpserver
+
+# Local port of the /metrics endpoint, the endpoint is disabled when it is not set
+METRICS_PORT = os.getenv('METRICS_PORT')
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+# Record the time and rows of every SQL statement
+METRICS_SQL = os.getenv('METRICS_SQL', '1') == '1'
+
+# Upper bounds of the latency histogram buckets in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+METRICS = {
+    'bot_handler_calls_total': ('counter', "Handler invocations"),
+    'bot_handler_errors_total': ('counter', "Handler invocations that raised an exception"),
+    'bot_handler_seconds': ('histogram', "Handler latency"),
+    'bot_sql_seconds': ('histogram', "SQL statement execution time"),
+    'bot_sql_fetch_seconds_total': ('counter', "Time spent fetching the rows of SQL statements"),
+    'bot_sql_rows_total': ('counter', "Rows returned or changed by SQL statements"),
+    'bot_report_seconds': ('histogram', "Report rendering time per phase"),
+    'bot_coalesced_total': ('counter', "Requests answered by an identical computation already running"),
+    'bot_db_write_batches_total': ('counter', "Batches of writes committed by the writer"),
+    'bot_db_writes_total': ('counter', "Writes committed by the writer"),
+    'bot_db_write_batch_seconds': ('histogram', "Time to run and commit a batch of writes"),
+}
+
+# Statements are labelled by their normalized text cut to this length
+STATEMENT_LABEL_SIZE = 120
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_server = None
+
+
+def _key(name: str, labels: dict) -> tuple:
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name: str, value: float = 1, **labels):
+    """
+    Adds the value to a counter.
+    """
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name: str, seconds: float, **labels):
+    """
+    Records a duration in a histogram.
+    """
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+        for index, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram[0][index] += 1
+                break
+        histogram[1] += seconds
+        histogram[2] += 1
+
+
+@contextmanager
+def timer(name: str, **labels):
+    """
+    Records the duration of the block in a histogram.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+
+def instrument(handler):
+    """
+    Wraps a handler to count its calls and errors and record its latency.
+    """
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        inc('bot_handler_calls_total', handler=name)
+        started = time.perf_counter()
+        try:
+            return await handler(*args, **kwargs)
+        except Exception:
+            inc('bot_handler_errors_total', handler=name)
+            raise
+        finally:
+            observe('bot_handler_seconds', time.perf_counter() - started, handler=name)
+
+    return wrapper
+
+
+def statement_label(sql: str) -> str:
+    """
+    Returns the label of a SQL statement: its text on one line, cut to STATEMENT_LABEL_SIZE.
+    """
+    return ' '.join(sql.split())[:STATEMENT_LABEL_SIZE]
+
+
+class TracedCursor(sqlite3.Cursor):
+    """
+    Cursor recording the time spent executing and fetching every statement and the rows it returned or changed.
+    """
+    statement = None
+
+    def _executed(self, started: float):
+        observe('bot_sql_seconds', time.perf_counter() - started, statement=self.statement)
+        if self.rowcount > 0:
+            inc('bot_sql_rows_total', self.rowcount, statement=self.statement)
+
+    def _fetched(self, started: float, rows: int):
+        inc('bot_sql_fetch_seconds_total', time.perf_counter() - started, statement=self.statement)
+        if rows:
+            inc('bot_sql_rows_total', rows, statement=self.statement)
+
+    def execute(self, sql, parameters=()):
+        self.statement = statement_label(sql)
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._executed(started)
+
+    def executemany(self, sql, seq_of_parameters):
+        self.statement = statement_label(sql)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._executed(started)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(started, row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._fetched(started, len(rows))
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(started, len(rows))
+        return rows
+
+
+class TracedConnection(sqlite3.Connection):
+    """
+    Connection whose cursors, including the ones of the execute() shortcuts, are TracedCursors.
+    """
+
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def connection_factory():
+    """
+    Returns the connection class to open the database with, TracedConnection when METRICS_SQL is set.
+    """
+    return TracedConnection if METRICS_SQL else sqlite3.Connection
+
+
+def drain() -> tuple[dict, dict]:
+    """
+    Returns the recorded metrics and clears them, to send them from a worker process to the bot.
+    """
+    global _counters, _histograms
+    with _lock:
+        state = _counters, _histograms
+        _counters, _histograms = {}, {}
+    return state
+
+
+def merge(state: tuple[dict, dict]):
+    """
+    Adds metrics returned by drain() in another process.
+    """
+    counters, histograms = state
+    with _lock:
+        for key, value in counters.items():
+            _counters[key] = _counters.get(key, 0) + value
+        for key, (buckets, total, count) in histograms.items():
+            histogram = _histograms.setdefault(key, [[0] * len(BUCKETS), 0.0, 0])
+            histogram[0] = [a + b for a, b in zip(histogram[0], buckets)]
+            histogram[1] += total
+            histogram[2] += count
+
+
+def reset():
+    """
+    Clears every metric.
+    """
+    drain()
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+def _format_bound(bound: float) -> str:
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+
+def render() -> str:
+    """
+    Returns the metrics in the Prometheus text format.
+    """
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: (list(buckets), total, count) for key, (buckets, total, count) in _histograms.items()}
+
+    lines = []
+    for name, (metric_type, description) in METRICS.items():
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        if metric_type == 'counter':
+            for (key_name, labels), value in sorted(counters.items()):
+                if key_name == name:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+            continue
+        for (key_name, labels), (buckets, total, count) in sorted(histograms.items()):
+            if key_name != name:
+                continue
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS, buckets):
+                cumulative += bucket
+                bucket_labels = _format_labels(labels + (('le', _format_bound(bound)),))
+                lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+    return '\n'.join(lines) + '\n'
+
+
+def quantile(buckets: list, q: float) -> float:
+    """
+    Returns the upper bound of the histogram bucket holding the q quantile.
+    """
+    target = q * sum(buckets)
+    cumulative = 0
+    for bound, bucket in zip(BUCKETS, buckets):
+        cumulative += bucket
+        if bucket and cumulative >= target:
+            return bound
+    return 0.0
+
+
+def summary(top: int = 5) -> str:
+    """
+    Formats the handler latencies, the report phases, the writer batches and the slowest SQL statements
+    for /bot_stats.
+    """
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: (list(buckets), total, count) for key, (buckets, total, count) in _histograms.items()}
+
+    def section(name: str, label: str) -> list:
+        # (label value, histogram) of a metric, by total time
+        return sorted(((dict(labels)[label], histogram) for (key_name, labels), histogram in histograms.items()
+                       if key_name == name), key=lambda row: -row[1][1])
+
+    lines = ["Handlers (calls, errors, avg, p50 <=, p99 <=):"]
+    for handler, (buckets, total, count) in section('bot_handler_seconds', 'handler'):
+        errors = counters.get(_key('bot_handler_errors_total', {'handler': handler}), 0)
+        lines.append(f"  {handler}: {count}, {errors}, {total / count * 1000:.1f} ms, "
+                     f"{quantile(buckets, 0.5) * 1000:g} ms, {quantile(buckets, 0.99) * 1000:g} ms")
+
+    reports = section('bot_report_seconds', 'phase')
+    if reports:
+        lines.append("Report phases (count, avg):")
+        for phase, (_, total, count) in reports:
+            lines.append(f"  {phase}: {count}, {total / count * 1000:.1f} ms")
+
+    batches = histograms.get(_key('bot_db_write_batch_seconds', {}))
+    if batches:
+        buckets, total, count = batches
+        writes = counters.get(_key('bot_db_writes_total', {}), 0)
+        lines.append(f"Writer: {count} batches, {writes / count:.1f} writes per batch, commit avg "
+                     f"{total / count * 1000:.1f} ms, p99 <= {quantile(buckets, 0.99) * 1000:g} ms")
+
+    statements = section('bot_sql_seconds', 'statement')[:top]
+    if statements:
+        lines.append(f"Top {len(statements)} SQL statements by time (count, total, rows):")
+        for statement, (_, total, count) in statements:
+            labels = {'statement': statement}
+            total += counters.get(_key('bot_sql_fetch_seconds_total', labels), 0)
+            rows = counters.get(_key('bot_sql_rows_total', labels), 0)
+            lines.append(f"  {statement}: {count}, {total * 1000:.1f} ms, {rows:g}")
+    return '\n'.join(lines)
+
+
+async def start_server(host: str = None, port: int = None):
+    """
+    Starts the /metrics endpoint when a port is configured.
+    """
+    global _server
+    port = port if port is not None else METRICS_PORT
+    if port is None or _server is not None:
+        return
+
+    async def handle(method: str, path: str, headers: dict, body: bytes):
+        if path != '/metrics':
+            return 404, b'Not Found'
+        if method != 'GET':
+            return 405, b'Method Not Allowed'
+        return 200, render().encode(), 'text/plain; version=0.0.4; charset=utf-8'
+
+    _server = await httpserver.serve(host or METRICS_LISTEN, int(port), handle)
+
+
+async def stop_server():
+    """
+    Stops the /metrics endpoint.
+    """
+    global _server
+    if _server is not None:
+        _server.close()
+        await _server.wait_closed()
+        _server = None
@@ -0,0 +1,85 @@
+"""
+This module parses the expenses typed by the users.
+
+A message holds one expense per line: 'category name shared amount [date]', the first line starting with the
+command. Every line is matched once by a compiled pattern, so a receipt can be sent as a single message.
+"""
+import re
+from collections import namedtuple
+
+from M_bot import db
+
+ParsedExpense = namedtuple('ParsedExpense', ['name', 'category', 'shared', 'amount', 'date'])
+# One per line of the message, either expense or error is set
+LineResult = namedtuple('LineResult', ['line', 'expense', 'error'])
+
+SHARED_WORDS = {'yes': True, 'y': True, 'no': False, 'n': False}
+
+COMMAND_PATTERN = re.compile(r'^\s*/\w+(?:@\w+)?')
+# A dd.mm.yyyy date as typed by the users
+DATE_PATTERN = re.compile(r'\d{1,2}\.\d{1,2}\.\d{4}')
+EXPENSE_PATTERN = re.compile(
+    r'^\s*(?P<category>\S+)\s+(?P<name>.+?)\s+(?P<shared>' + '|'.join(SHARED_WORDS) + r')'
+    r'\s+(?P<amount>\d+(?:[.,]\d+)?)(?:\s+(?P<date>' + DATE_PATTERN.pattern + r'))?\s*$',
+    re.IGNORECASE)
+
+USAGE = "category name yes|no amount [dd.mm.yyyy]"
+
+
+def parse_line(line: str, default_date: str = None) -> ParsedExpense:
+    """
+    Parses one expense line, the date defaults to default_date.
+    Raises ValueError with the reason when the line is invalid or has no date and there is no default.
+    """
+    match = EXPENSE_PATTERN.match(line)
+    if match is None:
+        raise ValueError(f"expected '{USAGE}'")
+    amount = float(match['amount'].replace(',', '.'))
+    if amount <= 0:
+        raise ValueError("amount must be greater than 0")
+    if amount.is_integer():
+        amount = int(amount)
+    if match['date']:
+        try:
+            expense_date = db.parse_user_date(match['date'])
+        except ValueError:
+            raise ValueError(f"invalid date {match['date']}") from None
+    elif default_date:
+        expense_date = default_date
+    else:
+        raise ValueError("missing date (dd.mm.yyyy)")
+    return ParsedExpense(match['name'].lower(), db.normalize_category(match['category'].lower()),
+                         SHARED_WORDS[match['shared'].lower()], amount, expense_date)
+
+
+def parse_message(text: str, default_date: str = None) -> list:
+    """
+    Parses every non-empty line of a message, skipping the command at its start.
+    Returns a LineResult per line, numbered from 1.
+    """
+    text = COMMAND_PATTERN.sub('', text, count=1)
+    results = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        try:
+            results.append(LineResult(len(results) + 1, parse_line(line, default_date), None))
+        except ValueError as e:
+            results.append(LineResult(len(results) + 1, None, str(e)))
+    return results
+
+
+def format_results(results: list) -> str:
+    """
+    Formats the result of every line for the reply.
+    """
+    added = sum(result.expense is not None for result in results)
+    lines = [f"Added {added} of {len(results)} expenses"]
+    for result in results:
+        if result.expense:
+            expense = result.expense
+            shared = ", shared" if expense.shared else ""
+            lines.append(f"{result.line}. {expense.name} ({expense.category}{shared}): {expense.amount}")
+        else:
+            lines.append(f"{result.line}. not added: {result.error}")
+    return '\n'.join(lines)
@@ -0,0 +1,111 @@
+"""
+This module pre-renders the reports of the month (and the year) that just closed, so the requests coming
+right after the rollover are served from the report cache.
+
+The job runs from the application's job queue on the first day of every month at PRERENDER_HOUR (UTC),
+renders at most PRERENDER_CONCURRENCY reports at once and waits while the worker pool is busy
+with interactive reports.
+"""
+import asyncio
+import os
+from datetime import date, time, timedelta
+
+from telegram.ext import ContextTypes
+
+from M_bot import concurrency, db, report_cache, report_pool
+
+PRERENDER_ENABLED = os.getenv('PRERENDER_ENABLED', '1') == '1'
+# Hour of the first day of the month the job runs at, pick one with little traffic
+PRERENDER_HOUR = int(os.getenv('PRERENDER_HOUR', '3'))
+PRERENDER_CONCURRENCY = int(os.getenv('PRERENDER_CONCURRENCY', '1'))
+# Most active ledgers pre-rendered, the reports have to fit in the report cache next to the interactive ones
+PRERENDER_MAX_CHATS = int(os.getenv('PRERENDER_MAX_CHATS', str(report_cache.REPORT_CACHE_SIZE // 2)))
+# Seconds to wait before trying again when the worker pool is busy
+PRERENDER_BUSY_WAIT = float(os.getenv('PRERENDER_BUSY_WAIT', '1'))
+
+
+def closed_periods(day: date = None) -> tuple[int, int, bool]:
+    """
+    Returns the month and the year of the month before the day, and whether that month closed the year.
+    """
+    last_month = (day or date.today()).replace(day=1) - timedelta(days=1)
+    return last_month.month, last_month.year, last_month.month == 12
+
+
+def active_chats(month: int, year: int, limit: int) -> list:
+    """
+    Returns up to limit chats having expenses in the month, the ones with the most expenses first.
+    """
+    return [row[0] for row in db.get_connection().execute(
+        "SELECT chat_id FROM monthly_totals WHERE month = ? GROUP BY chat_id ORDER BY SUM(count) DESC LIMIT ?",
+        (f"{year:04d}-{month:02d}", limit))]
+
+
+async def render_when_idle(chat_id: int, period: str, report_type: str, version: int, *args) -> bytes:
+    """
+    Renders a report into the cache, waiting while the worker pool is busy so interactive reports go first.
+    """
+    while True:
+        if report_pool.pending() < report_pool.REPORT_WORKERS:
+            try:
+                report = await report_pool.render(report_type, chat_id, *args)
+                break
+            except report_pool.QueueFull:
+                pass
+        await asyncio.sleep(PRERENDER_BUSY_WAIT)
+    report_cache.put(chat_id, period, report_type, version, report)
+    return report
+
+
+async def prerender_report(chat_id: int, period: str, report_type: str, *args) -> bool:
+    """
+    Renders a report into the cache unless it is already there, returns whether it was rendered.
+    Requests for the report arriving meanwhile wait for this rendering.
+    """
+    version, report = report_cache.peek(chat_id, period, report_type)
+    if report is not None:
+        return False
+    await concurrency.coalesce(('report', chat_id, period, report_type, version), render_when_idle,
+                               chat_id, period, report_type, version, *args)
+    return True
+
+
+async def prerender(month: int, year: int, yearly: bool, limit: int = None) -> int:
+    """
+    Pre-renders the monthly report of the month, and the yearly report of the year when yearly is set,
+    for the most active ledgers of the month, rendering up to limit (PRERENDER_CONCURRENCY) at once.
+    Returns the number of rendered reports.
+    """
+    chats = await db.read(active_chats, month, year, PRERENDER_MAX_CHATS)
+    semaphore = asyncio.Semaphore(limit or PRERENDER_CONCURRENCY)
+
+    async def run(chat_id, period, report_type, *args):
+        async with semaphore:
+            try:
+                return await prerender_report(chat_id, period, report_type, *args)
+            except Exception as e:
+                print(f"Pre-rendering the {report_type} report of chat {chat_id} failed: {e}")
+                return False
+
+    jobs = [run(chat_id, f"{year:04d}-{month:02d}", 'monthly', month, year) for chat_id in chats]
+    if yearly:
+        jobs += [run(chat_id, f"{year:04d}", 'yearly', year) for chat_id in chats]
+    return sum(await asyncio.gather(*jobs))
+
+
+async def prerender_job(_: ContextTypes.DEFAULT_TYPE):
+    """
+    Job pre-rendering the reports of the month that just closed.
+    """
+    month, year, yearly = closed_periods()
+    rendered = await prerender(month, year, yearly)
+    print(f"Pre-rendered {rendered} reports for {month}/{year}")
+
+
+def schedule(job_queue):
+    """
+    Schedules the pre-rendering on the first day of every month.
+    """
+    if not PRERENDER_ENABLED or job_queue is None:
+        return
+    job_queue.run_monthly(prerender_job, when=time(hour=PRERENDER_HOUR), day=1, name='prerender')
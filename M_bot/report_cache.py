@@ -0,0 +1,95 @@
+"""
+This module contains the cache of rendered reports.
+
+Reports are cached by (chat, period, report type, data version). Every write bumps the data version
+of the chat's month and year it touches, so a report is never served from before the data changed.
+"""
+import os
+import threading
+from collections import OrderedDict, namedtuple
+
+REPORT_CACHE_SIZE = int(os.getenv('REPORT_CACHE_SIZE', '32'))
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+_lock = threading.Lock()
+_reports = OrderedDict()
+_versions = {}
+_hits = 0
+_misses = 0
+
+
+def periods_of(expense_date: str) -> tuple[str, str]:
+    """
+    Returns the month ('yyyy-mm') and the year ('yyyy') periods of a stored date.
+    """
+    return expense_date[:7], expense_date[:4]
+
+
+def bump_version(chat_id: int, expense_date: str):
+    """
+    Invalidates the chat's cached reports of the month and the year of the date.
+    """
+    with _lock:
+        for period in periods_of(expense_date):
+            _versions[chat_id, period] = _versions.get((chat_id, period), 0) + 1
+            for key in [key for key in _reports if key[:2] == (chat_id, period)]:
+                del _reports[key]
+
+
+def get(chat_id: int, period: str, report_type: str) -> tuple[int, bytes]:
+    """
+    Returns the current data version of the chat's period and the cached report, or None if it is not cached.
+    """
+    global _hits, _misses
+    with _lock:
+        version = _versions.get((chat_id, period), 0)
+        key = (chat_id, period, report_type, version)
+        if key in _reports:
+            _hits += 1
+            _reports.move_to_end(key)
+            return version, _reports[key]
+        _misses += 1
+        return version, None
+
+
+def peek(chat_id: int, period: str, report_type: str) -> tuple[int, bytes]:
+    """
+    Like get(), without counting a hit or a miss or refreshing the report, for background jobs.
+    """
+    with _lock:
+        version = _versions.get((chat_id, period), 0)
+        return version, _reports.get((chat_id, period, report_type, version))
+
+
+def put(chat_id: int, period: str, report_type: str, version: int, data: bytes):
+    """
+    Caches a report rendered from the given data version, evicting the least recently used ones.
+    """
+    with _lock:
+        # A write happened while the report was rendering, it is already stale
+        if version != _versions.get((chat_id, period), 0):
+            return
+        key = (chat_id, period, report_type, version)
+        _reports[key] = data
+        _reports.move_to_end(key)
+        while len(_reports) > REPORT_CACHE_SIZE:
+            _reports.popitem(last=False)
+
+
+def cache_info() -> CacheInfo:
+    """
+    Returns the hit and miss counts and the size of the cache.
+    """
+    with _lock:
+        return CacheInfo(_hits, _misses, REPORT_CACHE_SIZE, len(_reports))
+
+
+def cache_clear():
+    """
+    Empties the cache and resets the statistics.
+    """
+    global _hits, _misses
+    with _lock:
+        _reports.clear()
+        _hits = _misses = 0
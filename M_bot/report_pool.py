@@ -0,0 +1,112 @@
+"""
+This module renders the reports in a pool of worker processes, so the bot keeps handling updates
+while matplotlib is drawing.
+"""
+import asyncio
+import contextlib
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from M_bot import db, metrics
+
+REPORT_WORKERS = int(os.getenv('REPORT_WORKERS', '2'))
+# Reports waiting or rendering at once, more requests are rejected
+REPORT_QUEUE_SIZE = int(os.getenv('REPORT_QUEUE_SIZE', '8'))
+# Start the workers and load the report modules in the background once the bot is running
+REPORT_PREWARM = os.getenv('REPORT_PREWARM', '1') == '1'
+
+_executor = None
+_pending = 0
+
+
+class QueueFull(Exception):
+    """
+    Raised when too many reports are already waiting for a worker.
+    """
+
+
+def _init_worker(db_path: str):
+    import matplotlib
+    matplotlib.use('Agg')
+    db.DB_PATH = db_path
+
+
+def _warm_up():
+    # Loads the report modules in a worker so the first report does not pay for it
+    from M_bot import stats  # noqa: F401
+
+
+def _render(report_type: str, args: tuple) -> tuple[bytes, tuple]:
+    # Runs in a worker process, the stats module and matplotlib are only imported there.
+    # The metrics recorded while rendering are sent back with the report.
+    from M_bot import stats
+
+    generate = {
+        'monthly': stats.generate_monthly_reports,
+        'yearly': stats.generate_yearly_reports,
+    }[report_type]
+
+    return generate(*args), metrics.drain()
+
+
+def get_executor() -> ProcessPoolExecutor:
+    """
+    Returns the worker pool, starting it on first use.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=REPORT_WORKERS,
+                                        mp_context=multiprocessing.get_context('spawn'),
+                                        initializer=_init_worker, initargs=(db.DB_PATH,))
+    return _executor
+
+
+def prewarm():
+    """
+    Starts every worker and loads matplotlib and python-docx in it without waiting for them.
+    """
+    if not REPORT_PREWARM:
+        return
+    executor = get_executor()
+    for _ in range(REPORT_WORKERS):
+        executor.submit(_warm_up)
+
+
+def pending() -> int:
+    """
+    Returns the number of reports waiting or rendering.
+    """
+    return _pending
+
+
+async def render(report_type: str, *args, limit=None) -> bytes:
+    """
+    Renders a report in the worker pool and returns the document bytes.
+    The report holds limit, an async context manager such as concurrency.heavy(), while it renders
+    and is pending while it waits for it.
+    Raises QueueFull when REPORT_QUEUE_SIZE reports are already pending.
+    """
+    global _pending
+    if _pending >= REPORT_QUEUE_SIZE:
+        raise QueueFull()
+    _pending += 1
+    try:
+        loop = asyncio.get_running_loop()
+        async with limit or contextlib.nullcontext():
+            with metrics.timer('bot_report_seconds', phase='total'):
+                report, worker_metrics = await loop.run_in_executor(get_executor(), _render, report_type, args)
+        metrics.merge(worker_metrics)
+        return report
+    finally:
+        _pending -= 1
+
+
+def shutdown():
+    """
+    Stops the worker processes.
+    """
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(cancel_futures=True)
+        _executor = None
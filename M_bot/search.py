@@ -0,0 +1,96 @@
+"""
+This module searches the expenses by name and category.
+
+The expenses_fts full-text index covers the names and categories of the expenses and a word standing for their
+chat, so a search only reads the chat's matches. The triggers keep it in sync and every term matches the words
+it starts with. The matches of the chat in the date range are counted and summed, and the best SEARCH_LIMIT by
+bm25 rank of the names and categories are listed, the newest ones when more than SEARCH_RANK_LIMIT match.
+The archives of the range have their own index and are searched along with the hot database.
+"""
+import os
+import re
+from collections import namedtuple
+from datetime import datetime
+
+from M_bot import archive, db
+
+SEARCH_LIMIT = int(os.getenv('SEARCH_LIMIT', '20'))
+# Ranking reads every match, searches matching more expenses list the newest ones instead
+SEARCH_RANK_LIMIT = int(os.getenv('SEARCH_RANK_LIMIT', '1000'))
+
+# Whole range searched when no dates are given
+ALL_TIME = ('0001-01-01', '9999-12-31')
+
+# rows are (date, name, category, shared, amount), the best match first
+SearchResult = namedtuple('SearchResult', ['rows', 'count', 'total'])
+
+_WORD = re.compile(r'\w+')
+
+
+def match_query(terms: str) -> str:
+    """
+    Returns the FTS5 query matching the expenses having words starting with every term.
+    Raises ValueError when there are no terms.
+    """
+    words = _WORD.findall(terms.lower())
+    if not words:
+        raise ValueError("Nothing to search for")
+    # Quoted, so no term is read as an FTS5 operator
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def search(chat_id: int, terms: str, start: str = None, end: str = None, limit: int = None) -> SearchResult:
+    """
+    Returns the chat's best limit (SEARCH_LIMIT) expenses of the [start, end) date range matching the terms,
+    with the number and the total amount of all the matching expenses.
+    """
+    # The chat's word first, so the index only returns the chat's matches
+    query = f'chat : "{db.chat_token(chat_id)}" AND {{name category}} : ({match_query(terms)})'
+    conn = db.get_connection()
+    matches = ("FROM {schema}.expenses_fts f JOIN {schema}.expenses e ON e.id = f.rowid "
+               "WHERE f.expenses_fts MATCH ? AND e.chat_id = ? AND e.date >= ? AND e.date < ?")
+    params = (query, chat_id, start or ALL_TIME[0], end or ALL_TIME[1])
+    if start or end:
+        # The ids of the range bound the rows the index returns
+        bounds = "FROM {schema}.expenses WHERE chat_id = ? AND date >= ? AND date < ?"
+        matches += f" AND f.rowid BETWEEN (SELECT MIN(id) {bounds}) AND (SELECT MAX(id) {bounds})"
+        params += params[1:] * 2
+    start, end = params[2:4]
+
+    # The archives are searched a batch at a time, an all-time search may cover more than can be attached at once
+    count, total = 0, 0
+    for sql, union_params in archive.union_batches(conn, "SELECT COUNT(*) AS count, SUM(e.amount) AS total " + matches,
+                                                   params, start, end):
+        batch_count, batch_total = conn.execute(f"SELECT SUM(count), COALESCE(SUM(total), 0) FROM ({sql})",
+                                                union_params).fetchone()
+        count, total = count + batch_count, total + batch_total
+    ranked = count <= SEARCH_RANK_LIMIT
+    # The chat's word is in every match, it does not weigh in the rank
+    rank = "bm25(f.expenses_fts, 0, 1, 1)" if ranked else "0"
+    limit = limit or SEARCH_LIMIT
+    rows = []
+    for sql, union_params in archive.union_batches(conn, "SELECT e.date, e.name, e.category, e.shared, e.amount, "
+                                                   f"{rank} AS rank " + matches, params, start, end):
+        rows += conn.execute(f"SELECT date, name, category, shared, amount, rank FROM ({sql}) "
+                             f"ORDER BY {'rank, date DESC' if ranked else 'date DESC'} LIMIT ?",
+                             (*union_params, limit)).fetchall()
+    # The best rows of every batch in the same order: by rank, then the newest first
+    rows.sort(key=lambda row: row[0], reverse=True)
+    rows.sort(key=lambda row: row[5])
+    return SearchResult([row[:5] for row in rows[:limit]], count, total)
+
+
+def format_result(result: SearchResult, terms: str) -> str:
+    """
+    Formats the search result for /search.
+    """
+    if not result.count:
+        return f"No expenses match '{terms}'"
+    lines = [f"Expenses matching '{terms}': {result.count}, total {result.total:.2f}"]
+    if result.count > len(result.rows):
+        lines[0] += f", the first {len(result.rows)}:"
+    for expense_date, name, category, shared, amount in result.rows:
+        expense_date = datetime.strptime(expense_date, db.DATE_FORMAT).strftime(db.USER_DATE_FORMAT)
+        shared = ", shared" if shared else ""
+        lines.append(f"{expense_date} {name} ({category}{shared}): {amount:.2f}")
+    return '\n'.join(lines)
@@ -0,0 +1,45 @@
+"""
+This module measures the startup time of the bot.
+
+It is imported by the package before anything else, so the clock starts before the bot's dependencies are loaded.
+"""
+import os
+import time
+
+# The bot should be ready to handle updates within this time after the start
+STARTUP_TARGET_MS = float(os.getenv('STARTUP_TARGET_MS', '1000'))
+
+STARTED = time.perf_counter()
+
+_marks = {}
+
+
+def mark(name: str):
+    """
+    Records the time since the start for a startup step, only the first time it is reached.
+    """
+    if name not in _marks:
+        _marks[name] = (time.perf_counter() - STARTED) * 1000
+
+
+def timings() -> dict:
+    """
+    Returns the recorded steps and their times in milliseconds.
+    """
+    return dict(_marks)
+
+
+def within_target() -> bool:
+    """
+    Tells if the bot was ready within STARTUP_TARGET_MS.
+    """
+    return 'ready' in _marks and _marks['ready'] <= STARTUP_TARGET_MS
+
+
+def summary() -> str:
+    """
+    Formats the recorded steps and the target.
+    """
+    steps = ', '.join(f"{name} {ms:.0f} ms" for name, ms in _marks.items())
+    status = "within" if within_target() else "over"
+    return f"Startup: {steps} ({status} the {STARTUP_TARGET_MS:.0f} ms target)"
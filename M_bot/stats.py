@@ -1,275 +1,82 @@
-import datetime
-import sqlite3
+from io import BytesIO
 
-import matplotlib.pyplot as plt
 from docx import Document
 
-
-def calculate_expenses():
-    data = get_expenses_data()
-
-
-def generate_chart(chart_type, data, title, filename):
-    plt.style.use("fivethirtyeight")
-    if chart_type == 'bar':
-        plt.bar(data.keys(), data.values())
-    elif chart_type == 'donut':
-        fig, ax = plt.subplots()
-        ax.pie(data.values(), labels=data.keys(), autopct='%1.1f%%', startangle=90, pctdistance=0.85)
-        centre_circle = plt.Circle((0, 0), 0.70, fc='white')
-        fig = plt.gcf()
-        fig.gca().add_artist(centre_circle)
-        plt.axis('equal')
-    plt.title(title)
-    plt.tight_layout()
-    plt.savefig(filename)
-    plt.show()
-
-
-def generate_monthly_bar(month, year):
-    # Get the expenses data for the specified month
-    monthly_data, _ = get_expenses_for_month(month, year)
-
-    # Get the costs per day
-    day_cost = get_costs_per_day(monthly_data)
-
-    generate_chart('bar', day_cost, f"Expenses per day for {month}/{year}", '../monthly_expenses_bar.png')
-
-
-def generate_yearly_bar(year):
-    # Get the expenses data for the specified year
-    yearly_data, _ = get_expenses_for_year(year)
-
-    # Get the costs by month
-    month_cost = get_costs_per_month(yearly_data)
-
-    # Generate the bar chart
-    generate_chart('bar', month_cost, f"Expenses per month for {year}", '../yearly_expenses_bar.png')
-
-
-def get_expenses_data():
-    conn = sqlite3.connect('../data/expenses.db')
-    c = conn.cursor()
-    c.execute("SELECT * FROM expenses")
-    data = c.fetchall()
-    conn.close()
-    return data
-
-
-def get_costs_by_category(data):
-    # Get the unique categories from the data
-    categories = set(row[1] for row in data)
-
-    # Initialize a dictionary to store the costs per category
-    cat_cost = {}
-
-    # Calculate the total cost for each category
-    for cat in categories:
-        cat_cost[cat] = sum(row[2] for row in data if row[1] == cat)
-
-    return cat_cost
-
-
-def get_costs_per_day(data):
-    # Initialize a dictionary to store the costs per day
-    day_cost = {day: 0 for day in range(1, 32)}
-
-    # Calculate the total cost for each day
-    for row in data:
-        day = row[0].day
-        day_cost[day] += row[2]
-
-    return day_cost
-
-
-def get_costs_per_month(data):
-    # Initialize a dictionary to store the costs per month
-    month_cost = {month: 0 for month in range(1, 13)}
-
-    # Calculate the total cost for each month
-    for row in data:
-        month = row[0].month
-        month_cost[month] += row[2]
-
-    return month_cost
-
-
-def get_expenses_for_month(month, year):
-    # Fetch the data from the database
-    data = get_expenses_data()
-
-    # Convert the date strings into datetime objects
-    dates = [datetime.datetime.strptime(row[4], '%d.%m.%Y') for row in data]
-    categories = [row[1] for row in data]
-    amounts = [row[3] for row in data]
-    shared = [row[2] for row in data]
-
-    # Filter the data based on the month and year of the datetime objects
-    monthly_data = []
-    monthly_shared_data = []
-    for date, category, amount, is_shared in zip(dates, categories, amounts, shared):
-        if date.month == month and date.year == year:
-            if is_shared == "yes":
-                amount /= 2
-                monthly_shared_data.append((date, category, amount))
-            monthly_data.append((date, category, amount))
-
-    return monthly_data, monthly_shared_data
-
-
-def get_expenses_for_year(year):
-    # Fetch the data from the database
-    data = get_expenses_data()
-
-    # Convert the date strings into datetime objects
-    dates = [datetime.datetime.strptime(row[4], '%d.%m.%Y') for row in data]
-    categories = [row[1] for row in data]
-    amounts = [row[3] for row in data]
-    shared = [row[2] for row in data]
-
-    # Filter the data based on the year of the datetime objects
-    yearly_data = []
-    yearly_shared_data = []
-    for date, category, amount, is_shared in zip(dates, categories, amounts, shared):
-        if date.year == year:
-            if is_shared == "yes":
-                amount /= 2
-                yearly_shared_data.append((date, category, amount))
-            yearly_data.append((date, category, amount))
-
-    return yearly_data, yearly_shared_data
-
-
-def generate_monthly_donut(month, year):
-    # Get the expenses data for the specified month
-    monthly_data, _ = get_expenses_for_month(month, year)
-
-    # Get the costs by category
-    cat_cost = get_costs_by_category(monthly_data)
-
-    generate_chart('donut', cat_cost, f"Expenses per category for {month}/{year}", '../monthly_expenses_donut.png')
-
-
-def generate_yearly_donut(year):
-    # Get the expenses data for the specified year
-    yearly_data, _ = get_expenses_for_year(year)
-
-    # Get the costs by category
-    cat_cost = get_costs_by_category(yearly_data)
-
-    # Generate the donut chart
-    generate_chart('donut', cat_cost, f"Expenses per category for {year}", '../yearly_expenses_donut.png')
-
-
-def generate_monthly_shared_donut(month, year):
-    # Get the shared expenses data for the specified month
-    _, monthly_shared_data = get_expenses_for_month(month, year)
-
-    # Get the costs by category
-    cat_cost = get_costs_by_category(monthly_shared_data)
-
-    # Generate the donut chart
-    fig, ax = plt.subplots()
-    ax.pie(cat_cost.values(), labels=cat_cost.keys(), autopct='%1.1f%%', startangle=90, pctdistance=0.85)
-    centre_circle = plt.Circle((0, 0), 0.70, fc='white')
-    fig = plt.gcf()
-    fig.gca().add_artist(centre_circle)
-    plt.axis('equal')
-    plt.tight_layout()
-    plt.savefig('monthly_shared_expenses_donut.png')
-    plt.show()
-
-
-def generate_yearly_shared_donut(year):
-    # Get the shared expenses data for the specified year
-    _, yearly_shared_data = get_expenses_for_year(year)
-
-    # Get the costs by category
-    cat_cost = get_costs_by_category(yearly_shared_data)
-
-    # Generate the donut chart
-    fig, ax = plt.subplots()
-    ax.pie(cat_cost.values(), labels=cat_cost.keys(), autopct='%1.1f%%', startangle=90, pctdistance=0.85)
-    centre_circle = plt.Circle((0, 0), 0.70, fc='white')
-    fig = plt.gcf()
-    fig.gca().add_artist(centre_circle)
-    plt.axis('equal')
-    plt.tight_layout()
-    plt.savefig('yearly_shared_expenses_donut.png')
-    plt.show()
-
-
-def generate_monthly_shared_bar(month, year):
-    # Get the shared expenses data for the specified month
-    _, monthly_shared_data = get_expenses_for_month(month, year)
-
-    # Get the costs per day
-    day_cost = get_costs_per_day(monthly_shared_data)
-
-    # Generate the bar chart
-    plt.style.use("fivethirtyeight")
-    plt.bar(day_cost.keys(), day_cost.values())
-    plt.title(f"Shared expenses per day for {month}/{year}")
-    plt.tight_layout()
-    plt.savefig('monthly_shared_expenses_bar.png')
-    plt.show()
-
-
-def generate_yearly_shared_bar(year):
-    # Get the shared expenses data for the specified year
-    _, yearly_shared_data = get_expenses_for_year(year)
-
-    # Get the costs per month
-    month_cost = get_costs_per_month(yearly_shared_data)
-
-    # Generate the bar chart
-    plt.style.use("fivethirtyeight")
-    plt.bar(month_cost.keys(), month_cost.values())
-    plt.title(f"Shared expenses per month for {year}")
-    plt.tight_layout()
-    plt.savefig('yearly_shared_expenses_bar.png')
-    plt.show()
-
-
-def generate_yearly_reports(year):
-    # Generate the yearly reports
-    generate_yearly_bar(year)
-    generate_yearly_donut(year)
-    generate_yearly_shared_bar(year)
-    generate_yearly_shared_donut(year)
-
-    # Create a new Word document
-    doc = Document()
-
-    # Add each image to the Word document
-    doc.add_picture('yearly_expenses_bar.png')
-    doc.add_picture('yearly_expenses_donut.png')
-    doc.add_picture('yearly_shared_expenses_bar.png')
-    doc.add_picture('yearly_shared_expenses_donut.png')
-
-    # Save the Word document
-    doc.save('yearly_reports.docx')
-
-    print("Yearly reports generated and saved in 'yearly_reports.docx'")
-
-
-def generate_monthly_reports(month, year):
-    # Generate the yearly reports
-    generate_monthly_bar(month, year)
-    generate_monthly_donut(month, year)
-    generate_monthly_shared_bar(month, year)
-    generate_monthly_shared_donut(month, year)
-
-    # Create a new Word document
+from M_bot import archive, charts, db, metrics
+
+
+def get_period_totals(chat_id, table, key, start, end, buckets):
+    """
+    Returns the chat's totals of the [start, end) period, the shared expenses are counted as half.
+    The totals are read from a rollup table keyed by (day or month, category, shared),
+    so the cost depends on the number of buckets and categories and not on the number of expenses.
+    """
+    conn = db.get_connection()
+    rows = conn.execute(*archive.union(conn, f"""
+        SELECT {key}, category, shared, total
+        FROM {{schema}}.{table}
+        WHERE chat_id = ? AND {key} >= ? AND {key} < ?
+    """, (chat_id, start, end), start, end)).fetchall()
+
+    totals = {
+        'per_bucket': {bucket: 0 for bucket in buckets},
+        'per_category': {},
+        'shared_per_bucket': {bucket: 0 for bucket in buckets},
+        'shared_per_category': {},
+    }
+    for period, category, is_shared, amount in rows:
+        # The day or month number is the last part of the key
+        bucket = int(period[-2:])
+        if is_shared:
+            amount /= 2
+            totals['shared_per_bucket'][bucket] += amount
+            totals['shared_per_category'][category] = totals['shared_per_category'].get(category, 0) + amount
+        totals['per_bucket'][bucket] += amount
+        totals['per_category'][category] = totals['per_category'].get(category, 0) + amount
+
+    return totals
+
+
+def get_monthly_totals(chat_id, month, year):
+    # Totals per day of the month
+    return get_period_totals(chat_id, 'daily_totals', 'day', *db.month_range(month, year), range(1, 32))
+
+
+def get_yearly_totals(chat_id, year):
+    # Totals per month of the year, the month keys are 'yyyy-mm'
+    start, end = db.year_range(year)
+    return get_period_totals(chat_id, 'monthly_totals', 'month', start[:7], end[:7], range(1, 13))
+
+
+def build_document(charts):
+    # Create a new Word document with each chart fitted to the page width and return its bytes
     doc = Document()
-
-    # Add each image to the Word document
-    doc.add_picture('monthly_expenses_bar.png')
-    doc.add_picture('monthly_expenses_donut.png')
-    doc.add_picture('monthly_shared_expenses_bar.png')
-    doc.add_picture('monthly_shared_expenses_donut.png')
-
-    # Save the Word document
-    doc.save('monthly_reports.docx')
-
-    print("Monthly reports generated and saved in 'monthly_reports.docx'")
\ No newline at end of file
+    section = doc.sections[0]
+    width = section.page_width - section.left_margin - section.right_margin
+    for chart in charts:
+        doc.add_picture(chart, width=width)
+    buffer = BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+
+def render_reports(totals, bucket, period, combined):
+    # Render the charts and build the document, timing both phases
+    with metrics.timer('bot_report_seconds', phase='charts'):
+        images = charts.render_report(totals, bucket, period, combined)
+    with metrics.timer('bot_report_seconds', phase='document'):
+        return build_document(images)
+
+
+def generate_yearly_reports(chat_id, year, combined=None):
+    # Aggregate the chat's year once and generate the yearly reports from it
+    with metrics.timer('bot_report_seconds', phase='aggregate'):
+        totals = get_yearly_totals(chat_id, year)
+    return render_reports(totals, 'month', f"{year}", combined)
+
+
+def generate_monthly_reports(chat_id, month, year, combined=None):
+    # Aggregate the chat's month once and generate the monthly reports from it
+    with metrics.timer('bot_report_seconds', phase='aggregate'):
+        totals = get_monthly_totals(chat_id, month, year)
+    return render_reports(totals, 'day', f"{month}/{year}", combined)
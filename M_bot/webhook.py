@@ -0,0 +1,96 @@
+"""
+This module runs the bot in webhook mode: Telegram POSTs the updates to a local HTTP listener,
+which checks the secret token and feeds them to the update queue of the Application.
+When WEBHOOK_SECRET is not set a random secret token is registered with the webhook on every start.
+"""
+import asyncio
+import hmac
+import json
+import os
+import secrets
+import signal
+
+from telegram import Update
+from telegram.ext import Application
+
+from M_bot import httpserver
+
+# Public URL Telegram sends the updates to, the bot runs in polling mode when it is not set
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+# Updates waiting to be handled, Telegram retries the ones rejected when the queue is full
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', '100'))
+
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+
+
+def make_handler(update_queue: asyncio.Queue, bot, path: str, secret: str):
+    """
+    Returns the HTTP handler putting the updates POSTed to path into the queue.
+    """
+
+    async def handle(method: str, request_path: str, headers: dict, body: bytes):
+        if request_path != path:
+            return 404, b'Not Found'
+        if method != 'POST':
+            return 405, b'Method Not Allowed'
+        if not hmac.compare_digest(headers.get(SECRET_HEADER, ''), secret):
+            return 403, b'Forbidden'
+        try:
+            update = Update.de_json(json.loads(body), bot)
+        except (ValueError, TypeError, KeyError):
+            return 400, b'Bad Request'
+        try:
+            update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            return 503, b'Service Unavailable'
+        return 200, b'OK'
+
+    return handle
+
+
+async def start_receiver(update_queue: asyncio.Queue, bot, host: str = None, port: int = None,
+                         path: str = None, secret: str = None) -> asyncio.Server:
+    """
+    Starts the HTTP listener feeding the update queue with the updates carrying the secret token.
+    Raises ValueError without a secret token.
+    """
+    secret = secret or WEBHOOK_SECRET
+    if not secret:
+        raise ValueError("The webhook receiver needs a secret token")
+    handler = make_handler(update_queue, bot, path or WEBHOOK_PATH, secret)
+    return await httpserver.serve(host or WEBHOOK_LISTEN, port if port is not None else WEBHOOK_PORT, handler)
+
+
+async def run(app: Application):
+    """
+    Runs the application in webhook mode until SIGINT or SIGTERM.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    # Telegram accepts up to 256 letters, digits, '_' and '-'
+    secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    try:
+        await app.bot.set_webhook(url=WEBHOOK_URL, secret_token=secret, allowed_updates=Update.ALL_TYPES)
+        await app.start()
+        server = await start_receiver(app.update_queue, app.bot, secret=secret)
+        print(f"Listening for updates on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        await stop.wait()
+
+        # Stop accepting updates first, then let the application finish the queued ones
+        server.close()
+        await server.wait_closed()
+        await app.stop()
+    finally:
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
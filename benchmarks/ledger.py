@@ -0,0 +1,103 @@
+"""
+Generates synthetic expense ledgers for the benchmarks.
+
+The expenses are spread over several years up to today, with a realistic mix of categories, amounts
+and shared expenses, so every command finds data for its period.
+
+    python -m benchmarks.ledger data/bench.db --rows 1000000
+"""
+import argparse
+import bisect
+import itertools
+import random
+import time
+from datetime import date, timedelta
+
+from M_bot import db
+
+# Share of the expenses per category
+CATEGORY_WEIGHTS = {
+    "food": 40,
+    "eating out": 15,
+    "cravings": 15,
+    "house cleaning": 10,
+    "cosmetics": 10,
+    "alcohol": 10,
+}
+# Typical amount per category, the amounts follow a log-normal distribution around it
+CATEGORY_AMOUNTS = {
+    "food": 40,
+    "eating out": 60,
+    "cravings": 15,
+    "house cleaning": 30,
+    "cosmetics": 35,
+    "alcohol": 25,
+}
+NAMES = {
+    "food": ["bread", "milk", "vegetables", "groceries", "meat", "fruit"],
+    "eating out": ["pizza", "sushi", "burger", "dinner", "lunch"],
+    "cravings": ["chocolate", "ice cream", "chips", "cookies"],
+    "house cleaning": ["detergent", "sponges", "trash bags", "dish soap"],
+    "cosmetics": ["shampoo", "soap", "toothpaste", "cream"],
+    "alcohol": ["beer", "wine", "whisky"],
+}
+SHARED_RATIO = 0.35
+CHUNK_SIZE = 50000
+
+
+def generate_rows(count: int, years: int = 3, chats: int = 1, seed: int = 0, end: date = None):
+    """
+    Yields count (name, category, shared, amount, date, chat_id) rows in date order,
+    spread over the given number of years up to the end date (today by default).
+    """
+    rng = random.Random(seed)
+    end = end or date.today()
+    first = end - timedelta(days=365 * years - 1)
+    dates = [(first + timedelta(days=day)).strftime(db.DATE_FORMAT) for day in range((end - first).days + 1)]
+    categories = list(CATEGORY_WEIGHTS)
+    cumulative = list(itertools.accumulate(CATEGORY_WEIGHTS.values()))
+    total = cumulative[-1]
+    for index in range(count):
+        category = categories[bisect.bisect(cumulative, rng.random() * total)]
+        amount = max(1, round(rng.lognormvariate(0, 0.6) * CATEGORY_AMOUNTS[category]))
+        shared = rng.random() < SHARED_RATIO
+        yield (rng.choice(NAMES[category]), category, shared, amount, dates[index * len(dates) // count],
+               rng.randrange(chats) + 1)
+
+
+def generate(path: str, count: int, years: int = 3, chats: int = 1, seed: int = 0) -> float:
+    """
+    Creates a ledger database with count expenses and returns how long it took in seconds.
+    The chat ids go from 1 to chats.
+    """
+    started = time.perf_counter()
+    conn = db.connect(path)
+    db.init_db(conn)
+    # Nothing to lose while generating, skip the durability work
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    rows = generate_rows(count, years, chats, seed)
+    while chunk := [row for _, row in zip(range(CHUNK_SIZE), rows)]:
+        conn.executemany("INSERT INTO expenses (name, category, shared, amount, date, chat_id) "
+                         "VALUES (?, ?, ?, ?, ?, ?)", chunk)
+        conn.commit()
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("ANALYZE")
+    conn.close()
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic expense ledger")
+    parser.add_argument('path')
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--years', type=int, default=3)
+    parser.add_argument('--chats', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    seconds = generate(args.path, args.rows, args.years, args.chats, args.seed)
+    print(f"Generated {args.rows} expenses in {seconds:.1f} s")
+
+
+if __name__ == '__main__':
+    main()
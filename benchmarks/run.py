@@ -0,0 +1,228 @@
+"""
+Drives the bot commands against a synthetic ledger and reports their latency, the peak memory
+and the number of SQL statements per call as JSON.
+
+    python -m benchmarks.run --rows 100000 --output before.json
+    python -m benchmarks.run --rows 100000 --compare before.json
+    python -m benchmarks.run --rows 500000 --chats 500 --only search search_month
+
+The reports are rendered in worker processes: their queries are not counted and their memory is
+reported separately as peak_children_rss_kb. Only the results are written to stdout, what the bot prints
+goes to stderr.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+from types import SimpleNamespace
+
+from M_bot import db, report_cache
+from M_bot import main as bot
+from benchmarks import ledger
+
+_queries = 0
+_queries_lock = threading.Lock()
+
+
+def _count_query(_):
+    global _queries
+    with _queries_lock:
+        _queries += 1
+
+
+def count_queries():
+    """
+    Makes every connection opened from now on count the statements it runs.
+    """
+    connect = db.connect
+
+    def counting_connect(*args, **kwargs):
+        conn = connect(*args, **kwargs)
+        conn.set_trace_callback(_count_query)
+        return conn
+
+    db.connect = counting_connect
+
+
+class FakeMessage:
+    """
+    The part of telegram.Message used by the handlers, the replies are only counted.
+    """
+
+    def __init__(self, text: str, chat_id: int):
+        self.text = text
+        self.chat_id = chat_id
+        self.chat = SimpleNamespace(id=chat_id)
+        self.document = None
+        self.reply_to_message = None
+        self.replies = 0
+
+    async def reply_text(self, text, **_):
+        self.replies += 1
+
+
+class FakeBot:
+    """
+    The part of telegram.Bot used by the handlers, the documents are read and dropped.
+    """
+
+    async def send_document(self, chat_id, document, **_):
+        data = document.input_file_content
+        return len(data)
+
+
+def make_update(text: str, chat_id: int):
+    # The parts of telegram.Update and CallbackContext used by the handlers
+    message = FakeMessage(text, chat_id)
+    update = SimpleNamespace(message=message, effective_chat=message.chat, effective_user=None)
+    context = SimpleNamespace(bot=FakeBot(), args=text.split()[1:], error=None)
+    return update, context
+
+
+def commands(today: date) -> list:
+    """
+    Returns the benchmarked cases as (name, handler, message text, clear the report cache first).
+    """
+    last_month = today.replace(day=1) - timedelta(days=1)
+    return [
+        ('expense', bot.expense_command, "/expense food bread no 12", False),
+        ('expense_batch', bot.expense_command,
+         "/expense " + "\n".join(f"food item{line} {'yes' if line % 2 else 'no'} {line}.5" for line in range(1, 11)),
+         False),
+        ('old_expense', bot.old_expense_command, f"/old_expense food bread no 12 {last_month:%d.%m.%Y}", False),
+        ('delete_last_expense', bot.delete_last_expense, "/delete_last_expense", False),
+        ('today_expenses', bot.today_expenses_command, "/today_expenses", False),
+        ('weekly_expenses', bot.weekly_expenses_command, "/weekly_expenses", False),
+        ('monthly_expenses', bot.monthly_expenses_command, "/monthly_expenses", False),
+        ('search', bot.search_command, "/search piz", False),
+        ('search_month', bot.search_command, f"/search piz {last_month:01.%m.%Y} {last_month:%d.%m.%Y}", False),
+        ('export_month', bot.export_command, f"/export {last_month:01.%m.%Y} {last_month:%d.%m.%Y}", False),
+        ('monthly_report', bot.monthly_report_command,
+         f"/monthly_report {last_month.month} {last_month.year}", True),
+        ('monthly_report_cached', bot.monthly_report_command,
+         f"/monthly_report {last_month.month} {last_month.year}", False),
+        ('yearly_report', bot.yearly_report_command, f"/yearly_report {last_month.year}", True),
+    ]
+
+
+def percentile(samples: list, p: float) -> float:
+    # Nearest-rank percentile
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered) + 0.5) - 1))]
+
+
+async def run_case(handler, text: str, chat_id: int, clear_cache: bool, iterations: int, warmup: int) -> dict:
+    """
+    Runs the handler warmup + iterations times and returns its latency and query statistics.
+    """
+    samples = []
+    queries = 0
+    for iteration in range(warmup + iterations):
+        if clear_cache:
+            report_cache.cache_clear()
+        update, context = make_update(text, chat_id)
+        before = _queries
+        started = time.perf_counter()
+        await handler(update, context)
+        elapsed = time.perf_counter() - started
+        if iteration >= warmup:
+            samples.append(elapsed)
+            queries += _queries - before
+    return {
+        'iterations': iterations,
+        'p50_ms': percentile(samples, 50) * 1000,
+        'p99_ms': percentile(samples, 99) * 1000,
+        'mean_ms': sum(samples) / len(samples) * 1000,
+        'queries_per_call': queries / iterations,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+async def run(cases: list, chat_id: int, iterations: int, warmup: int) -> dict:
+    await bot.on_startup(None)
+    try:
+        return {name: await run_case(handler, text, chat_id, clear_cache, iterations, warmup)
+                for name, handler, text, clear_cache in cases}
+    finally:
+        await bot.on_shutdown(None)
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict, baseline: dict):
+    """
+    Prints the latency of every case relative to a previous run.
+    """
+    print(f"{'case':<24}{'p50 ms':>10}{'before':>10}{'ratio':>8}{'p99 ms':>10}{'before':>10}{'ratio':>8}")
+    for name, case in results['cases'].items():
+        old = baseline['cases'].get(name)
+        if old is None:
+            continue
+        print(f"{name:<24}{case['p50_ms']:>10.2f}{old['p50_ms']:>10.2f}{case['p50_ms'] / old['p50_ms']:>8.2f}"
+              f"{case['p99_ms']:>10.2f}{old['p99_ms']:>10.2f}{case['p99_ms'] / old['p99_ms']:>8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the bot commands")
+    parser.add_argument('--rows', type=int, default=100000, help="expenses in the generated ledger")
+    parser.add_argument('--years', type=int, default=3)
+    parser.add_argument('--chats', type=int, default=1, help="chats sharing the generated ledger, chat 1 is measured")
+    parser.add_argument('--db', help="ledger to use, generated when it does not exist")
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--only', nargs='*', help="names of the cases to run")
+    parser.add_argument('--output', help="file the JSON results are written to, stdout by default")
+    parser.add_argument('--compare', help="JSON results of a previous run to compare with")
+    args = parser.parse_args()
+
+    # Keeps stdout valid JSON, the bot prints its startup times and errors
+    with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(sys.stderr):
+        path = args.db or os.path.join(tmp, 'bench.db')
+        generate_seconds = None
+        if not os.path.exists(path):
+            generate_seconds = ledger.generate(path, args.rows, args.years, args.chats)
+        db.DB_PATH = path
+        count_queries()
+
+        cases = commands(date.today())
+        if args.only:
+            cases = [case for case in cases if case[0] in args.only]
+        results = {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'rows': args.rows,
+            'chats': args.chats,
+            'generate_seconds': generate_seconds,
+            'cases': asyncio.run(run(cases, 1, args.iterations, args.warmup)),
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'peak_children_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        }
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+    elif not args.compare:
+        print(output)
+    if args.compare:
+        with open(args.compare) as file:
+            compare(results, json.load(file))
+
+
+if __name__ == '__main__':
+    main()
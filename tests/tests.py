@@ -1,56 +1,1294 @@
+import asyncio
+import contextlib
+import gc
+import gzip
+import io
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from types import SimpleNamespace
+from unittest import mock
 
-from M_bot.main import add_expense, add_old_expense
-from M_bot.stats import get_costs_by_category, get_costs_per_day
+from docx import Document
 
+from benchmarks import ledger
+from benchmarks import run as bench
+from M_bot import (archive, budgets, charts, concurrency, db, exporter, importer, listing, main, maintenance, metrics,
+                   parser, prerender, report_cache, report_pool, search, webhook)
+from M_bot.main import get_today_expenses, remove_last_expense
+from M_bot.stats import get_monthly_totals, get_yearly_totals, generate_monthly_reports
 
-class TestMain(unittest.TestCase):
+
+def add_expense(line: str, chat_id: int = 0, alerts: list = None) -> bool:
+    # Adds an expense line, dated today unless it has a date, the way the /expense handler does
+    return main.add_expenses([parser.parse_line(line, db.today())], chat_id, alerts)
+
+
+class DbTestCase(unittest.TestCase):
+    def setUp(self):
+        # Point the database at a temporary file
+        self.tmp = tempfile.TemporaryDirectory()
+        self.old_path = db.DB_PATH
+        db.DB_PATH = os.path.join(self.tmp.name, 'expenses.db')
+
+    def tearDown(self):
+        db.close()
+        db.DB_PATH = self.old_path
+        self.tmp.cleanup()
+
+
+class TestMain(DbTestCase):
     def test_add_expense(self):
-        # Test the add_expense function
-        result = add_expense("test", "food", "yes", 100)
-        self.assertEqual(result, "Your expense has been added")
+        # Test the add_expenses function with a line without a date
+        self.assertTrue(add_expense("food test yes 100"))
+        self.assertEqual(get_today_expenses(0), [("test", "food", "yes", 100, db.today())])
 
     def test_add_expense_invalid(self):
-        # Test the add_expense function
-        result = add_expense("test", "food", "yes", -100)
-        self.assertEqual(result, "Amount must be greater than 0")
+        # Test the parse_line function with an amount of 0
+        with self.assertRaisesRegex(ValueError, "amount must be greater than 0"):
+            parser.parse_line("food test yes 0", db.today())
 
     def test_add_old_expense(self):
-        # Test the add_old_expense function
-        result = add_old_expense("test", "food", "yes", 100, "01.01.2022")
-        self.assertEqual(result, "Your old expense has been added")
-
+        # Test the add_expenses function with a dated line
+        self.assertTrue(add_expense("food test yes 100 01.01.2022"))
+        self.assertEqual(db.get_connection().execute("SELECT date FROM expenses").fetchone()[0], "2022-01-01")
 
     def test_add_old_expense_invalid_date(self):
-        # Test the add_old_expense function with an invalid date
-        result = add_old_expense("test", "food", "yes", 100, "invalid_date")
-        self.assertEqual(result, "Invalid date. Please enter a valid date in the format dd.mm.yyyy.")
-
-
-class TestStats(unittest.TestCase):
-    def test_get_costs_by_category(self):
-        # Test the get_costs_by_category function
-        data = [("01.01.2022", "food", 100), ("02.01.2022", "cosmetics", 50)]
-        result = get_costs_by_category(data)
-        self.assertEqual(result, {"food": 100, "cosmetics": 50})
-
-    def test_get_costs_per_day(self):
-        # Test the get_costs_per_day function
-        data = [("01.01.2022", "food", 100), ("02.01.2022", "cosmetics", 50)]
-        result = get_costs_per_day(data)
-        self.assertEqual(result, {1: 100, 2: 50})
-
-    def test_get_costs_by_category_empty_data(self):
-        # Test the get_costs_by_category function with empty data
-        data = []
-        result = get_costs_by_category(data)
-        self.assertEqual(result, {})
-
-    def test_get_costs_per_day_single_day(self):
-        # Test the get_costs_per_day function with data for a single day
-        data = [("01.01.2022", "food", 100), ("01.01.2022", "cosmetics", 50)]
-        result = get_costs_per_day(data)
-        self.assertEqual(result, {1: 150})
+        # Test the parse_line function with an invalid date
+        with self.assertRaisesRegex(ValueError, "invalid date"):
+            parser.parse_line("food test yes 100 32.01.2022")
+
+    def test_write_and_read_through_the_access_layer(self):
+        # Test that writes queued for the writer are visible to reads on the thread pool
+        async def run():
+            results = await asyncio.gather(*(db.write(add_expense, f"food test {i} no 10") for i in range(5)))
+            rows = await db.read(get_today_expenses, 0)
+            await db.stop()
+            return results, rows
+
+        results, rows = asyncio.run(run())
+        self.assertEqual(results, [True] * 5)
+        self.assertEqual(len(rows), 5)
+
+    def test_delete_last_expense(self):
+        # Test that only the last expense is removed
+        add_expense("food first no 10")
+        add_expense("food second no 20")
+        self.assertEqual(remove_last_expense(0), "The last expense has been deleted")
+        self.assertEqual([row[0] for row in get_today_expenses(0)], ["first"])
+
+    def test_delete_shared_expense(self):
+        # Test that deleting a shared expense also removes it from the shared expenses
+        add_expense("eo pizza yes 40")
+        remove_last_expense(0)
+        self.assertEqual(db.get_connection().execute("SELECT COUNT(*) FROM shared_expenses").fetchone()[0], 0)
+
+    def test_chats_have_separate_ledgers(self):
+        # Test that every chat only sees and deletes its own expenses
+        add_expense("food mine no 10", 1)
+        add_expense("food theirs no 20", 2)
+        self.assertEqual([row[0] for row in get_today_expenses(1)], ["mine"])
+        remove_last_expense(1)
+        self.assertEqual(get_today_expenses(1), [])
+        self.assertEqual([row[0] for row in get_today_expenses(2)], ["theirs"])
+
+    def test_wal_mode(self):
+        # Test that the connections use write-ahead logging
+        self.assertEqual(db.get_connection().execute("PRAGMA journal_mode").fetchone()[0], "wal")
+
+
+class TestParser(unittest.TestCase):
+    def test_parse_line(self):
+        # Test aliases, multi-word names, decimal amounts and the optional date
+        self.assertEqual(parser.parse_line("eo Pizza Margherita yes 40,5", "2024-01-02"),
+                         ("pizza margherita", "eating out", True, 40.5, "2024-01-02"))
+        self.assertEqual(parser.parse_line("food milk y no 3 05.01.2024"),
+                         ("milk y", "food", False, 3, "2024-01-05"))
+
+    def test_invalid_lines(self):
+        # Test that the reason of an invalid line is given
+        for line, reason in (("food bread maybe 5", "expected"), ("food bread no 0", "greater than 0"),
+                             ("food bread no 5 31.02.2024", "invalid date"), ("food bread no 5", "missing date")):
+            with self.assertRaisesRegex(ValueError, reason):
+                parser.parse_line(line)
+
+    def test_parse_message(self):
+        # Test that the command is skipped and every non-empty line is numbered
+        results = parser.parse_message("/expense@m_bot food bread no 5\n\nfood bread\nalcohol beer yes 8", "2024-01-02")
+        self.assertEqual([(result.line, bool(result.expense)) for result in results],
+                         [(1, True), (2, False), (3, True)])
+        self.assertTrue(parser.format_results(results).startswith("Added 2 of 3 expenses"))
+
+
+class TestExpenseCommand(DbTestCase):
+    def test_batch_message(self):
+        # Test that the valid lines of a message are added in one write and every line is answered
+        async def run():
+            update, context = bench.make_update("/expense food bread no 5\nfood milk no\neo pizza yes 40", 3)
+            batches = db.write_stats()['batches']
+            await main.expense_command(update, context)
+            batches = db.write_stats()['batches'] - batches
+            await db.stop()
+            return update.message.replies, batches
+
+        self.assertEqual(asyncio.run(run()), (1, 1))
+        self.assertEqual([row[0] for row in get_today_expenses(3)], ["bread", "pizza"])
+
+    def test_old_expense_needs_date(self):
+        # Test that /old_expense does not default to today
+        async def run():
+            update, context = bench.make_update("/old_expense food bread no 5", 3)
+            await main.old_expense_command(update, context)
+            await db.stop()
+
+        asyncio.run(run())
+        self.assertEqual(get_today_expenses(3), [])
+
+
+class TestReportCommands(unittest.TestCase):
+    def replies(self, handler, *texts) -> list:
+        # Sends the commands to the handler and returns their replies
+        async def run():
+            replies = []
+            for text in texts:
+                update, context = bench.make_update(text, 1)
+                update.message.reply_text = mock.AsyncMock()
+                await handler(update, context)
+                replies.append(update.message.reply_text.call_args.args[0])
+            return replies
+
+        return asyncio.run(run())
+
+    def test_invalid_monthly_report(self):
+        # Test that a month or a year out of range is answered with the usage
+        usage = "Please provide a month and a year in the format 'monthly_report month year'"
+        self.assertEqual(self.replies(main.monthly_report_command, "/monthly_report 13 2024",
+                                      "/monthly_report 0 2024", "/monthly_report 12 9999", "/monthly_report 1"),
+                         [usage] * 4)
+        self.assertEqual(self.replies(main.monthly_report_command, "/monthly_report may 2024"),
+                         ["Month and year should be numbers"])
+
+    def test_invalid_yearly_report(self):
+        # Test that a missing, invalid or out of range year is answered with the usage
+        usage = "Please provide a year in the format 'yearly_report year'"
+        self.assertEqual(self.replies(main.yearly_report_command, "/yearly_report", "/yearly_report 0",
+                                      "/yearly_report 9999", "/yearly_report abc"),
+                         [usage] * 3 + ["The year should be a number"])
+
+
+class TestBudgets(DbTestCase):
+    def setUp(self):
+        super().setUp()
+        budgets.reset()
+
+    def tearDown(self):
+        budgets.reset()
+        super().tearDown()
+
+    def test_alerts(self):
+        # Test that the spending follows the added and deleted expenses and the crossed thresholds are reported
+        budgets.set_budget(1, "food", 100)
+        alerts = []
+        add_expense("food bread no 70", 1, alerts)
+        add_expense("alcohol beer no 70", 1, alerts)
+        self.assertEqual(alerts, [])
+        add_expense("food cheese no 15", 1, alerts)
+        self.assertEqual(alerts, ["Budget alert: food reached 80% of its monthly budget (85.00 of 100.00)"])
+        add_expense("food dinner yes 40", 1, alerts)
+        self.assertEqual(alerts[1:], ["Budget alert: food reached 100% of its monthly budget (105.00 of 100.00)"])
+        remove_last_expense(1)
+        self.assertEqual(budgets.get_budgets(1), [("food", 100, 85)])
+
+        alerts = []
+        add_expense("food old no 500 01.01.2020", 1, alerts)
+        self.assertEqual((alerts, budgets.get_budgets(1)), ([], [("food", 100, 85)]))
+
+    def test_load(self):
+        # Test that the spending is rebuilt from the rollup and reread after an import
+        with db.transaction() as conn:
+            conn.execute("INSERT INTO budgets (chat_id, category, amount) VALUES (1, 'food', 50)")
+        add_expense("food bread yes 30", 1)
+        budgets.load()
+        self.assertEqual(budgets.get_budgets(1), [("food", 50, 15)])
+        importer.insert_expenses(1, [("milk", "food", False, 20, db.today())])
+        alerts = []
+        add_expense("food cheese no 10", 1, alerts)
+        self.assertEqual(budgets.get_budgets(1), [("food", 50, 45)])
+        self.assertEqual(len(alerts), 1)
+
+    def budget_replies(self, *texts) -> list:
+        # Sends the commands to the handlers and returns their replies
+        async def run():
+            replies = []
+            for text in texts:
+                update, context = bench.make_update(text, 1)
+                update.message.reply_text = mock.AsyncMock()
+                handler = main.budget_command if text.startswith("/budget") else main.expense_command
+                await handler(update, context)
+                replies.append(update.message.reply_text.call_args.args[0])
+            await db.stop()
+            return replies
+
+        return asyncio.run(run())
+
+    def test_budget_command(self):
+        # Test that the alerts are sent in the reply of the expense
+        replies = self.budget_replies("/budget eo 100", "/expense eo pizza no 90", "/budget")
+        self.assertEqual(replies[1], "Your expense has been added\n"
+                                     "Budget alert: eating out reached 80% of its monthly budget (90.00 of 100.00)")
+        self.assertEqual(replies[2], "Budgets this month:\neating out: 90.00 of 100.00 (90%)")
+
+    def test_expenses_of_one_commit_counted_once(self):
+        # Test that the spending read from the rollup by the first expense of a batch is not increased by the others
+        replies = self.budget_replies("/budget food 100", "/expense food a no 30\nfood b no 30", "/budget",
+                                      "/expense food c no 25", "/budget food 200",
+                                      "/expense food d no 50\nfood e no 40")
+        self.assertEqual(replies[2], "Budgets this month:\nfood: 60.00 of 100.00 (60%)")
+        self.assertEqual(replies[3], "Your expense has been added\n"
+                                     "Budget alert: food reached 80% of its monthly budget (85.00 of 100.00)")
+        self.assertEqual(replies[5].splitlines()[-1],
+                         "Budget alert: food reached 80% of its monthly budget (175.00 of 200.00)")
+        self.assertEqual(budgets.get_budgets(1), [("food", 200, 175)])
+
+    def test_invalid_budget(self):
+        # Test that amounts that are not finite are rejected
+        for text in ("/budget food nan", "/budget food inf", "/budget food -5"):
+            self.assertEqual(self.budget_replies(text),
+                             ["Please use the format 'budget category amount', 0 removes the budget"])
+        self.assertEqual(budgets.get_budgets(1), [])
+
+
+class TestStatsTotals(DbTestCase):
+    def setUp(self):
+        super().setUp()
+        conn = db.connect()
+        db.init_db(conn)
+        conn.executemany("INSERT INTO expenses (name, category, shared, amount, date) VALUES (?, ?, ?, ?, ?)", [
+            ("bread", "food", 0, 10, "2022-01-01"),
+            ("pizza", "eating out", 1, 40, "2022-01-01"),
+            ("soap", "cosmetics", 0, 6, "2022-01-31"),
+            ("beer", "alcohol", 1, 8, "2022-02-01"),
+        ])
+        conn.commit()
+        conn.close()
+
+    def test_get_monthly_totals(self):
+        # Test that only the requested month is aggregated and shared expenses count as half
+        totals = get_monthly_totals(0, 1, 2022)
+        self.assertEqual(totals['per_bucket'][1], 30)
+        self.assertEqual(totals['per_bucket'][31], 6)
+        self.assertEqual(totals['per_category'], {"food": 10, "eating out": 20, "cosmetics": 6})
+        self.assertEqual(totals['shared_per_category'], {"eating out": 20})
+
+    def test_get_yearly_totals(self):
+        # Test the per month totals of a year
+        totals = get_yearly_totals(0, 2022)
+        self.assertEqual(totals['per_bucket'][1], 36)
+        self.assertEqual(totals['shared_per_bucket'][2], 4)
+
+    def test_totals_of_another_chat(self):
+        # Test that the totals only include the chat's expenses
+        self.assertEqual(get_monthly_totals(1, 1, 2022)['per_category'], {})
+
+    def test_generate_monthly_reports_in_memory(self):
+        # Test that the report is built in memory without writing any file
+        before = set(os.listdir('.'))
+        report = generate_monthly_reports(0, 1, 2022)
+        self.assertTrue(report.startswith(b"PK"))
+        self.assertEqual(len(Document(io.BytesIO(report)).inline_shapes), 4)
+        self.assertEqual(set(os.listdir('.')), before)
+
+    def test_rollups_follow_deletes(self):
+        # Test that deleting an expense updates the rollup tables in the same transaction
+        conn = db.connect()
+        conn.execute("DELETE FROM expenses WHERE name = 'soap'")
+        conn.commit()
+        self.assertIsNone(conn.execute("SELECT * FROM daily_totals WHERE day = '2022-01-31'").fetchone())
+        self.assertEqual(conn.execute("SELECT SUM(total) FROM monthly_totals WHERE month = '2022-01'").fetchone()[0],
+                         50)
+        conn.close()
+
+    def test_rebuild_rollups(self):
+        # Test that rebuilding the rollups gives the same totals as the triggers
+        conn = db.connect()
+        before = conn.execute("SELECT * FROM daily_totals ORDER BY day, category").fetchall()
+        db.rebuild_rollups(conn)
+        self.assertEqual(conn.execute("SELECT * FROM daily_totals ORDER BY day, category").fetchall(), before)
+        conn.close()
+
+
+class TestCharts(unittest.TestCase):
+    def test_figures_are_freed(self):
+        # Test that rendering does not use pyplot and keeps no figure alive
+        import matplotlib.pyplot as plt
+        from matplotlib.figure import Figure
+
+        for _ in range(20):
+            charts.render('bar', {1: 10, 2: 20}, "bars")
+        gc.collect()
+        self.assertEqual(plt.get_fignums(), [])
+        self.assertEqual([obj for obj in gc.get_objects() if isinstance(obj, Figure)], [])
+
+    def test_render_from_threads(self):
+        # Test that charts rendered concurrently are the same as the ones rendered one by one
+        data = [{f"category {i}": i + 1, "food": 10} for i in range(8)]
+        expected = [charts.render('donut', item, "donut").getvalue() for item in data]
+        with ThreadPoolExecutor(4) as executor:
+            results = list(executor.map(lambda item: charts.render('donut', item, "donut").getvalue(), data))
+        self.assertEqual(results, expected)
+
+    def test_empty_donut(self):
+        # Test that a donut without expenses is still rendered
+        self.assertTrue(charts.render('donut', {}, "empty").getvalue().startswith(b"\x89PNG"))
+
+
+class TestWriter(DbTestCase):
+    def test_group_commit(self):
+        # Test that writes queued together are committed in one batch
+        async def run():
+            results = await asyncio.gather(*(db.write(add_expense, f"food test {i} no 10") for i in range(20)))
+            await db.stop()
+            return results
+
+        batches = db.write_stats()['batches']
+        results = asyncio.run(run())
+        self.assertEqual(results, [True] * 20)
+        self.assertEqual(db.write_stats()['batches'], batches + 1)
+        self.assertEqual(len(get_today_expenses(0)), 20)
+
+    def test_failed_write_is_isolated(self):
+        # Test that a failing write is rolled back without affecting the rest of its batch
+        def failing_insert():
+            db.get_connection().execute("INSERT INTO expenses (name) VALUES ('half written')")
+            raise ValueError("failed")
+
+        async def run():
+            results = await asyncio.gather(db.write(add_expense, "food first no 10"),
+                                           db.write(failing_insert),
+                                           db.write(add_expense, "food second no 10"),
+                                           return_exceptions=True)
+            await db.stop()
+            return results
+
+        results = asyncio.run(run())
+        self.assertIsInstance(results[1], ValueError)
+        self.assertEqual(sorted(row[0] for row in get_today_expenses(0)), ["first", "second"])
+        self.assertIsNone(db.get_connection().execute("SELECT * FROM expenses WHERE name = 'half written'").fetchone())
+
+    def test_after_commit(self):
+        # Test that the callbacks of a rolled back savepoint are dropped
+        called = []
+        with db.transaction():
+            db.after_commit(called.append, "kept")
+            with self.assertRaises(ValueError):
+                with db.transaction():
+                    db.after_commit(called.append, "dropped")
+                    raise ValueError()
+            self.assertEqual(called, [])
+        self.assertEqual(called, ["kept"])
+
+    def test_failed_commit_drops_callbacks(self):
+        # Test that the callbacks of a transaction whose commit fails do not run with the next one
+        conn = sqlite3.connect(':memory:', isolation_level=None)
+        conn.execute("PRAGMA foreign_keys = ON")
+        conn.execute("CREATE TABLE parent (id integer PRIMARY KEY)")
+        conn.execute("CREATE TABLE child (parent_id integer REFERENCES parent (id) DEFERRABLE INITIALLY DEFERRED)")
+        called = []
+        with self.assertRaises(sqlite3.IntegrityError):
+            with db.transaction(conn):
+                conn.execute("INSERT INTO child VALUES (1)")
+                db.after_commit(called.append, "failed", conn=conn)
+        self.assertFalse(conn.in_transaction)
+        with db.transaction(conn):
+            db.after_commit(called.append, "committed", conn=conn)
+        self.assertEqual(called, ["committed"])
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM child").fetchone()[0], 0)
+
+    def test_failing_callback_keeps_the_commit(self):
+        # Test that a callback raising after the commit does not fail the writes of the batch
+        def fail():
+            raise RuntimeError("callback failed")
+
+        def write(name):
+            db.after_commit(fail)
+            return add_expense(f"food {name} no 10")
+
+        async def run():
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                results = await asyncio.gather(db.write(write, "first"), db.write(add_expense, "food second no 10"))
+            await db.stop()
+            return results, output.getvalue()
+
+        results, output = asyncio.run(run())
+        self.assertEqual(results, [True, True])
+        self.assertIn("callback failed", output)
+        self.assertEqual(len(get_today_expenses(0)), 2)
+
+
+class TestImporter(DbTestCase):
+    def test_import_csv(self):
+        # Test that valid rows are inserted and invalid rows are reported with their line
+        data = ("name,category,shared,amount,date\n"
+                "bread,food,no,5,01.01.2022\n"
+                "pizza,eo,yes,40.5,2022-01-02\n"
+                "broken,food,maybe,5,01.01.2022\n"
+                "soap,cosmetics,no,-1,01.01.2022\n")
+
+        async def run():
+            result = await importer.import_csv(io.BytesIO(data.encode()), 0)
+            await db.stop()
+            return result
+
+        result = asyncio.run(run())
+        self.assertEqual(result['inserted'], 2)
+        self.assertEqual(result['rejected'], 2)
+        self.assertEqual([line for line, _ in result['errors']], [4, 5])
+        conn = db.get_connection()
+        self.assertEqual(conn.execute("SELECT category, date FROM expenses WHERE name = 'pizza'").fetchone(),
+                         ("eating out", "2022-01-02"))
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM shared_expenses").fetchone()[0], 1)
+        self.assertEqual(conn.execute("SELECT SUM(total) FROM monthly_totals").fetchone()[0], 45.5)
+
+    def test_import_in_chunks(self):
+        # Test that a file bigger than a chunk is fully imported
+        data = "".join(f"item {i},food,no,1,02.01.2022\n" for i in range(25))
+        old_size = importer.IMPORT_CHUNK_SIZE
+        importer.IMPORT_CHUNK_SIZE = 10
+
+        async def run():
+            result = await importer.import_csv(io.BytesIO(data.encode()), 0)
+            await db.stop()
+            return result
+
+        try:
+            result = asyncio.run(run())
+        finally:
+            importer.IMPORT_CHUNK_SIZE = old_size
+        self.assertEqual(result['inserted'], 25)
+
+    def test_fallback_encoding(self):
+        # Test that a file that is not UTF-8 is read with the fallback encoding
+        data = "chleb żytni,food,no,5,01.01.2022\n".encode('cp1250')
+
+        async def run():
+            result = await importer.import_csv(io.BytesIO(data), 0)
+            await db.stop()
+            return result
+
+        self.assertEqual(asyncio.run(run())['inserted'], 1)
+        self.assertEqual(db.get_connection().execute("SELECT name FROM expenses").fetchone()[0], "chleb żytni")
+
+    def test_import_errors_are_reported(self):
+        # Test that an unreadable file or a failed insert stops the import with the partial counts
+        old_size = importer.IMPORT_CHUNK_SIZE
+        importer.IMPORT_CHUNK_SIZE = 400
+        # The file is decoded in blocks of 8 KB, the broken byte is in a later block than the first two chunks
+        unreadable = b"bread,food,no,5,01.01.2022\n" * 1000 + b"\x81,food,no,5,01.01.2022\n"
+
+        async def run():
+            results = [await importer.import_csv(io.BytesIO(unreadable), 0)]
+            with mock.patch.object(importer, 'insert_expenses', side_effect=sqlite3.OperationalError("locked")):
+                results.append(await importer.import_csv(io.BytesIO(b"bread,food,no,5,01.01.2022\n"), 0))
+            await db.stop()
+            return results
+
+        try:
+            unreadable_result, failed_result = asyncio.run(run())
+        finally:
+            importer.IMPORT_CHUNK_SIZE = old_size
+        self.assertEqual(unreadable_result['inserted'], 800)
+        self.assertIn("Import stopped, the file could not be read after line 800",
+                      importer.format_summary(unreadable_result))
+        self.assertEqual(failed_result['inserted'], 0)
+        self.assertIn("Import stopped, the expenses after line 0 could not be saved",
+                      importer.format_summary(failed_result))
+
+
+class TestExporter(DbTestCase):
+    def setUp(self):
+        super().setUp()
+        with db.transaction() as conn:
+            conn.executemany("INSERT INTO expenses (name, category, shared, amount, date) VALUES (?, ?, ?, ?, ?)",
+                             [(f"item {i}", "food", 0, i, f"2022-01-{i:02d}") for i in range(1, 31)])
+
+    def test_export_csv(self):
+        # Test that only the rows of the range are exported, in date order
+        file, filename, count = exporter.export_expenses(0, "2022-01-10", "2022-01-12")
+        with file:
+            lines = file.read().decode().splitlines()
+        self.assertEqual(filename, "expenses.csv")
+        self.assertEqual(count, 2)
+        self.assertEqual(lines, ["name,category,shared,amount,date",
+                                 "item 10,food,no,10,2022-01-10", "item 11,food,no,11,2022-01-11"])
+
+    def test_export_jsonl(self):
+        # Test the JSON lines export
+        file, _, _ = exporter.export_expenses(0, "2022-01-01", "2022-01-02", "jsonl")
+        with file:
+            rows = [json.loads(line) for line in file]
+        self.assertEqual(rows, [{"name": "item 1", "category": "food", "shared": "no", "amount": 1,
+                                 "date": "2022-01-01"}])
+
+    def test_export_compressed(self):
+        # Test that big exports are gzip compressed
+        old_rows = exporter.EXPORT_COMPRESS_ROWS
+        exporter.EXPORT_COMPRESS_ROWS = 10
+        try:
+            file, filename, count = exporter.export_expenses(0, "2022-01-01", "2022-02-01")
+        finally:
+            exporter.EXPORT_COMPRESS_ROWS = old_rows
+        with file:
+            lines = gzip.decompress(file.read()).decode().splitlines()
+        self.assertEqual(filename, "expenses.csv.gz")
+        self.assertEqual(len(lines), count + 1)
+
+    def test_export_command(self):
+        # Test that the export is sent as a document unless it is bigger than Telegram accepts
+        async def run(max_size):
+            update, context = bench.make_update("/export 01.01.2022 31.01.2022", 0)
+            update.message.reply_text = mock.AsyncMock()
+            context.bot.send_document = mock.AsyncMock()
+            with mock.patch.object(exporter, 'EXPORT_MAX_SIZE', max_size):
+                await main.export_command(update, context)
+            await db.stop()
+            return update.message.reply_text.call_args, context.bot.send_document.call_args
+
+        reply, sent = asyncio.run(run(100))
+        self.assertIsNone(sent)
+        self.assertIn("export a shorter period", reply.args[0])
+        reply, sent = asyncio.run(run(10000))
+        self.assertIsNone(reply)
+        self.assertEqual(len(sent.kwargs['document'].input_file_content.decode().splitlines()), 31)
+
+
+class TestListing(DbTestCase):
+    def setUp(self):
+        super().setUp()
+        # Three expenses a day, so the pages split days
+        with db.transaction() as conn:
+            conn.executemany("INSERT INTO expenses (name, category, shared, amount, date) VALUES (?, ?, ?, ?, ?)",
+                             [(f"item {i}", "food", i % 2, i, f"2022-01-{i // 3 + 1:02d}") for i in range(45)])
+
+    def test_pages(self):
+        # Test that walking the older pages lists every expense once, newest first, and the newer pages go back
+        start, end = "2022-01-01", "2022-02-01"
+        pages = [listing.fetch_page(0, start, end, size=10)]
+        while pages[-1].older:
+            pages.append(listing.fetch_page(0, start, end, listing.OLDER, pages[-1].rows[-1][1::-1], size=10))
+        names = [row[2] for page in pages for row in page.rows]
+        self.assertEqual(names, [f"item {i}" for i in range(44, -1, -1)])
+        self.assertEqual([(page.newer, page.older) for page in pages], [(False, True)] + [(True, True)] * 3
+                         + [(True, False)])
+        self.assertEqual([page.running for page in pages], [395, 690, 885, 980, 990])
+        self.assertEqual((pages[-1].total, pages[-1].count), (990, 45))
+
+        newer = listing.fetch_page(0, start, end, listing.NEWER, pages[3].rows[0][1::-1], size=10)
+        self.assertEqual(newer.rows, pages[2].rows)
+        # Back at the top the first page is full again
+        first = listing.fetch_page(0, start, end, listing.NEWER, pages[0].rows[5][1::-1], size=10)
+        self.assertEqual((first.rows, first.newer), (pages[0].rows, False))
+
+    def test_callback_data(self):
+        # Test that the buttons carry the period and the cursor and fit Telegram's 64 bytes
+        page = listing.fetch_page(0, "2022-01-01", "2022-02-01", size=10)
+        buttons = listing.keyboard(page, "2022-01-01", "2022-02-01").inline_keyboard[0]
+        self.assertEqual([button.text for button in buttons], ["Older »"])
+        self.assertLessEqual(len(buttons[0].callback_data), 64)
+        self.assertEqual(listing.parse_callback(buttons[0].callback_data),
+                         ("2022-01-01", "2022-02-01", listing.OLDER, ("2022-01-12", 36)))
+        with self.assertRaises(ValueError):
+            listing.parse_callback("list:2022-01-01:2022-02-01:x:2022-01-12:35")
+
+    def test_page_callback(self):
+        # Test that a button replaces the message with the next page
+        async def run():
+            query = SimpleNamespace(data=listing.callback_data("2022-01-01", "2022-02-01", listing.OLDER,
+                                                               (6, "2022-01-03")),
+                                    answer=mock.AsyncMock(), edit_message_text=mock.AsyncMock())
+            update = SimpleNamespace(callback_query=query, effective_chat=SimpleNamespace(id=0))
+            await main.listing_page_callback(update, None)
+            await db.stop()
+            return query
+
+        query = asyncio.run(run())
+        query.answer.assert_awaited_once()
+        text = query.edit_message_text.call_args.args[0]
+        self.assertEqual(text.splitlines()[1:], ["02.01.2022 item 5 (food, shared): 5.00",
+                                                 "02.01.2022 item 4 (food): 4.00",
+                                                 "02.01.2022 item 3 (food, shared): 3.00",
+                                                 "01.01.2022 item 2 (food): 2.00",
+                                                 "01.01.2022 item 1 (food, shared): 1.00",
+                                                 "01.01.2022 item 0 (food): 0.00",
+                                                 "Running total 990.00 of 990.00 (45 expenses)"])
+
+
+class TestSearch(DbTestCase):
+    def setUp(self):
+        super().setUp()
+        with db.transaction() as conn:
+            conn.executemany("INSERT INTO expenses (name, category, shared, amount, date, chat_id) "
+                             "VALUES (?, ?, ?, ?, ?, ?)",
+                             [("pizza margherita", "eating out", 0, 30, "2022-01-05", 0),
+                              ("pizza pizza", "eating out", 1, 20, "2022-02-05", 0),
+                              ("pizzeria", "eating out", 0, 45, "2022-03-05", 0),
+                              ("sushi", "eating out", 0, 50, "2022-03-06", 0),
+                              ("bread", "food", 0, 5, "2022-03-07", 0),
+                              ("pizza", "eating out", 0, 99, "2022-03-05", 1)])
+
+    def test_search(self):
+        # Test the prefix matching, the ranking, the date range and the chat filters
+        result = search.search(0, "PIZ")
+        self.assertEqual((result.count, result.total), (3, 95))
+        self.assertEqual(result.rows[0][1], "pizza pizza")
+        self.assertEqual(search.search(0, "pizza", "2022-02-01", "2022-03-01").rows,
+                         [("2022-02-05", "pizza pizza", "eating out", 1, 20)])
+        self.assertEqual(search.search(0, "eating out").count, 4)
+        self.assertEqual(search.search(0, "pizza bread").count, 0)
+
+    def test_newest_past_rank_limit(self):
+        # Test that the newest matches are listed when too many match to rank them
+        old_limit = search.SEARCH_RANK_LIMIT
+        search.SEARCH_RANK_LIMIT = 1
+        try:
+            result = search.search(0, "eat", limit=2)
+        finally:
+            search.SEARCH_RANK_LIMIT = old_limit
+        self.assertEqual(([row[0] for row in result.rows], result.count), (["2022-03-06", "2022-03-05"], 4))
+
+    def test_match_query(self):
+        # Test that the FTS5 syntax typed by the users is matched as words
+        self.assertEqual(search.match_query('pizza" OR NEAR(x'), '"pizza"* "or"* "near"* "x"*')
+        with self.assertRaises(ValueError):
+            search.match_query("*")
+
+    def test_index_in_sync(self):
+        # Test that the deleted, changed and archived expenses are found where they are
+        remove_last_expense(1)
+        self.assertEqual(search.search(1, "pizza").count, 0)
+        with db.transaction() as conn:
+            conn.execute("UPDATE expenses SET name = 'calzone' WHERE name = 'pizzeria'")
+        self.assertEqual((search.search(0, "pizzeria").count, search.search(0, "calz").count), (0, 1))
+        conn = maintenance.connect()
+        archive.archive(conn, date(2024, 1, 1))
+        conn.close()
+        indexed = db.get_connection().execute("SELECT COUNT(*) FROM expenses_fts WHERE expenses_fts MATCH 'calzone'")
+        self.assertEqual(indexed.fetchone(), (0,))
+        self.assertEqual(search.search(0, "calz", "2022-01-01", "2023-01-01").count, 1)
+
+    def test_search_command(self):
+        # Test the dates of the command
+        async def run():
+            replies = []
+            for text in ("/search pizza 01.02.2022 28.02.2022", "/search 01.02.2022", "/search pizza 31.02.2022"):
+                update, context = bench.make_update(text, 0)
+                update.message.reply_text = mock.AsyncMock()
+                await main.search_command(update, context)
+                replies.append(update.message.reply_text.call_args.args[0])
+            await db.stop()
+            return replies
+
+        self.assertEqual(asyncio.run(run()), [
+            "Expenses matching 'pizza': 1, total 20.00\n05.02.2022 pizza pizza (eating out, shared): 20.00",
+            "Please use the format 'search terms [from] [to]'",
+            "Invalid date. Please enter a valid date in the format dd.mm.yyyy."])
+
+
+    def test_index_scoped_by_chat(self):
+        # Test that the index only returns the matches of the searching chat among many chats
+        with db.transaction() as conn:
+            conn.executemany("INSERT INTO expenses (name, category, shared, amount, date, chat_id) "
+                             "VALUES ('pizza', 'eating out', 0, 10, '2022-03-05', ?)", [(i,) for i in range(-50, 50)])
+        matches = conn.execute("SELECT COUNT(*) FROM expenses_fts WHERE expenses_fts MATCH ?",
+                               (f'chat : "{db.chat_token(-7)}" AND pizza',))
+        self.assertEqual(matches.fetchone(), (1,))
+        self.assertEqual((search.search(-7, "piz").count, search.search(0, "piz").count), (1, 4))
+        self.assertEqual(search.search(0, "c0").count, 0)
+        with db.transaction() as conn:
+            db.claim_legacy_expenses(conn, 100)
+        self.assertEqual((search.search(0, "piz").count, search.search(100, "piz").count), (0, 4))
+
+    def test_search_more_archives_than_attached(self):
+        # Test that an all-time search covers more archived years than can be attached at once
+        with db.transaction() as conn:
+            conn.executemany("INSERT INTO expenses (name, category, shared, amount, date, chat_id) "
+                             "VALUES ('pizza', 'eating out', 0, 1, ?, 0)", [(f"{year}-06-01",) for year in (2019, 2020)])
+        conn = maintenance.connect()
+        self.assertEqual(sorted(archive.archive(conn, date(2024, 1, 1))), [2019, 2020, 2022])
+        conn.close()
+        with mock.patch.object(archive, 'ARCHIVE_MAX_ATTACHED', 2):
+            result = search.search(0, "piz", limit=10)
+        self.assertEqual((result.count, result.total), (5, 97))
+        self.assertEqual([row[1] for row in result.rows[:1]], ["pizza pizza"])
+
+    def test_upgrade_archive_index(self):
+        # Test that an archive indexed without the chats gets the new index when it is attached
+        os.makedirs(archive.archive_dir(), exist_ok=True)
+        old = sqlite3.connect(archive.archive_path(2019))
+        old.execute("CREATE TABLE expenses (id integer PRIMARY KEY, chat_id integer, name text, category text, "
+                    "shared integer, amount integer, date text)")
+        old.execute("CREATE VIRTUAL TABLE expenses_fts USING fts5(name, category, content='expenses', "
+                    "content_rowid='id', prefix='2 3')")
+        old.execute("INSERT INTO expenses VALUES (1, 0, 'pizza', 'eating out', 0, 12, '2019-05-01')")
+        old.execute("INSERT INTO expenses_fts (expenses_fts) VALUES ('rebuild')")
+        old.commit()
+        old.close()
+        with db.transaction() as conn:
+            conn.execute("INSERT INTO archived_years (year, rows) VALUES (2019, 1)")
+        self.assertEqual(search.search(0, "piz", "2019-01-01", "2020-01-01").count, 1)
+        self.assertEqual(search.search(1, "piz", "2019-01-01", "2020-01-01").count, 0)
+
+
+class TestReportCache(unittest.TestCase):
+    def setUp(self):
+        report_cache.cache_clear()
+
+    def test_hit_and_miss(self):
+        # Test that the second request for a report is served from the cache
+        version, report = report_cache.get(0, "2022-01", "monthly")
+        self.assertIsNone(report)
+        report_cache.put(0, "2022-01", "monthly", version, b"report")
+        self.assertEqual(report_cache.get(0, "2022-01", "monthly")[1], b"report")
+        self.assertEqual(report_cache.cache_info()[:2], (1, 1))
+
+    def test_bump_version(self):
+        # Test that a write in the period invalidates the month and the year reports
+        report_cache.put(0, "2022-01", "monthly", report_cache.get(0, "2022-01", "monthly")[0], b"old")
+        report_cache.put(0, "2022", "yearly", report_cache.get(0, "2022", "yearly")[0], b"old")
+        report_cache.bump_version(0, "2022-01-15")
+        self.assertIsNone(report_cache.get(0, "2022-01", "monthly")[1])
+        self.assertIsNone(report_cache.get(0, "2022", "yearly")[1])
+
+    def test_put_stale_version(self):
+        # Test that a report rendered before a write is not cached
+        version, _ = report_cache.get(0, "2022-01", "monthly")
+        report_cache.bump_version(0, "2022-01-15")
+        report_cache.put(0, "2022-01", "monthly", version, b"stale")
+        self.assertIsNone(report_cache.get(0, "2022-01", "monthly")[1])
+
+    def test_lru_eviction(self):
+        # Test that the least recently used report is evicted first
+        for month in range(1, report_cache.REPORT_CACHE_SIZE + 2):
+            report_cache.put(0, f"2022-{month:02d}", "monthly", 0, b"report")
+        self.assertEqual(report_cache.cache_info().currsize, report_cache.REPORT_CACHE_SIZE)
+        self.assertIsNone(report_cache.get(0, "2022-01", "monthly")[1])
+        self.assertEqual(report_cache.get(0, "2022-02", "monthly")[1], b"report")
+
+
+class TestReportPool(unittest.TestCase):
+    def test_queue_full(self):
+        # Test that a render request is rejected when the queue is full
+        old_size = report_pool.REPORT_QUEUE_SIZE
+        report_pool.REPORT_QUEUE_SIZE = 0
+        try:
+            with self.assertRaises(report_pool.QueueFull):
+                asyncio.run(report_pool.render("monthly", 1, 2022))
+        finally:
+            report_pool.REPORT_QUEUE_SIZE = old_size
+
+
+class TestArchive(DbTestCase):
+    def setUp(self):
+        super().setUp()
+        with db.transaction() as conn:
+            conn.executemany("INSERT INTO expenses (name, category, shared, amount, date) VALUES (?, ?, ?, ?, ?)",
+                             [(f"item {i}", "food", i % 2, i, f"{2020 + i % 3}-{i % 12 + 1:02d}-01")
+                              for i in range(60)])
+
+    def archive(self, day):
+        conn = maintenance.connect()
+        try:
+            return archive.archive(conn, day)
+        finally:
+            conn.close()
+
+    def test_archive_closed_years(self):
+        # Test that the old closed years move to their archives and are still read by the reports and exports
+        yearly, monthly = get_yearly_totals(0, 2020), get_monthly_totals(0, 4, 2020)
+        self.assertEqual(self.archive(date(2022, 6, 1)), {2020: 20})
+        self.assertTrue(os.path.exists(os.path.join(self.tmp.name, "archive", "expenses-2020.db")))
+        conn = db.get_connection()
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM expenses WHERE date < '2021-01-01'").fetchone()[0], 0)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM monthly_totals WHERE month < '2021'").fetchone()[0], 0)
+        self.assertEqual((get_yearly_totals(0, 2020), get_monthly_totals(0, 4, 2020)), (yearly, monthly))
+        self.assertEqual(get_yearly_totals(0, 2021)['per_bucket'][2], 62.5)
+
+        file, _, count = exporter.export_expenses(0, "2020-01-01", "2021-03-01")
+        with file:
+            dates = [line.split(',')[-1] for line in file.read().decode().splitlines()[1:]]
+        self.assertEqual((count, len(dates), dates, max(dates)), (25, 25, sorted(dates), "2021-02-01"))
+
+    def test_archive_in_chunks(self):
+        # Test that a year moved a few expenses per transaction keeps its totals, rollups and search index
+        yearly, monthly = get_yearly_totals(0, 2020), get_monthly_totals(0, 4, 2020)
+        conn = maintenance.connect()
+        try:
+            with mock.patch.object(archive, 'ARCHIVE_CHUNK_PAUSE', 0):
+                self.assertEqual(archive.archive_year(conn, 2020, chunk_size=3), 20)
+            self.assertEqual(conn.execute("SELECT SUM(count) FROM archive_2020.monthly_totals").fetchone()[0], 20)
+        finally:
+            conn.close()
+        self.assertEqual((get_yearly_totals(0, 2020), get_monthly_totals(0, 4, 2020)), (yearly, monthly))
+        self.assertEqual(search.search(0, "item", "2020-01-01", "2021-01-01").count, 20)
+        self.assertEqual(db.get_connection().execute("SELECT rows FROM archived_years").fetchall(), [(20,)])
+
+    def test_late_expenses(self):
+        # Test that an expense added to an archived year is counted and moved by the next archiving
+        self.archive(date(2022, 6, 1))
+        total = get_yearly_totals(0, 2020)['per_bucket'][1]
+        self.assertTrue(add_expense("food late no 7 15.01.2020"))
+        self.assertEqual(get_yearly_totals(0, 2020)['per_bucket'][1], total + 7)
+        self.assertEqual(self.archive(date(2022, 6, 1)), {2020: 1})
+        self.assertEqual(get_yearly_totals(0, 2020)['per_bucket'][1], total + 7)
+        self.assertEqual(db.get_connection().execute("SELECT rows FROM archived_years").fetchall(), [(21,)])
+
+
+class TestMaintenance(DbTestCase):
+    def test_run(self):
+        # Test that a run enables the incremental vacuum, frees the pages of the deleted expenses and is reported
+        conn = db.connect(isolation_level=None)
+        conn.execute("CREATE TABLE expenses (name text, category text, shared text, amount integer, date text)")
+        conn.executemany("INSERT INTO expenses VALUES (?, 'food', 'no', 1, '2021-01-01')",
+                         [("x" * 200,)] * 5000)
+        conn.close()
+        with db.transaction() as conn:
+            conn.execute("DELETE FROM expenses")
+        self.assertFalse(maintenance.health()['incremental_vacuum'])
+        self.assertGreater(maintenance.health()['free_pages'], 100)
+
+        # /maintenance leaves the switch, which rewrites the file, to the daily job and the command line
+        result = maintenance.run(date(2024, 1, 1))
+        self.assertFalse(result['vacuum_enabled'] or result['incremental_vacuum'])
+        self.assertIn("incremental vacuum not enabled yet", maintenance.format_result(result))
+
+        result = maintenance.run(date(2024, 1, 1), switch_vacuum=True)
+        self.assertEqual(result['archived'], {})
+        self.assertTrue(result['vacuum_enabled'])
+        db.close()
+        info = maintenance.health()
+        self.assertTrue(info['incremental_vacuum'])
+        self.assertLess(info['free_pages'], 10)
+        self.assertEqual(info['rows']['expenses'], 0)
+        self.assertIn("Rows: expenses 0", maintenance.format_health(info))
+
+
+class TestPrerender(DbTestCase):
+    def setUp(self):
+        super().setUp()
+        report_cache.cache_clear()
+        for chat_id, count in ((1, 1), (2, 3)):
+            for _ in range(count):
+                add_expense("food bread no 5 15.12.2022", chat_id)
+
+    def test_closed_periods(self):
+        # Test that the job renders the month before and the year when it was December
+        self.assertEqual(prerender.closed_periods(date(2023, 1, 1)), (12, 2022, True))
+        self.assertEqual(prerender.closed_periods(date(2023, 5, 1)), (4, 2023, False))
+
+    def test_prerender_closed_month(self):
+        # Test that the reports of the active ledgers are rendered into the cache once
+        async def run():
+            with mock.patch.object(report_pool, 'render', mock.AsyncMock(return_value=b"report")) as render:
+                first = await prerender.prerender(12, 2022, True)
+                second = await prerender.prerender(12, 2022, True)
+            await db.stop()
+            return first, second, render.await_args_list
+
+        first, second, calls = asyncio.run(run())
+        self.assertEqual((first, second), (4, 0))
+        # The most active ledger goes first
+        self.assertEqual(calls[0].args, ('monthly', 2, 12, 2022))
+        self.assertEqual(report_cache.get(1, "2022", "yearly")[1], b"report")
+
+    def test_waits_for_busy_pool(self):
+        # Test that pre-rendering waits while the workers render interactive reports
+        async def run():
+            with mock.patch.object(report_pool, 'pending', side_effect=[report_pool.REPORT_WORKERS, 0]), \
+                    mock.patch.object(report_pool, 'render', mock.AsyncMock(return_value=b"report")), \
+                    mock.patch.object(prerender, 'PRERENDER_BUSY_WAIT', 0):
+                return await prerender.prerender_report(1, "2022-12", "monthly", 12, 2022)
+
+        self.assertTrue(asyncio.run(run()))
+
+
+class TestConcurrency(unittest.TestCase):
+    def test_coalesce(self):
+        # Test that identical calls running at the same time share one computation
+        calls = []
+
+        async def compute(value):
+            calls.append(value)
+            await asyncio.sleep(0.01)
+            return value * 2
+
+        async def run():
+            return await asyncio.gather(*(concurrency.coalesce(('test', 1), compute, 21) for _ in range(3)),
+                                        concurrency.coalesce(('test', 2), compute, 5))
+
+        self.assertEqual(asyncio.run(run()), [42, 42, 42, 10])
+        self.assertEqual(calls, [21, 5])
+
+    def test_coalesced_error(self):
+        # Test that every waiter gets the error of the shared computation
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise report_pool.QueueFull()
+
+        async def run():
+            return await asyncio.gather(*(concurrency.coalesce(('test',), fail) for _ in range(2)),
+                                        return_exceptions=True)
+
+        self.assertTrue(all(isinstance(result, report_pool.QueueFull) for result in asyncio.run(run())))
+
+    def test_heavy_limits(self):
+        # Test that a chat runs one heavy computation at a time while other chats run in parallel
+        running = {}
+        peaks = {}
+
+        async def work(chat_id):
+            async with concurrency.heavy(chat_id):
+                running[chat_id] = running.get(chat_id, 0) + 1
+                peaks[chat_id] = max(peaks.get(chat_id, 0), running[chat_id])
+                peaks['all'] = max(peaks.get('all', 0), sum(running.values()))
+                await asyncio.sleep(0.01)
+                running[chat_id] -= 1
+
+        async def run():
+            await asyncio.gather(*(work(chat_id) for chat_id in (1, 1, 1, 2, 3)))
+
+        with mock.patch.object(concurrency, 'CHAT_HEAVY_LIMIT', 1), mock.patch.object(concurrency, 'HEAVY_LIMIT', 2):
+            asyncio.run(run())
+        self.assertEqual((peaks[1], peaks['all']), (1, 2))
+        self.assertEqual(concurrency._chat_slots, {})
+
+    def test_repeated_report_requests(self):
+        # Test that tapping /yearly_report several times renders the report once
+        report_cache.cache_clear()
+
+        async def render(*_, **__):
+            await asyncio.sleep(0.01)
+            return b"report"
+
+        async def run():
+            updates = [bench.make_update("/yearly_report 2024", 5) for _ in range(3)]
+            await asyncio.gather(*(main.yearly_report_command(*update) for update in updates))
+
+        with mock.patch.object(report_pool, 'render', mock.AsyncMock(side_effect=render)) as render_mock:
+            asyncio.run(run())
+        self.assertEqual(render_mock.await_count, 1)
+
+    def test_busy_pool_rejects_reports(self):
+        # Test that the reports waiting for a heavy slot count against the report queue
+        report_cache.cache_clear()
+
+        def render(report_type, args):
+            time.sleep(0.05)
+            return b"report", ({}, {})
+
+        async def run():
+            updates = [bench.make_update(f"/yearly_report {2020 + chat_id}", chat_id)[0] for chat_id in range(6)]
+            reports = await asyncio.gather(*(main.get_report(update, f"{2020 + chat_id}", 'yearly', 2020 + chat_id)
+                                             for chat_id, update in enumerate(updates)))
+            return reports, [update.message.replies for update in updates]
+
+        with ThreadPoolExecutor(2) as executor, mock.patch.object(report_pool, '_render', render), \
+                mock.patch.object(report_pool, 'get_executor', return_value=executor), \
+                mock.patch.object(report_pool, 'REPORT_QUEUE_SIZE', 3), \
+                mock.patch.object(concurrency, 'HEAVY_LIMIT', 1):
+            reports, replies = asyncio.run(run())
+        self.assertEqual(reports, [b"report"] * 3 + [None] * 3)
+        self.assertEqual(replies, [0] * 3 + [1] * 3)
+        self.assertEqual(report_pool.pending(), 0)
+
+
+UPDATE_JSON = {
+    "update_id": 1,
+    "message": {
+        "message_id": 10,
+        "date": 1700000000,
+        "chat": {"id": 42, "type": "private", "first_name": "Test"},
+        "from": {"id": 42, "is_bot": False, "first_name": "Test"},
+        "text": "/today_expenses",
+        "entities": [{"type": "bot_command", "offset": 0, "length": 15}],
+    },
+}
+
+
+class TestWebhook(unittest.TestCase):
+    async def post(self, port, body, secret="secret", path="/telegram"):
+        # Send a request to the local endpoint and return the status code
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write((f"POST {path} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+                      f"X-Telegram-Bot-Api-Secret-Token: {secret}\r\nContent-Length: {len(body)}\r\n\r\n").encode()
+                     + body)
+        await writer.drain()
+        status = int((await reader.readline()).split()[1])
+        writer.close()
+        return status
+
+    def run_receiver(self, requests, queue_size=10):
+        # Start the receiver on a free port, send the requests and return the statuses and the queued updates
+        async def run():
+            queue = asyncio.Queue(maxsize=queue_size)
+            server = await webhook.start_receiver(queue, None, "127.0.0.1", 0, "/telegram", "secret")
+            port = server.sockets[0].getsockname()[1]
+            statuses = [await self.post(port, *request) for request in requests]
+            server.close()
+            await server.wait_closed()
+            return statuses, [queue.get_nowait() for _ in range(queue.qsize())]
+
+        return asyncio.run(run())
+
+    def test_update_is_queued(self):
+        # Test that a recorded update POSTed to the endpoint reaches the update queue
+        statuses, updates = self.run_receiver([(json.dumps(UPDATE_JSON).encode(),)])
+        self.assertEqual(statuses, [200])
+        self.assertEqual(updates[0].message.text, "/today_expenses")
+        self.assertEqual(updates[0].effective_chat.id, 42)
+
+    def test_wrong_secret(self):
+        # Test that updates with a wrong secret token are rejected
+        statuses, updates = self.run_receiver([(json.dumps(UPDATE_JSON).encode(), "wrong")])
+        self.assertEqual(statuses, [403])
+        self.assertEqual(updates, [])
+
+    def test_secret_is_required(self):
+        # Test that the receiver does not start without a secret token
+        with mock.patch.object(webhook, 'WEBHOOK_SECRET', None):
+            with self.assertRaises(ValueError):
+                asyncio.run(webhook.start_receiver(asyncio.Queue(), None, "127.0.0.1", 0))
+
+    def test_full_queue(self):
+        # Test that Telegram is asked to retry when the update queue is full
+        body = json.dumps(UPDATE_JSON).encode()
+        statuses, updates = self.run_receiver([(body,), (body,)], queue_size=1)
+        self.assertEqual(statuses, [200, 503])
+
+    def test_invalid_json(self):
+        # Test that a malformed body is rejected
+        statuses, _ = self.run_receiver([(b"not json",), (b"{}", "secret", "/other")])
+        self.assertEqual(statuses, [400, 404])
+
+
+class TestMetrics(DbTestCase):
+    def setUp(self):
+        super().setUp()
+        metrics.reset()
+
+    def test_instrument_handler(self):
+        # Test that the wrapper counts the calls and errors of a handler and records its latency
+        async def failing_command(update, _):
+            raise ValueError("broken")
+
+        handler = metrics.instrument(failing_command)
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                asyncio.run(handler(None, None))
+        text = metrics.render()
+        self.assertIn('bot_handler_calls_total{handler="failing_command"} 2', text)
+        self.assertIn('bot_handler_errors_total{handler="failing_command"} 2', text)
+        self.assertIn('bot_handler_seconds_bucket{handler="failing_command",le="+Inf"} 2', text)
+        self.assertIn('bot_handler_seconds_count{handler="failing_command"} 2', text)
+
+    def test_sql_statements_are_timed(self):
+        # Test that the statements run on the thread's connection are timed and their rows counted
+        add_expense("food bread no 10")
+        get_today_expenses(0)
+        label = metrics.statement_label(f"SELECT name, category, {db.SHARED_AS_TEXT}, amount, date FROM expenses "
+                                        "WHERE chat_id = ? AND date = ?")
+        self.assertIn(f'bot_sql_rows_total{{statement="{label}"}} 1', metrics.render())
+        self.assertIn(f"{label}: 1, ", metrics.summary(top=100))
+
+    def test_writer_batches(self):
+        # Test that the batch sizes and commit latencies of the writer are exported and summarized
+        async def run():
+            await asyncio.gather(*(db.write(add_expense, f"food test {i} no 10") for i in range(3)))
+            await db.stop()
+
+        asyncio.run(run())
+        text = metrics.render()
+        self.assertIn("bot_db_write_batches_total 1", text)
+        self.assertIn("bot_db_writes_total 3", text)
+        self.assertIn("bot_db_write_batch_seconds_count 1", text)
+        self.assertIn("Writer: 1 batches, 3.0 writes per batch", metrics.summary())
+
+    def test_worker_metrics_are_merged(self):
+        # Test that the metrics drained in another process are added to the bot's
+        metrics.observe('bot_report_seconds', 0.2, phase='charts')
+        state = metrics.drain()
+        self.assertNotIn('phase="charts"', metrics.render())
+        metrics.merge(state)
+        metrics.merge(state)
+        self.assertIn('bot_report_seconds_count{phase="charts"} 2', metrics.render())
+
+    def test_metrics_endpoint(self):
+        # Test that the endpoint serves the metrics in the Prometheus text format
+        async def run():
+            await metrics.start_server('127.0.0.1', 0)
+            port = metrics._server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            response = await reader.read()
+            writer.close()
+            await metrics.stop_server()
+            return response
+
+        response = asyncio.run(run())
+        self.assertTrue(response.startswith(b"HTTP/1.1 200 OK"))
+        self.assertIn(b"# TYPE bot_handler_seconds histogram", response)
+
+    def test_bot_stats_admin_only(self):
+        # Test that /bot_stats is only answered for the admins
+        update, context = bench.make_update("/bot_stats", 1)
+        update.effective_user = SimpleNamespace(id=7)
+        asyncio.run(main.bot_stats_command(update, context))
+        self.assertEqual(update.message.replies, 1)
+        with mock.patch.object(main, 'ADMIN_IDS', {7}), mock.patch.object(metrics, 'summary', return_value="ok"):
+            asyncio.run(main.bot_stats_command(update, context))
+        self.assertEqual(update.message.replies, 2)
+
+
+class TestStartup(unittest.TestCase):
+    def test_report_stack_is_not_imported(self):
+        # Test that importing the bot does not load matplotlib and python-docx
+        code = "import sys, M_bot.main; print(sorted(m for m in ('matplotlib', 'docx') if m in sys.modules))"
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+        self.assertEqual(output.strip(), "[]")
+
+    def test_import_time(self):
+        # Test that the bot module imports within the startup target
+        code = "import M_bot.main; from M_bot import startup; startup.mark('ready'); print(startup.within_target())"
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+        self.assertEqual(output.strip(), "True")
+
+
+class TestDb(unittest.TestCase):
+    def test_migrate_dates(self):
+        # Test that old dd.mm.yyyy dates are migrated to sortable ISO dates
+        conn = sqlite3.connect(':memory:')
+        conn.execute("CREATE TABLE expenses (name text, category text, shared text, amount integer, date text)")
+        conn.execute("INSERT INTO expenses VALUES ('bread', 'food', 'no', 5, '31.12.2021')")
+        db.init_db(conn)
+        self.assertEqual(conn.execute("SELECT date FROM expenses").fetchone()[0], "2021-12-31")
+
+    def test_migrate_dates_without_leading_zeros(self):
+        # Test that d.m.yyyy dates are migrated too and unreadable ones are quarantined
+        conn = sqlite3.connect(':memory:')
+        conn.execute("CREATE TABLE expenses (name text, category text, shared text, amount integer, date text)")
+        conn.executemany("INSERT INTO expenses VALUES (?, 'food', 'no', 5, ?)",
+                         [("bread", "1.2.2022"), ("milk", "3.11.2022 "), ("typo", "32.1.2022"), ("empty", None)])
+        db.init_db(conn)
+        self.assertEqual(conn.execute("SELECT name, date FROM expenses ORDER BY id").fetchall(),
+                         [("bread", "2022-02-01"), ("milk", "2022-11-03")])
+        self.assertEqual(conn.execute("SELECT month, total FROM monthly_totals ORDER BY month").fetchall(),
+                         [("2022-02", 5), ("2022-11", 5)])
+        self.assertEqual(conn.execute("SELECT source, name, date FROM quarantined_expenses").fetchall(),
+                         [("expenses", "typo", "32.1.2022"), ("expenses", "empty", None)])
+
+    def test_migrate_dates_left_by_the_first_migration(self):
+        # Test that the d.m.yyyy dates left in a migrated database are converted
+        conn = sqlite3.connect(':memory:')
+        with mock.patch.object(db, 'MIGRATIONS', db.MIGRATIONS[:db.MIGRATIONS.index(db._migrate_loose_dates)]):
+            db.init_db(conn)
+        conn.execute("INSERT INTO expenses (chat_id, name, category, amount, date) VALUES (1, 'bread', 'food', 5, "
+                     "'1.2.2022')")
+        db.init_db(conn)
+        self.assertEqual(conn.execute("SELECT date FROM expenses").fetchone()[0], "2022-02-01")
+        self.assertEqual(conn.execute("SELECT chat_id, month, total FROM monthly_totals").fetchall(),
+                         [(1, "2022-02", 5)])
+
+    def test_date_filter_uses_index(self):
+        # Test that a chat's date range query is served by the (chat_id, date) index
+        conn = sqlite3.connect(':memory:')
+        db.init_db(conn)
+        plan = conn.execute("EXPLAIN QUERY PLAN SELECT * FROM expenses WHERE chat_id = ? AND date >= ? AND date < ?",
+                            (1, *db.month_range(1, 2022))).fetchall()
+        self.assertIn("idx_expenses_chat_date", plan[0][3])
+
+    def test_claim_legacy_expenses(self):
+        # Test that the expenses recorded before the migration can be moved to a chat
+        conn = sqlite3.connect(':memory:')
+        conn.execute("CREATE TABLE expenses (name text, category text, shared text, amount integer, date text)")
+        conn.execute("INSERT INTO expenses VALUES ('bread', 'food', 'no', 5, '31.12.2021')")
+        db.init_db(conn)
+        self.assertEqual(db.claim_legacy_expenses(conn, 42), 1)
+        self.assertEqual(conn.execute("SELECT chat_id, month, total FROM monthly_totals").fetchall(),
+                         [(42, "2021-12", 5)])
+
+    def test_migrate_single_table(self):
+        # Test that the copies in shared_expenses are dropped, including the ones left by deletes
+        conn = sqlite3.connect(':memory:', isolation_level=None)
+        for table in ("expenses", "shared_expenses"):
+            conn.execute(f"CREATE TABLE {table} (name text, category text, shared text, amount integer, date text)")
+        conn.executemany("INSERT INTO expenses VALUES (?, ?, ?, ?, ?)",
+                         [("pizza", "eo", "yes", 40, "01.01.2022"), ("bread", "food", "no", 5, "02.01.2022")])
+        conn.executemany("INSERT INTO shared_expenses VALUES (?, ?, ?, ?, ?)",
+                         [("pizza", "eo", "yes", 40, "01.01.2022"), ("deleted", "eo", "yes", 9, "03.01.2022")])
+        db.init_db(conn)
+        self.assertEqual(conn.execute("SELECT name, shared FROM expenses ORDER BY id").fetchall(),
+                         [("pizza", 1), ("bread", 0)])
+        self.assertEqual(conn.execute("SELECT name, shared FROM shared_expenses").fetchall(), [("pizza", "yes")])
+        self.assertEqual(conn.execute("SELECT SUM(total) FROM monthly_totals WHERE shared = 1").fetchone()[0], 40)
+
+    def test_shared_query_uses_covering_index(self):
+        # Test that the shared expenses of a period are read from the partial index only
+        conn = sqlite3.connect(':memory:')
+        db.init_db(conn)
+        plan = conn.execute("EXPLAIN QUERY PLAN SELECT date, category, amount FROM expenses "
+                            "WHERE chat_id = ? AND date >= ? AND date < ? AND shared = 1",
+                            (1, *db.month_range(1, 2022))).fetchall()
+        self.assertIn("COVERING INDEX idx_expenses_shared", plan[0][3])
+
+    def test_month_range_across_year(self):
+        # Test the month_range function for December
+        self.assertEqual(db.month_range(12, 2021), ("2021-12-01", "2022-01-01"))
+
+    def test_week_range(self):
+        # Test the week_range function on a Wednesday
+        self.assertEqual(db.week_range(date(2024, 1, 3)), ("2023-12-31", "2024-01-04"))
+
+
+class TestBenchmarks(DbTestCase):
+    def test_generate_ledger(self):
+        # Test that the generated ledger spans the years up to today with consistent rollups
+        ledger.generate(db.DB_PATH, 2000, years=2, chats=2)
+        conn = db.connect()
+        first, last, chats = conn.execute("SELECT MIN(date), MAX(date), COUNT(DISTINCT chat_id) "
+                                          "FROM expenses").fetchone()
+        self.assertEqual(last, db.today())
+        self.assertLess(first, f"{date.today().year - 1}")
+        self.assertEqual(chats, 2)
+        self.assertEqual(conn.execute("SELECT SUM(count) FROM monthly_totals").fetchone()[0], 2000)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM shared_expenses").fetchone()[0],
+                         conn.execute("SELECT COUNT(*) FROM expenses WHERE shared = 1").fetchone()[0])
+        conn.close()
+
+    def test_drive_handler(self):
+        # Test that a handler sending a spooled export runs against the fake update
+        ledger.generate(db.DB_PATH, 500, years=1)
+
+        async def run():
+            result = await bench.run_case(main.export_command, "/export", 1, False, 2, 0)
+            await db.stop()
+            return result
+
+        result = asyncio.run(run())
+        self.assertEqual(result['iterations'], 2)
+        self.assertGreater(result['p99_ms'], 0)
+
+    def test_output_is_json(self):
+        # Test that only the JSON results are written to stdout
+        output = subprocess.run([sys.executable, "-m", "benchmarks.run", "--rows", "200", "--years", "1",
+                                 "--iterations", "1", "--warmup", "0", "--only", "expense"],
+                                capture_output=True, text=True, check=True, env={**os.environ, 'REPORT_PREWARM': '0'})
+        self.assertEqual(list(json.loads(output.stdout)['cases']), ["expense"])
+        self.assertIn("Startup:", output.stderr)
 
 
 if __name__ == "__main__":